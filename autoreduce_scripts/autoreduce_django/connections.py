@@ -0,0 +1,36 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Reuse of the DB connections by the scripts, see database_settings in the settings module.
+"""
+from django.db import connections
+
+
+def refresh_connections():
+    """
+    Closes the DB connections that are older than their CONN_MAX_AGE or no longer usable,
+    so that the next query opens a new one. Connections that are still good are kept.
+
+    Django only does this at the start and end of each request, so loops that run for
+    a long time outside of a request call this before each operation. Connections in
+    a transaction are left alone.
+    """
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+def close_thread_connections():
+    """
+    Closes the DB connections of the calling thread. Django's connections belong to the thread
+    that opened them, so worker threads close theirs before they finish rather than leaving them
+    open until they are garbage collected.
+    """
+    from django.conf import settings  # pylint:disable=import-outside-toplevel
+
+    if settings.configured:
+        connections.close_all()
@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/3.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
+import copy
+import os
 from pathlib import Path
 
 from autoreduce_db.autoreduce_django.settings import DATABASES as autoreduce_db_settings
@@ -33,15 +35,47 @@ INSTALLED_APPS = [
     'autoreduce_db.reduction_viewer',
     'autoreduce_db.instrument',
 ]
-DATABASES = autoreduce_db_settings
+
+# Seconds an idle DB connection is kept open to be reused, rather than closed after each request
+CONN_MAX_AGE = int(os.environ.get("AUTOREDUCE_DB_CONN_MAX_AGE", "60"))
+
+
+def database_settings(worker_mode: bool = False) -> dict:
+    """
+    Returns autoreduce_db's DATABASES with connection reuse configured.
+
+    Connections are reused for CONN_MAX_AGE seconds. In worker mode, e.g. a long running
+    service, CONN_MAX_AGE is None so each thread keeps its own connection open for the life
+    of the process. This is not a pool: connections are not shared between threads, and
+    ones that break are only closed by connections.refresh_connections before the next
+    operation. Worker mode can also be set with AUTOREDUCE_DB_WORKER_MODE=1.
+
+    If AUTOREDUCE_DB_POOL_HOST is set, connections go through a local connection pooler
+    (e.g. ProxySQL or pgbouncer) on that host and AUTOREDUCE_DB_POOL_PORT instead of
+    straight to the database server.
+    """
+    worker_mode = worker_mode or os.environ.get("AUTOREDUCE_DB_WORKER_MODE") == "1"
+    databases = copy.deepcopy(autoreduce_db_settings)
+    for database in databases.values():
+        database.setdefault("CONN_MAX_AGE", None if worker_mode else CONN_MAX_AGE)
+        if "AUTOREDUCE_DB_POOL_HOST" in os.environ and database["ENGINE"] != "django.db.backends.sqlite3":
+            database["HOST"] = os.environ["AUTOREDUCE_DB_POOL_HOST"]
+            database["PORT"] = os.environ.get("AUTOREDUCE_DB_POOL_PORT", database.get("PORT", ""))
+    return databases
+
+
+DATABASES = database_settings()
 
 MIDDLEWARE = []
 
-ROOT_URLCONF = 'autoreduce_django.urls'
+# The token the clients of the HTTP API must send, see views. If empty, the API refuses every request
+API_TOKEN = os.environ.get("AUTOREDUCE_API_TOKEN", "")
+
+ROOT_URLCONF = 'autoreduce_scripts.autoreduce_django.urls'
 
 TEMPLATES = []
 
-WSGI_APPLICATION = 'autoreduce_django.wsgi.application'
+WSGI_APPLICATION = 'autoreduce_scripts.autoreduce_django.wsgi.application'
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
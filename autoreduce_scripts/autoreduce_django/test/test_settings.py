@@ -0,0 +1,72 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import os
+from unittest.mock import Mock, patch
+
+from django.test import TestCase
+
+from autoreduce_scripts.autoreduce_django.connections import refresh_connections
+from autoreduce_scripts.autoreduce_django.settings import CONN_MAX_AGE, database_settings
+
+MYSQL_DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.mysql",
+        "HOST": "db.example.com",
+        "PORT": "3306",
+    }
+}
+
+
+class DatabaseSettingsTest(TestCase):
+    """
+    Test the connection reuse settings
+    """
+
+    @patch("autoreduce_scripts.autoreduce_django.settings.autoreduce_db_settings", MYSQL_DATABASES)
+    def test_connections_are_reused(self):
+        """
+        Test that connections are kept for CONN_MAX_AGE, without changing autoreduce_db's settings
+        """
+        database = database_settings()["default"]
+        assert database["CONN_MAX_AGE"] == CONN_MAX_AGE
+        assert database["HOST"] == "db.example.com"
+        assert "CONN_MAX_AGE" not in MYSQL_DATABASES["default"]
+
+    @patch("autoreduce_scripts.autoreduce_django.settings.autoreduce_db_settings", MYSQL_DATABASES)
+    def test_worker_mode(self):
+        """
+        Test that connections are kept for the life of the process in worker mode
+        """
+        assert database_settings(worker_mode=True)["default"]["CONN_MAX_AGE"] is None
+        with patch.dict(os.environ, {"AUTOREDUCE_DB_WORKER_MODE": "1"}):
+            assert database_settings()["default"]["CONN_MAX_AGE"] is None
+
+    @patch("autoreduce_scripts.autoreduce_django.settings.autoreduce_db_settings", MYSQL_DATABASES)
+    def test_local_pool(self):
+        """
+        Test that connections go through the local pooler when it is configured
+        """
+        with patch.dict(os.environ, {"AUTOREDUCE_DB_POOL_HOST": "127.0.0.1", "AUTOREDUCE_DB_POOL_PORT": "6033"}):
+            database = database_settings()["default"]
+        assert (database["HOST"], database["PORT"]) == ("127.0.0.1", "6033")
+
+
+class RefreshConnectionsTest(TestCase):
+    """
+    Test that stale connections are closed between operations
+    """
+
+    @patch("autoreduce_scripts.autoreduce_django.connections.connections")
+    def test_refresh_connections(self, mock_connections):
+        """
+        Test that connections are checked for closing, unless they are in a transaction
+        """
+        idle, in_transaction = Mock(in_atomic_block=False), Mock(in_atomic_block=True)
+        mock_connections.all.return_value = [idle, in_transaction]
+        refresh_connections()
+        idle.close_if_unusable_or_obsolete.assert_called_once()
+        in_transaction.close_if_unusable_or_obsolete.assert_not_called()
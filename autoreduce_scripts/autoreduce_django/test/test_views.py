@@ -0,0 +1,226 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import asyncio
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
+
+from django.test import TestCase, override_settings
+
+from autoreduce_scripts.autoreduce_django.views import Job, JobStore, lookup
+
+TOKEN = "secret"
+# the async test client of Django 4.0 takes the header names as they are sent
+AUTHORIZATION = {"authorization": f"Bearer {TOKEN}"}
+
+RUN_DATA = {
+    1234: ("/archive/MARI1234.nxs", "1920000", "Run 1234"),
+    1235: ("/archive/MARI1235.nxs", "1920000", "Run 1235"),
+    1236: ("/archive/MARI1236.nxs", "1930000", "Run 1236"),
+}
+
+
+def fake_run_data(_, run_number):
+    """Returns the data of the fake runs, failing for unknown runs like get_run_data"""
+    if run_number not in RUN_DATA:
+        raise RuntimeError(f"Cannot find datafile for {run_number}")
+    return RUN_DATA[run_number]
+
+
+class JobStoreTestCase(TestCase):
+    """
+    Keeps the jobs in a temporary directory
+    """
+
+    def setUp(self) -> None:
+        self.jobs_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.jobs = JobStore(Path(self.jobs_dir.name, "jobs.sqlite3"), max_jobs=2)
+        jobs_patch = patch("autoreduce_scripts.autoreduce_django.views.get_jobs", return_value=self.jobs)
+        jobs_patch.start()
+        self.addCleanup(jobs_patch.stop)
+
+    def tearDown(self) -> None:
+        self.jobs.connection.close()
+        self.jobs_dir.cleanup()
+
+
+@override_settings(API_TOKEN=TOKEN)
+@patch("autoreduce_scripts.autoreduce_django.views.get_publisher")
+@patch("autoreduce_scripts.autoreduce_django.views.get_run_data", side_effect=fake_run_data)
+@patch("autoreduce_scripts.manual_operations.manual_submission.submit_run")
+class ViewsTest(JobStoreTestCase):
+    """
+    Test the HTTP API for submitting and removing runs
+    """
+
+    async def post(self, url: str, body: dict):
+        """Posts the body as JSON"""
+        return await self.async_client.post(url, body, content_type="application/json", **AUTHORIZATION)
+
+    async def wait_for_job(self, url: str) -> dict:
+        """Polls the job until it is done"""
+        for _ in range(500):
+            job = (await self.async_client.get(url, **AUTHORIZATION)).json()
+            if job["status"] == "done":
+                return job
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"Job {url} did not finish")
+
+    async def test_submit(self, mock_submit_run: Mock, _, mock_get_publisher: Mock):
+        """
+        Test that a range of runs is submitted in order in the background, and failures are reported per run
+        """
+        response = await self.post("/runs/submit", {
+            "instrument": "mari",
+            "first_run": 1234,
+            "last_run": 1237,
+            "description": "rerun"
+        })
+        assert response.status_code == 202
+
+        job = await self.wait_for_job(response.json()["url"])
+        assert job["total"] == job["done"] == 4
+        assert job["results"] == [1234, 1235, 1236]
+        assert job["errors"] == [{"run": 1237, "error": "Cannot find datafile for 1237"}]
+        assert [call.args[4] for call in mock_submit_run.call_args_list] == [1234, 1235, 1236]
+        mock_submit_run.assert_any_call(mock_get_publisher.return_value,
+                                        "1920000",
+                                        "MARI",
+                                        "/archive/MARI1234.nxs",
+                                        1234,
+                                        run_title="Run 1234",
+                                        description="rerun")
+
+    @patch("autoreduce_scripts.autoreduce_django.views.get_icat_client")
+    @patch("autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data")
+    @patch("autoreduce_scripts.manual_operations.manual_batch_submit.submit_run")
+    async def test_batch_submit(self, mock_submit_run: Mock, mock_get_run_data: Mock, mock_get_icat_client: Mock, *_):
+        """
+        Test that a batch is submitted with manual_batch_submit, and refused if the RB numbers don't match
+        or it can't be split as asked
+        """
+        mock_get_run_data.side_effect = lambda instrument, run_number, *_, **__: fake_run_data(instrument, run_number)
+        mock_submit_run.return_value = {"run_number": [1234, 1235]}
+        response = await self.post("/runs/batch", {"instrument": "MARI", "runs": [1234, 1235]})
+        assert response.json() == {"run_number": [1234, 1235]}
+        assert mock_submit_run.call_args.args[3] == ["/archive/MARI1234.nxs", "/archive/MARI1235.nxs"]
+        assert mock_get_run_data.call_args.kwargs == {"icat_client": mock_get_icat_client.return_value}
+
+        response = await self.post("/runs/batch", {"instrument": "MARI", "runs": [1234, 1236]})
+        assert response.status_code == 400
+        assert "mismatching RB numbers" in response.json()["error"]
+
+        response = await self.post("/runs/batch", {"instrument": "MARI", "runs": [1234], "split_by": "size"})
+        assert response.status_code == 400
+        assert mock_submit_run.call_count == 1
+
+    @patch("autoreduce_scripts.autoreduce_django.views.NonInteractiveRemove.delete_records")
+    async def test_remove(self, mock_delete: Mock, *_):
+        """
+        Test that runs are removed without prompting, and runs with multiple versions need delete_all_versions
+        """
+
+        def find_run_versions_in_database(manual_remove, run_number):
+            manual_remove.to_delete[run_number] = [Mock()] * (2 if run_number == 1235 else 1)
+
+        with patch("autoreduce_scripts.autoreduce_django.views.NonInteractiveRemove.find_run_versions_in_database",
+                   new=find_run_versions_in_database):
+            response = await self.post("/runs/remove", {"instrument": "MARI", "runs": [1234, 1235]})
+            job = await self.wait_for_job(response.json()["url"])
+
+        assert job["results"] == [1234]
+        assert "Found multiple versions of MARI1235" in job["errors"][0]["error"]
+        mock_delete.assert_called_once()
+
+    async def test_bad_requests(self, *_):
+        """
+        Test that invalid requests and unknown jobs are refused
+        """
+        assert (await self.async_client.get("/runs/submit", **AUTHORIZATION)).status_code == 400
+        response = await self.post("/runs/submit", {"runs": [1]})
+        assert response.json() == {"error": "Missing the instrument"}
+        response = await self.post("/runs/submit", {"instrument": 1, "runs": [1]})
+        assert response.json() == {"error": "The instrument must be a string"}
+        for body in ({"runs": [[1]]}, {"runs": [1], "dedupe_window": "x"}, {"runs": [1], "dedupe_window": [1]}):
+            response = await self.post("/runs/submit", {"instrument": "MARI", **body})
+            assert response.status_code == 400
+        response = await self.post("/runs/remove", {"instrument": "MARI", "first_run": 1, "last_run": 10**9})
+        assert response.status_code == 400 and "the most is" in response.json()["error"]
+        assert (await self.post("/runs/submit", [1])).status_code == 400
+        assert (await self.async_client.get("/jobs/unknown", **AUTHORIZATION)).status_code == 404
+
+    @patch("autoreduce_scripts.autoreduce_django.views.NonInteractiveRemove")
+    async def test_unauthenticated(self, mock_remove: Mock, mock_submit_run: Mock, *_):
+        """
+        Test that requests without the token, or with another one, are refused without doing anything
+        """
+        body = {"instrument": "MARI", "runs": [1234]}
+        for url in ("/runs/submit", "/runs/batch", "/runs/remove", "/jobs/unknown"):
+            response = await self.async_client.post(url, body, content_type="application/json")
+            assert response.status_code == 401
+            response = await self.async_client.post(url,
+                                                    body,
+                                                    content_type="application/json",
+                                                    authorization="Bearer wrong")
+            assert response.status_code == 401
+        with override_settings(API_TOKEN=""):
+            response = await self.async_client.post("/runs/remove",
+                                                    body,
+                                                    content_type="application/json",
+                                                    authorization="Bearer ")
+            assert response.status_code == 401
+        await asyncio.sleep(0.05)
+        mock_remove.assert_not_called()
+        mock_submit_run.assert_not_called()
+
+
+class JobStoreTest(JobStoreTestCase):
+    """
+    Test that the jobs are shared through the SQLite file
+    """
+
+    def test_save(self):
+        """
+        Test that another process sees the progress of a job, and the oldest jobs are forgotten
+        """
+        jobs = [Job("submit", total=2) for _ in range(3)]
+        for job in jobs:
+            self.jobs.save(job)
+        jobs[2].done = 1
+        jobs[2].results.append(1234)
+        self.jobs.save(jobs[2])
+
+        other_process = JobStore(Path(self.jobs_dir.name, "jobs.sqlite3"))
+        assert other_process.get(jobs[2].id) == jobs[2]
+        assert other_process.get(jobs[0].id) is None
+        other_process.connection.close()
+
+
+class LookupTest(TestCase):
+    """
+    Test that concurrent lookups of the same run share one call
+    """
+
+    @patch("autoreduce_scripts.autoreduce_django.views.get_run_data")
+    async def test_lookup(self, mock_get_run_data: Mock):
+        """
+        Test that a lookup in progress is shared, and a later lookup makes a new call
+        """
+        release = threading.Event()
+        mock_get_run_data.side_effect = lambda instrument, run_number: release.wait(5) and run_number
+
+        first = asyncio.ensure_future(lookup("MARI", 1234))
+        second = asyncio.ensure_future(lookup("MARI", 1234))
+        other = asyncio.ensure_future(lookup("MARI", 1235))
+        await asyncio.sleep(0.05)
+        release.set()
+
+        assert await asyncio.gather(first, second, other) == [1234, 1234, 1235]
+        assert mock_get_run_data.call_count == 2
+        assert await lookup("MARI", 1234) == 1234
+        assert mock_get_run_data.call_count == 3
@@ -13,5 +13,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.urls import path
 
-urlpatterns = []
+from autoreduce_scripts.autoreduce_django import views
+
+urlpatterns = [
+    path("runs/submit", views.submit),
+    path("runs/batch", views.batch_submit),
+    path("runs/remove", views.remove),
+    path("jobs/<str:job_id>", views.job_status),
+]
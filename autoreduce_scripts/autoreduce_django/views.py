@@ -0,0 +1,425 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Async HTTP API for submitting, batch submitting and removing runs, served through asgi.py.
+
+Every request must carry the token set in AUTOREDUCE_API_TOKEN, as "Authorization: Bearer <token>".
+If no token is set, every request is refused. As the token isn't sent by browsers on their own,
+the API doesn't need CSRF protection.
+
+POST /runs/submit
+    {"instrument": "MARI", "runs": [1234, 1235]}, or "first_run" and optionally "last_run" instead of "runs",
+    plus optionally software, reduction_script, reduction_arguments, user_id and description,
+    and dedupe_window and force as in manual_submission.main
+POST /runs/remove
+    {"instrument": "MARI", "first_run": 1234, "last_run": 1300, "delete_all_versions": true, "batch": false}
+POST /runs/batch
+    {"instrument": "MARI", "runs": [1234, 1235], ...} submits the runs with manual_batch_submit.main,
+    with optionally workers, max_batch_size and split_by, and responds with the submitted message,
+    or a summary of the parts if the batch was split
+GET /jobs/<id>
+    {"action": ..., "status": "running" or "done", "total": ..., "done": ..., "results": [...], "errors": [...]}
+
+A request can name at most MAX_RUNS runs. Submit and remove respond 202 with a job,
+{"id": ..., "url": "/jobs/<id>"}, and process the runs in the background. GET the job's URL for its progress.
+
+Progress is reported through the job rather than a streaming response, as Django before 4.2
+iterates streaming responses synchronously, which would block the event loop.
+
+The jobs are kept in a local SQLite file, so that any worker process of the ASGI server can report
+them. The work of a job is done by the worker that accepted it, and the workers must run on the
+same host, as they share the file.
+
+Concurrent submit requests for the same (instrument, run) share a single lookup of the run's data.
+The blocking work runs in threads, and the Kafka publisher and ICAT client are created once per process.
+The threads take turns to query ICAT with the shared client, see manual_submission.icat_client_lock.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache, wraps
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpRequest, JsonResponse
+
+from autoreduce_scripts.local_store import connect, default_path
+from autoreduce_scripts.manual_operations import manual_batch_submit, manual_submission
+from autoreduce_scripts.manual_operations.dedupe import RESOLUTIONS, PublicationLog
+from autoreduce_scripts.manual_operations.manual_remove import ManualRemove
+from autoreduce_scripts.manual_operations.util import get_run_range
+
+logger = logging.getLogger(__file__)
+
+# the oldest jobs are forgotten when there are more than this
+MAX_JOBS = 1000
+JOBS_PATH = default_path("api_jobs.sqlite3")
+# the most runs a single request can name
+MAX_RUNS = 10000
+# the number of runs of a request that are looked up at the same time
+MAX_CONCURRENT_LOOKUPS = 8
+SUBMIT_OPTIONS = ("software", "reduction_script", "reduction_arguments", "user_id", "description")
+BATCH_OPTIONS = SUBMIT_OPTIONS + ("workers", "max_batch_size", "split_by")
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    job TEXT NOT NULL
+);
+"""
+
+
+def require_token(view: Callable) -> Callable:
+    """
+    Refuses requests without the API token, see the module's docstring
+    """
+
+    @wraps(view)
+    async def authenticated_view(request: HttpRequest, *args, **kwargs):
+        expected = getattr(settings, "API_TOKEN", "")
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if not expected or scheme != "Bearer" or not hmac.compare_digest(token.encode(), expected.encode()):
+            return JsonResponse({"error": "Missing or invalid API token"}, status=401)
+        return await view(request, *args, **kwargs)
+
+    return authenticated_view
+
+
+def in_thread(func: Callable) -> Callable:
+    """Wraps a blocking function to be awaited from a thread, so that it doesn't block the event loop"""
+    return sync_to_async(func, thread_sensitive=False)
+
+
+@dataclass
+class Job:
+    """The progress of a request that is processed in the background"""
+    action: str
+    total: int
+    status: str = "running"
+    done: int = 0
+    results: list = field(default_factory=list)
+    errors: List[dict] = field(default_factory=list)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)  # pylint:disable=invalid-name
+
+    def to_dict(self) -> dict:
+        """The job as reported to the client"""
+        return {
+            "action": self.action,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "results": self.results,
+            "errors": self.errors,
+        }
+
+
+class JobStore:
+    """
+    Keeps the progress of the jobs in a local SQLite file shared by the worker processes.
+    The updates are small local transactions, so they are made on the event loop.
+    """
+
+    def __init__(self, path: Path = JOBS_PATH, max_jobs: int = MAX_JOBS):
+        """
+        Args:
+            path: The SQLite file holding the jobs
+            max_jobs: The number of jobs kept. The oldest are forgotten
+        """
+        self.max_jobs = max_jobs
+        self.connection = connect(path, JOBS_SCHEMA, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def save(self, job: Job):
+        """Records the job's progress, and forgets the oldest jobs when there are too many"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO jobs (id, created, job) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET job = excluded.job", (job.id, time.time(), json.dumps(asdict(job))))
+            self.connection.execute(
+                "DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY created DESC LIMIT ?)",
+                (self.max_jobs, ))
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Returns the job with the ID, or None if there is no such job"""
+        with self.lock:
+            row = self.connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id, )).fetchone()
+        return None if row is None else Job(**json.loads(row[0]))
+
+
+@lru_cache(maxsize=None)
+def get_jobs() -> JobStore:
+    """Returns the job store of the process, opening it on first use"""
+    return JobStore()
+
+
+# references to the running job tasks, so they aren't garbage collected before they finish
+RUNNING_TASKS = set()
+
+
+@lru_cache(maxsize=None)
+def get_publisher():
+    """Returns the Kafka publisher of the process, creating it on first use"""
+    return manual_submission.login_queue()
+
+
+@lru_cache(maxsize=None)
+def _get_icat_client():
+    return manual_submission.login_icat()
+
+
+def get_icat_client():
+    """
+    Returns the ICAT client of the process, logging in on first use.
+    If ICAT can't be reached, returns None so that the lookup logs in itself when it needs to.
+    """
+    try:
+        return _get_icat_client()
+    except RuntimeError:
+        logger.warning("Could not log into ICAT")
+        return None
+
+
+def get_run_data(instrument: str, run_number: int) -> Tuple[str, str, str]:
+    """Looks up the data location, RB number and title of the run"""
+    return manual_submission.get_run_data(instrument, run_number, "nxs", icat_client=get_icat_client())
+
+
+async def lookup(instrument: str, run_number: int) -> Tuple[str, str, str]:
+    """
+    Looks up the run in a thread, sharing the lookup with any concurrent requests for the same run,
+    and with the scripts running in the process, see dedupe.RESOLUTIONS
+    """
+    return await in_thread(RESOLUTIONS.resolve)((instrument, run_number), get_run_data, instrument, run_number)
+
+
+class NonInteractiveRemove(ManualRemove):
+    """
+    Removes runs without prompting, as there is nobody to answer
+    """
+
+    def multiple_versions_found(self, run_number):
+        raise RuntimeError(f"Found multiple versions of {self.instrument}{run_number}. "
+                           "Set delete_all_versions to remove all of them")
+
+
+def remove_run(instrument: str, run_number: int, delete_all_versions: bool, batch: bool) -> int:
+    """Removes the run, or the batch run with the primary key run_number if batch is set"""
+    manual_remove = NonInteractiveRemove(instrument)
+    if batch:
+        manual_remove.find_batch_run(run_number)
+    else:
+        manual_remove.find_run_versions_in_database(run_number)
+    manual_remove.process_results(delete_all_versions)
+    manual_remove.delete_records()
+    return run_number
+
+
+# pylint: disable=too-many-locals
+async def submit_runs(job: Job, instrument: str, runs: List[int], options: dict, dedupe_window: float = 0):
+    """
+    Looks up the runs concurrently and submits them in order.
+
+    Runs published with the same reduction arguments in the last `dedupe_window` seconds are skipped,
+    see PublicationLog. The claims are small local transactions, so they are made on the event loop.
+    The claims of the runs that weren't published are released, even if the job is cancelled.
+    """
+    arguments = options.get("reduction_arguments")
+    # runs that have been claimed in the publication log, but not published yet
+    unpublished = set()
+
+    with (PublicationLog(dedupe_window) if dedupe_window > 0 else nullcontext()) as publications:
+
+        def release(run_number):
+            unpublished.discard(run_number)
+            if publications is not None:
+                publications.release(instrument, run_number, arguments)
+
+        try:
+            claimed = []
+            already_submitted = f"Already submitted in the last {dedupe_window} seconds"
+            for run_number in runs:
+                if publications is None or publications.claim(instrument, run_number, arguments):
+                    claimed.append(run_number)
+                    unpublished.add(run_number)
+                else:
+                    job.errors.append({"run": run_number, "error": already_submitted})
+                    job.done += 1
+            get_jobs().save(job)
+
+            publisher = await in_thread(get_publisher)()
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_LOOKUPS)
+
+            async def bounded_lookup(run_number):
+                async with semaphore:
+                    return await lookup(instrument, run_number)
+
+            lookups = [asyncio.ensure_future(bounded_lookup(run_number)) for run_number in claimed]
+            for run_number, run_lookup in zip(claimed, lookups):
+                try:
+                    run_data = await run_lookup
+                    message = await in_thread(manual_submission.submit_resolved_run)(publisher, instrument, run_number,
+                                                                                     run_data, **options)
+                    if message is None:
+                        job.errors.append({"run": run_number, "error": "Unable to find or categorize the RB number"})
+                    else:
+                        job.results.append(run_number)
+                except Exception as err:  # pylint:disable=broad-except
+                    job.errors.append({"run": run_number, "error": str(err)})
+                    message = None
+                if message is None:
+                    release(run_number)
+                else:
+                    unpublished.discard(run_number)
+                job.done += 1
+                get_jobs().save(job)
+        finally:
+            for run_number in list(unpublished):
+                release(run_number)
+
+
+async def remove_runs(job: Job, instrument: str, runs: List[int], delete_all_versions: bool, batch: bool):
+    """
+    Removes the runs one after another
+    """
+    for run_number in runs:
+        try:
+            job.results.append(await in_thread(remove_run)(instrument, run_number, delete_all_versions, batch))
+        except Exception as err:  # pylint:disable=broad-except
+            job.errors.append({"run": run_number, "error": str(err)})
+        job.done += 1
+        get_jobs().save(job)
+
+
+def start_job(request: HttpRequest, action: str, runs: List[int], work) -> JsonResponse:
+    """
+    Runs the work for the job in the background and responds with where to find the job
+    """
+    job = Job(action, total=len(runs))
+    get_jobs().save(job)
+
+    async def run_job():
+        try:
+            await work(job)
+        finally:
+            job.status = "done"
+            get_jobs().save(job)
+
+    task = asyncio.ensure_future(run_job())
+    RUNNING_TASKS.add(task)
+    task.add_done_callback(RUNNING_TASKS.discard)
+    url = request.build_absolute_uri(f"/jobs/{job.id}")
+    return JsonResponse({"id": job.id, "url": url}, status=202)
+
+
+def parse_request(request: HttpRequest) -> Tuple[dict, str, List[int]]:
+    """
+    Parses the JSON body of the request
+
+    Returns:
+        The body, the upper case instrument name and the run numbers
+
+    Raises:
+        ValueError: If the body is not valid
+    """
+    if request.method != "POST":
+        raise ValueError("Expected a POST request")
+    body = json.loads(request.body)
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+    if "instrument" not in body:
+        raise ValueError("Missing the instrument")
+    if not isinstance(body["instrument"], str):
+        raise ValueError("The instrument must be a string")
+    try:
+        if "runs" in body:
+            runs = body["runs"] if isinstance(body["runs"], list) else [body["runs"]]
+        elif "first_run" in body:
+            runs = get_run_range(int(body["first_run"]), body.get("last_run") and int(body["last_run"]))
+        else:
+            raise ValueError("Missing the runs, or the first_run")
+        if len(runs) > MAX_RUNS:
+            raise ValueError(f"Cannot process {len(runs)} runs in one request, the most is {MAX_RUNS}")
+        runs = [int(run) for run in runs]
+    except TypeError as err:
+        raise ValueError(f"The runs must be integers: {err}") from err
+    return body, body["instrument"].upper(), runs
+
+
+def bad_request(err: Exception) -> JsonResponse:
+    """Responds with the reason why the request is not valid"""
+    return JsonResponse({"error": str(err)}, status=400)
+
+
+@require_token
+async def submit(request: HttpRequest) -> JsonResponse:
+    """Submits the runs for reduction in the background"""
+    try:
+        body, instrument, runs = parse_request(request)
+        dedupe_window = 0 if body.get("force") else float(body.get("dedupe_window", 0))
+    except (ValueError, TypeError) as err:
+        return bad_request(err)
+    options = {option: body[option] for option in SUBMIT_OPTIONS if option in body}
+    return start_job(request, "submit", runs, lambda job: submit_runs(job, instrument, runs, options, dedupe_window))
+
+
+@require_token
+async def remove(request: HttpRequest) -> JsonResponse:
+    """Removes the runs in the background"""
+    try:
+        body, instrument, runs = parse_request(request)
+    except ValueError as err:
+        return bad_request(err)
+    delete_all_versions, batch = bool(body.get("delete_all_versions")), bool(body.get("batch"))
+    return start_job(request, "remove", runs,
+                     lambda job: remove_runs(job, instrument, runs, delete_all_versions, batch))
+
+
+def batch_submit_runs(instrument: str, runs: List[int], options: dict) -> dict:
+    """Submits the runs with manual_batch_submit.main, using the process's publisher and ICAT client"""
+    return manual_batch_submit.main(instrument,
+                                    runs,
+                                    publisher=get_publisher(),
+                                    icat_client=get_icat_client(),
+                                    **options)
+
+
+@require_token
+async def batch_submit(request: HttpRequest) -> JsonResponse:
+    """
+    Submits the runs as a single reduction, or several if the batch is split,
+    and responds with the submitted message or the summary of the parts
+    """
+    try:
+        body, instrument, runs = parse_request(request)
+    except ValueError as err:
+        return bad_request(err)
+
+    options = {option: body[option] for option in BATCH_OPTIONS if option in body}
+    try:
+        message = await in_thread(batch_submit_runs)(instrument, runs, options)
+    except (ValueError, RuntimeError) as err:
+        # the runs could not be found, their RB numbers don't match, or the batch can't be split as asked
+        return bad_request(err)
+    return JsonResponse(message)
+
+
+@require_token
+async def job_status(_: HttpRequest, job_id: str) -> JsonResponse:
+    """Responds with the progress of the job"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return JsonResponse({"error": f"No job with ID {job_id}"}, status=404)
+    return JsonResponse(job.to_dict())
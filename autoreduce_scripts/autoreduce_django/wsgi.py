@@ -11,6 +11,6 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'autoreduce_django.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'autoreduce_scripts.autoreduce_django.settings')
 
 application = get_wsgi_application()
@@ -8,7 +8,10 @@
 This script is expected to be called by a cronjob daily.
 
 It will traverse all instrument folders in the archive (all NDX... folders),
-grab reduce.py and reduce_vars.py and upload it to the repository.
+grab the files in their autoreduction directory that match the --pattern glob patterns
+(by default all Python files, i.e. reduce.py, reduce_vars.py and any helper modules)
+and upload them to the repository. Files larger than --max-size bytes, or that are
+not text, are skipped.
 
 The repository of the STORAGE_DIR needs to be manually configured to point to the correct
 remote - otherwise this script will fail to commit/push.
@@ -16,6 +19,17 @@ remote - otherwise this script will fail to commit/push.
 There is also a --dry-run option that will just show which files are traversed,
 but will not do anything.
 
+The instrument directories are scanned and the files copied by a bounded pool of threads,
+and each scan or copy is given up on after --timeout seconds, so that a single hung
+instrument share does not hold up the whole backup. A copy that has been given up on
+never replaces the file in STORAGE_DIR, even if it finishes later. The script still waits
+for hung calls to return before it exits, after the backup has been pushed.
+
+A manifest of the size, modification time and content hash of every file is kept between runs.
+Files whose size and modification time have not changed are skipped without being read,
+and that includes the files that were skipped before because they are not text.
+Only files whose content changed are committed. If nothing changed there is no commit or push at all.
+
 The cronjob should be:
 
 0 1 * * * python3 /home/reduce/backup_reduction_scripts.py
@@ -28,35 +42,278 @@ import os
 import sys
 import argparse
 import datetime
+import fnmatch
+import hashlib
+import json
 import shutil
+import threading
+import time
 import traceback
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from git import Git, exc
+from git import Repo, exc
 
 # this calls the configuration of the logger which is done in the settings module
 from autoreduce_utils.settings import logging
 
+from autoreduce_scripts.local_store import default_path
+
 ISIS_MOUNT_PATH = Path("/isis")
 AUTOREDUCTION_PATH = Path("user/scripts/autoreduction")
-REDUCE_FILES_TO_SAVE = ["reduce.py", "reduce_vars.py"]
+# glob patterns of the files backed up from each instrument's autoreduction directory
+REDUCE_FILE_PATTERNS = ["*.py"]
+# files larger than this many bytes are not backed up
+MAX_FILE_SIZE = 1024 * 1024
 
 # STORAGE_DIR is the git repository dir that has been configured to point to the correct remote
 STORAGE_DIR = Path("~/autoreduction_scripts").expanduser().absolute()
+# kept outside of STORAGE_DIR so that it is not committed
+MANIFEST_PATH = default_path("backup_manifest.json")
 
 log = logging.getLogger(__file__)
 
 
+def file_hash(path: Path) -> str:
+    """
+    Returns the SHA256 hash of the file's contents
+    """
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def load_manifest(path: Path) -> Dict[str, dict]:
+    """
+    Loads the manifest of backed up files. If it doesn't exist yet the manifest is empty.
+
+    :param path: The path to the manifest file
+    """
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path: Path, manifest: Dict[str, dict]):
+    """
+    Saves the manifest of backed up files
+
+    :param path: The path to the manifest file
+    :param manifest: The manifest, keyed by source path
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+
+
+def is_text(path: Path) -> bool:
+    """
+    Returns whether the file looks like text, i.e. there are no null bytes at its start
+    """
+    with open(path, "rb") as file:
+        return b"\0" not in file.read(8192)
+
+
+class TimedJob(ABC):
+    """
+    Work done in a thread of `run_jobs`, which is given up on if it takes too long.
+    """
+
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.abandoned = False
+        # held while the job makes its result visible, so that it can't be abandoned half way through
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Does the work, recording when it started and any error reading or writing files"""
+        self.started_at = time.monotonic()
+        try:
+            self.work()
+        except OSError as err:
+            self.error = f"{err}.\n\n {traceback.format_exc()}"
+
+    def abandon(self):
+        """Marks the job as given up on. It must not make any changes after this"""
+        with self.lock:
+            self.abandoned = True
+
+    @abstractmethod
+    def work(self):
+        """The work done by the job"""
+
+
+def run_jobs(jobs: List[TimedJob], workers: int, timeout: float) -> Tuple[List[TimedJob], List[TimedJob]]:
+    """
+    Runs the jobs in a pool of `workers` threads.
+
+    A job that has not finished `timeout` seconds after it started is abandoned. It keeps its thread
+    until it returns, so if every thread is held by an abandoned job, the jobs that haven't started
+    are given up on too.
+
+    :param jobs: The jobs to run
+    :param workers: The number of threads running jobs
+    :param timeout: The number of seconds after which a job is abandoned
+    :return: The jobs that finished, and the jobs that timed out or never started
+    """
+    executor = ThreadPoolExecutor(workers)
+    futures: Dict[Future, TimedJob] = {executor.submit(job.run): job for job in jobs}
+    running = set(futures)
+    hung = set()
+    finished, timed_out = [], []
+    try:
+        while running:
+            deadlines = [job.started_at + timeout for job in map(futures.get, running) if job.started_at is not None]
+            wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else timeout
+            done, _ = wait(running | hung, timeout=wait_for, return_when=FIRST_COMPLETED)
+            hung -= done
+            now = time.monotonic()
+            for future in list(running):
+                job = futures[future]
+                if future.done():
+                    future.result()
+                    running.remove(future)
+                    finished.append(job)
+                elif job.started_at is not None and now - job.started_at > timeout:
+                    job.abandon()
+                    running.remove(future)
+                    hung.add(future)
+                    timed_out.append(job)
+            if len(hung) >= workers:
+                for future in [future for future in running if future.cancel()]:
+                    running.remove(future)
+                    timed_out.append(futures[future])
+    finally:
+        executor.shutdown(wait=False)
+    return finished, timed_out
+
+
+class ScanJob(TimedJob):
+    """
+    Finds the files to back up in an instrument's autoreduction directory
+    """
+
+    def __init__(self, directory: Path, patterns: List[str], max_size: int):
+        super().__init__()
+        self.directory = directory
+        self.patterns = patterns
+        self.max_size = max_size
+        self.files: List[Path] = []
+
+    def work(self):
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            # not every instrument has an autoreduction directory
+            return
+        for entry in entries:
+            if not entry.is_file() or not any(fnmatch.fnmatch(entry.name, pattern) for pattern in self.patterns):
+                continue
+            if entry.stat().st_size > self.max_size:
+                log.warning("Skipping %s as it is larger than %s bytes", entry.path, self.max_size)
+                continue
+            self.files.append(Path(entry.path))
+
+
+def scan_reduction_files(mount_path: Path, patterns: List[str], max_size: int, workers: int,
+                         timeout: float) -> Tuple[List[Path], List[Path]]:
+    """
+    Finds the files to back up in the autoreduction directory of every NDX instrument folder,
+    scanning the instrument folders in parallel.
+
+    :param mount_path: The path the archive is mounted at
+    :param patterns: Glob patterns of the file names to back up
+    :param max_size: Files larger than this many bytes are skipped
+    :param workers: The maximum number of directories scanned at the same time
+    :param timeout: The number of seconds after which a directory scan is abandoned
+    :return: The paths of the files to back up, and the directories that timed out or could not be scanned
+    """
+    with os.scandir(mount_path) as entries:
+        directories = [Path(entry.path) / AUTOREDUCTION_PATH for entry in entries if entry.name.startswith("NDX")]
+
+    finished, timed_out = run_jobs([ScanJob(directory, patterns, max_size) for directory in directories], workers,
+                                   timeout)
+    for job in timed_out:
+        log.error("Timed out scanning %s after %s seconds", job.directory, timeout)
+    for job in finished:
+        if job.error:
+            log.error("Could not scan %s. Error: %s", job.directory, job.error)
+    unscanned = [job.directory for job in timed_out] + [job.directory for job in finished if job.error]
+    return sorted(file for job in finished for file in job.files), unscanned
+
+
+def find_reduction_files(mount_path: Path, patterns: List[str], max_size: int, workers: int,
+                         timeout: float) -> List[Path]:
+    """
+    Finds the files to back up, see scan_reduction_files. Directories that could not be scanned are logged and skipped.
+
+    :return: The paths of the files to back up
+    """
+    return scan_reduction_files(mount_path, patterns, max_size, workers, timeout)[0]
+
+
+class CopyJob(TimedJob):
+    """
+    Copies a single file.
+
+    The copy is skipped if the source's size and modification time match its manifest entry,
+    or if the source is not a text file. Files that are not text are recorded in the manifest
+    without a hash, so that they aren't read again until they change. The target is only replaced
+    if the job hasn't been abandoned by then.
+    """
+
+    def __init__(self, source: Path, destination: Path, entry: Optional[dict]):
+        super().__init__()
+        self.source = source
+        self.destination = destination
+        self.entry = entry
+        self.changed = False
+
+    def matches_manifest(self, stat: os.stat_result) -> bool:
+        """
+        Returns whether the source has the same size and modification time as in the manifest
+        """
+        return bool(self.entry) and (self.entry["size"], self.entry["mtime"]) == (stat.st_size, stat.st_mtime_ns)
+
+    def work(self):
+        target = self.destination / self.source.name
+        stat = self.source.stat()
+        if self.matches_manifest(stat) and (self.entry["sha256"] is None or target.exists()):
+            return
+        if not is_text(self.source):
+            log.warning("Skipping %s as it is not a text file", self.source)
+            self.entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": None}
+            return
+
+        # copied next to the target first, so that a copy abandoned half way never replaces it
+        partial = self.destination / f".{self.source.name}.{uuid.uuid4().hex}.partial"
+        try:
+            shutil.copy(self.source, partial, follow_symlinks=True)
+            # the hash is read from the local copy, not from the network mount
+            content_hash = file_hash(partial)
+            with self.lock:
+                if self.abandoned:
+                    return
+                os.replace(partial, target)
+        finally:
+            partial.unlink(missing_ok=True)
+
+        self.changed = not self.entry or self.entry["sha256"] != content_hash
+        self.entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": content_hash}
+
+
 def check_if_git_directory(path: Path):
     """
     Ensures that the directory is a git repo.
 
+    Only the repository's git directory is read, the work tree is not walked.
     If it is not the function will raise
 
     :param path: The path to the directory
     """
-    repo = Git(path.absolute())
-    repo.status()
+    Repo(path.absolute())
 
 
 def ensure_storage_exists(path: Path):
@@ -80,55 +337,102 @@ def get_today() -> str:
     return str(datetime.date.today())
 
 
-def commit_and_push(path: Path):
+def commit_and_push(path: Path, changed: List[Path]):
     """
-    Commits all files in the path directory and pushes to origin/master
+    Commits the changed files in the path directory and pushes to origin/master
+
+    The blobs, tree and commit are written directly to the repository's object database
+    from the list of changed files, so the time taken depends on what changed and not on
+    the size of the work tree or history. Only the push runs the git executable.
 
     :param path: The path to the directory
+    :param changed: The files that have changed
+    :raises RuntimeError: If the push failed or was rejected, e.g. because it isn't a fast-forward
     """
-    repo = Git(path.absolute())
+    repo = Repo(path.absolute())
     today = get_today()
-    repo.add(".")
-    repo.commit("-m", f"Reduction files for {today}")
-    repo.push("--set-upstream", "origin", "master")
+    repo.index.add([str(file.relative_to(path)) for file in changed])
+    repo.index.commit(f"Reduction files for {today}")
+    results = repo.remote("origin").push("master", set_upstream=True)
+    errors = [
+        result.summary for result in results if result.flags & (result.ERROR | result.REJECTED | result.REMOTE_REJECTED)
+    ]
+    if errors:
+        raise RuntimeError(f"Could not push the reduction files: {errors}")
+
+
+def copy_files(copies: List[Tuple[Path, Path]], manifest: Dict[str, dict], workers: int,
+               timeout: float) -> Tuple[List[Path], List[Tuple[Path, str]]]:
+    """
+    Copies the files with at most `workers` copies running at the same time.
+
+    :param copies: Pairs of source file and destination directory
+    :param manifest: The manifest from the last backup. It is updated with the files that were copied
+    :param workers: The maximum number of copies running at the same time
+    :param timeout: The number of seconds after which a copy is abandoned and counted as failed
+    :return: The copied files whose content changed, and the source and error message of each copy that failed
+    """
+    jobs = [CopyJob(source, destination, manifest.get(str(source))) for source, destination in copies]
+    finished, timed_out = run_jobs(jobs, workers, timeout)
+
+    changed, failures = [], []
+    for job in finished:
+        if job.error:
+            failures.append((job.source, job.error))
+            continue
+        if job.entry:
+            manifest[str(job.source)] = job.entry
+        if job.changed:
+            changed.append(job.destination / job.source.name)
+    failures += [(job.source, f"Timed out after {timeout} seconds") for job in timed_out]
+    return changed, failures
 
 
 def main(args):
     """
     Ensures expected directories exist. Then queries the ISIS_MOUNT_PATH for all folders
-    starting with NDX, and iterates through each one checking if they contain a
-    reduce.py and reduce_vars.py in the expected AUTOREDUCTION_PATH.
+    starting with NDX, and scans each one for files matching the patterns in the
+    expected AUTOREDUCTION_PATH.
 
-    If the expected python files are found they are copied to STORAGE_DIR
-    and later committed and pushed to the storage repository.
+    If matching files are found they are copied to STORAGE_DIR
+    and later committed and pushed to the storage repository, if any of them changed.
     """
     ensure_storage_exists(STORAGE_DIR)
 
     try:
         check_if_git_directory(STORAGE_DIR)
-    except exc.GitCommandError as err:  # pylint: disable=no-member
+    except (exc.InvalidGitRepositoryError, exc.NoSuchPathError) as err:  # pylint: disable=no-member
         log.error(
             "Destination folder %s is not a Git repository. "
             "Please configure it manually before running this script."
             "Error %s", str(STORAGE_DIR), err)
         sys.exit(1)
 
-    for inst in [directory for directory in os.listdir(ISIS_MOUNT_PATH) if directory.startswith("NDX")]:
-        path = ISIS_MOUNT_PATH / inst / AUTOREDUCTION_PATH
-        destination = STORAGE_DIR / inst / AUTOREDUCTION_PATH
-
+    copies = []
+    for fullpath in find_reduction_files(ISIS_MOUNT_PATH, args.patterns or REDUCE_FILE_PATTERNS, args.max_size,
+                                         args.workers, args.timeout):
+        destination = STORAGE_DIR / fullpath.parent.relative_to(ISIS_MOUNT_PATH)
         ensure_storage_exists(destination)
+        log.info("Copying %s to %s", fullpath, destination)
+        copies.append((fullpath, destination))
 
-        for file in REDUCE_FILES_TO_SAVE:
-            fullpath = path / file
-            log.info("Copying %s to %s", fullpath, destination)
-            if not args.dry_run:
-                try:
-                    shutil.copy(fullpath, destination, follow_symlinks=True)
-                except OSError as err:
-                    log.error("Could not copy last entry. Error: %s.\n\n %s", str(err), traceback.format_exc())
     if not args.dry_run:
-        commit_and_push(STORAGE_DIR)
+        manifest = load_manifest(MANIFEST_PATH)
+        changed, failures = copy_files(copies, manifest, args.workers, args.timeout)
+        for source, error in failures:
+            log.error("Could not copy %s. Error: %s", source, error)
+        if failures:
+            log.error("Failed to copy %s of %s files", len(failures), len(copies))
+
+        if not changed:
+            log.info("No reduction files have changed, nothing to commit")
+            # still saved to record new modification times of files whose content is the same
+            save_manifest(MANIFEST_PATH, manifest)
+            return
+        log.info("%s reduction files have changed", len(changed))
+        commit_and_push(STORAGE_DIR, changed)
+        # only saved once the changes are pushed, otherwise they would be skipped by the next backup
+        save_manifest(MANIFEST_PATH, manifest)
 
 
 if __name__ == '__main__':
@@ -136,6 +440,23 @@ if __name__ == '__main__':
     parser.add_argument("--dry-run",
                         action="store_true",
                         help="Dry run and display all files that will be copied and to where. But do nothing!")
+    parser.add_argument("--pattern",
+                        action="append",
+                        dest="patterns",
+                        help=f"Glob pattern of the files to back up. Can be given multiple times. "
+                        f"Defaults to {REDUCE_FILE_PATTERNS}")
+    parser.add_argument("--max-size",
+                        type=int,
+                        default=MAX_FILE_SIZE,
+                        help="Files larger than this many bytes are not backed up")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=8,
+                        help="Number of directories to scan or files to copy at the same time")
+    parser.add_argument("--timeout",
+                        type=float,
+                        default=120,
+                        help="Number of seconds after which scanning a directory or copying a file is given up on")
 
     _args = parser.parse_args()
 
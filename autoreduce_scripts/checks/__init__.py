@@ -5,19 +5,20 @@
 # SPDX - License - Identifier: GPL-3.0-or-later
 # ############################################################################### #
 
-import django
-from django.conf import settings
-from autoreduce_scripts.autoreduce_django.settings import DATABASES, INSTALLED_APPS
+# pylint:disable=import-outside-toplevel
 
 
-def setup_django():
+def setup_django(worker_mode: bool = False):
     """
     Sets up django if not configured already. This allows accessing the models through the ORM
+
+    Args:
+        worker_mode: Keep DB connections open for the life of the process, for long running services
     """
+    import django
+    from django.conf import settings
+    from autoreduce_scripts.autoreduce_django.settings import INSTALLED_APPS, database_settings
 
     if not settings.configured:
-        settings.configure(DATABASES=DATABASES, INSTALLED_APPS=INSTALLED_APPS, USE_TZ=True)
+        settings.configure(DATABASES=database_settings(worker_mode), INSTALLED_APPS=INSTALLED_APPS, USE_TZ=True)
         django.setup()
-
-
-setup_django()
@@ -0,0 +1,103 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.utils import timezone
+
+from autoreduce_scripts.checks import setup_django  # pylint:disable=wrong-import-order,ungrouped-imports
+from autoreduce_db.reduction_viewer.models import Instrument, ReductionRun, Status
+from autoreduce_scripts.checks.daily.throughput import main, window_statistics
+
+# pylint:disable=no-member
+
+setup_django()
+
+
+def make_runs(count: int, created, duration: timedelta, status=None):
+    """
+    Copies the first fixture run `count` times, with the given creation time and duration
+    """
+    template = ReductionRun.objects.get(pk=1)
+    for _ in range(count):
+        template.pk = None
+        template.status = status or Status.get_completed()
+        template.save()
+        # created is auto_now_add, so it can only be overwritten with an update
+        ReductionRun.objects.filter(pk=template.pk).update(created=created, finished=created + duration)
+
+
+class ThroughputTest(TestCase):
+    """
+    Test the throughput and backlog statistics
+    """
+    fixtures = ["status_fixture", "multiple_instruments_and_runs"]
+
+    def test_window_statistics(self):
+        """
+        Test the counts, mean and 95th percentile of runs in a window
+        """
+        now = timezone.now()
+        make_runs(19, now - timedelta(minutes=30), timedelta(minutes=1))
+        make_runs(1, now - timedelta(minutes=30), timedelta(minutes=10))
+
+        stats = window_statistics(now - timedelta(hours=1), now)["TESTINSTRUMENT"]["c"]
+        assert stats["created"] == 20
+        assert stats["finished"] == 20
+        assert stats["mean_duration"] == timedelta(seconds=(19 * 60 + 600) / 20)
+        assert stats["p95_duration"] == timedelta(minutes=1)
+
+    def test_window_statistics_excludes_old_runs(self):
+        """
+        Test that the fixture runs from 2020 are not counted in a recent window
+        """
+        now = timezone.now()
+        assert not window_statistics(now - timedelta(hours=1), now)
+
+    @patch("autoreduce_scripts.checks.daily.throughput.logging")
+    def test_throughput_drop(self, mock_logging):
+        """
+        Test that a drop in finished runs compared to the previous window is warned about
+        """
+        make_runs(10, timezone.now() - timedelta(minutes=90), timedelta(minutes=1))
+        make_runs(1, timezone.now() - timedelta(minutes=30), timedelta(minutes=1))
+        main(windows=[1])
+        mock_logging.getLogger.return_value.warning.assert_called_once()
+
+    @patch("autoreduce_scripts.checks.daily.throughput.logging")
+    def test_steady_throughput(self, mock_logging):
+        """
+        Test that steady throughput does not cause a warning
+        """
+        make_runs(10, timezone.now() - timedelta(minutes=90), timedelta(minutes=1))
+        make_runs(10, timezone.now() - timedelta(minutes=30), timedelta(minutes=1))
+        main(windows=[1])
+        mock_logging.getLogger.return_value.warning.assert_not_called()
+
+    @patch("autoreduce_scripts.checks.daily.throughput.logging")
+    def test_backlog(self, mock_logging):
+        """
+        Test that a backlog over the threshold is warned about, unless the instrument is paused
+        """
+        make_runs(3, timezone.now(), timedelta(0), status=Status.get_queued())
+        main(windows=[1], max_backlog=2)
+        mock_logging.getLogger.return_value.warning.assert_called_once()
+
+        mock_logging.reset_mock()
+        Instrument.objects.filter(name="TESTINSTRUMENT").update(is_paused=True)
+        main(windows=[1], max_backlog=2)
+        mock_logging.getLogger.return_value.warning.assert_not_called()
+
+    def test_single_window(self):
+        """
+        Test that a single window can be given as a number, as the CLI does for --windows=1
+        """
+        make_runs(1, timezone.now() - timedelta(minutes=30), timedelta(minutes=1))
+        stats = main(windows=1)
+        assert list(stats) == [1]
+        assert stats[1]["TESTINSTRUMENT"]["c"]["finished"] == 1
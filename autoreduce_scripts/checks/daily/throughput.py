@@ -0,0 +1,175 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Checks the reduction throughput and queue backlog for each instrument.
+
+For every rolling window it computes, per instrument and status, how many runs were created,
+how many finished, and the mean and 95th percentile of ``finished - created``. All of the
+aggregation is done by the database.
+
+It logs a warning if the number of finished runs has dropped compared to the previous window,
+or if the number of queued and processing runs has grown past the configured threshold.
+"""
+import logging
+import math
+import os
+from datetime import timedelta
+from typing import Dict, Iterable, Optional, Union
+
+import fire
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, QuerySet
+from django.utils import timezone
+
+from autoreduce_scripts.checks import setup_django  # setup_django first or importing the model fails
+
+setup_django()
+
+# pylint:disable=wrong-import-position,wrong-import-order
+from autoreduce_db.reduction_viewer.models import Instrument, ReductionRun, Status
+
+# pylint:disable=no-member
+
+DURATION = ExpressionWrapper(F("finished") - F("created"), output_field=DurationField())
+
+
+def percentile_duration(runs: QuerySet, count: int, percentile: float) -> Optional[timedelta]:
+    """
+    Finds the duration at the given percentile by letting the database sort the runs and
+    return the single row at the percentile's rank.
+
+    Args:
+        runs: The finished runs, annotated with their duration
+        count: The number of runs in the queryset, already known from the aggregation
+        percentile: The percentile to find, between 0 and 100
+
+    Returns:
+        The duration at the percentile, or None if there are no runs
+    """
+    if count == 0:
+        return None
+    rank = max(math.ceil(percentile / 100 * count) - 1, 0)
+    return runs.order_by("duration").values_list("duration", flat=True)[rank]
+
+
+def window_statistics(start, end) -> Dict[str, Dict[str, dict]]:
+    """
+    Computes the throughput statistics of the runs in the window between start and end.
+
+    Args:
+        start: The start of the window
+        end: The end of the window
+
+    Returns:
+        Statistics keyed by instrument name and then status value
+    """
+    stats = {}
+
+    def group(instrument: str, status: str) -> dict:
+        return stats.setdefault(instrument, {}).setdefault(status, {
+            "created": 0,
+            "finished": 0,
+            "mean_duration": None,
+            "p95_duration": None
+        })
+
+    created = ReductionRun.objects.filter(created__gte=start, created__lt=end)
+    for row in created.values("instrument__name", "status__value").annotate(count=Count("id")):
+        group(row["instrument__name"], row["status__value"])["created"] = row["count"]
+
+    finished = ReductionRun.objects.filter(finished__gte=start, finished__lt=end).annotate(duration=DURATION)
+    for row in finished.values("instrument__name", "status__value").annotate(count=Count("id"), mean=Avg("duration")):
+        instrument, status = row["instrument__name"], row["status__value"]
+        stat = group(instrument, status)
+        stat["finished"] = row["count"]
+        stat["mean_duration"] = row["mean"]
+        stat["p95_duration"] = percentile_duration(finished.filter(instrument__name=instrument, status__value=status),
+                                                   row["count"], 95)
+    return stats
+
+
+def backlog() -> Dict[str, int]:
+    """
+    Returns the number of queued and processing runs for each instrument
+    """
+    pending = ReductionRun.objects.filter(status__in=[Status.get_queued(), Status.get_processing()])
+    return {
+        row["instrument__name"]: row["count"]
+        for row in pending.values("instrument__name").annotate(count=Count("id"))
+    }
+
+
+def total_finished(stats: Dict[str, dict]) -> int:
+    """Returns the number of finished runs across all statuses of an instrument's window statistics"""
+    return sum(stat["finished"] for stat in stats.values())
+
+
+# pylint: disable=too-many-locals
+def main(windows: Union[float, Iterable[float]] = (1, 24),
+         max_backlog: int = 50,
+         min_throughput_ratio: float = 0.5,
+         min_runs_for_comparison: int = 10) -> Dict[float, Dict[str, Dict[str, dict]]]:
+    """
+    Computes the throughput statistics over each rolling window and warns about drops in throughput
+    or a growing backlog.
+
+    Paused instruments are not warned about, as we are not processing runs for them.
+
+    The log file should then be sent to Kibana where we have alerts.
+
+    Args:
+        windows: The lengths of the rolling windows, in hours. A single window can be given on its own,
+                 as Fire passes e.g. --windows=1 as a number
+        max_backlog: Warn if an instrument has more queued and processing runs than this
+        min_throughput_ratio: Warn if the number of finished runs in a window is less than this
+                              fraction of the number in the window before it
+        min_runs_for_comparison: Only compare throughput when the previous window has at least this many finished runs
+
+    Returns:
+        The statistics, keyed by window length, instrument name and then status value
+    """
+    setup_django()
+    logger = logging.getLogger(os.path.basename(__file__))
+    now = timezone.now()
+    paused = set(Instrument.objects.filter(is_paused=True).values_list("name", flat=True))
+    if isinstance(windows, (int, float)):
+        windows = (windows, )
+
+    all_stats = {}
+    for hours in windows:
+        window = timedelta(hours=hours)
+        current = window_statistics(now - window, now)
+        previous = window_statistics(now - 2 * window, now - window)
+        all_stats[hours] = current
+
+        for instrument, stats in current.items():
+            for status, stat in stats.items():
+                logger.info("%s %s over the last %sh: %s", instrument, status, hours, stat)
+
+        for instrument, stats in previous.items():
+            if instrument in paused:
+                continue
+            before = total_finished(stats)
+            after = total_finished(current.get(instrument, {}))
+            if before >= min_runs_for_comparison and after < before * min_throughput_ratio:
+                logger.warning("Instrument %s finished %s runs in the last %sh, down from %s in the %sh before",
+                               instrument, after, hours, before, hours)
+
+    for instrument, pending in backlog().items():
+        if instrument not in paused and pending > max_backlog:
+            logger.warning("Instrument %s has a backlog of %s queued and processing runs", instrument, pending)
+    return all_stats
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire.Fire(main)  # pragma: no cover
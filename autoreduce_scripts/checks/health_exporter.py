@@ -0,0 +1,287 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Exports health metrics for every instrument from a single process.
+
+The individual checks each set up Django, query the database and exit. This exporter
+computes all of the metrics in one pass with a handful of shared queries, and serves them
+over a small local HTTP endpoint in Prometheus text format (``/metrics``) or JSON
+(``/metrics.json``). Results are cached for ``ttl`` seconds so frequent scrapes stay cheap.
+"""
+import json
+import logging
+import os
+import statistics
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import fire
+from django.db import connection
+from django.db.models import F, Max, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from autoreduce_scripts.checks import setup_django  # setup_django first or importing the model fails
+
+setup_django()
+
+# pylint:disable=wrong-import-position,wrong-import-order,ungrouped-imports
+from autoreduce_db.reduction_viewer.models import Instrument, ReductionRun, Status
+from autoreduce_scripts.autoreduce_django.connections import refresh_connections
+from autoreduce_scripts.checks.daily.time_since_last_run import BASE_INSTRUMENT_LASTRUNS_TXT_DIR
+from autoreduce_scripts.checks.snapshot import StatisticsSnapshot
+
+# pylint:disable=no-member
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+METRIC_PREFIX = "autoreduce"
+STATUS_NAMES = {value: verbose.lower() for value, verbose in Status.STATUS_CHOICES}
+
+
+class TTLCache:
+    """
+    Caches the result of a function call for a number of seconds.
+    """
+
+    def __init__(self, func: Callable, ttl: float):
+        """
+        Args:
+            func: The function whose result is cached. Called without arguments.
+            ttl: Number of seconds for which a result is reused
+        """
+        self.func = func
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.0
+
+    def get(self):
+        """
+        Returns the cached value, recomputing it if it has expired.
+        """
+        now = time.monotonic()
+        if now >= self._expires_at:
+            self._value = self.func()
+            self._expires_at = now + self.ttl
+        return self._value
+
+
+def read_lastrun_txt(instrument: str) -> Optional[int]:
+    """
+    Reads the last run number that the instrument has recorded in its lastrun.txt
+
+    Args:
+        instrument: The name of the instrument
+
+    Returns:
+        The run number, or None if the file is missing or cannot be parsed
+    """
+    last_runs_txt_file = Path(BASE_INSTRUMENT_LASTRUNS_TXT_DIR.format(instrument), "lastrun.txt")
+    try:
+        return int(last_runs_txt_file.read_text(encoding="utf-8").split()[1])
+    except (OSError, IndexError, ValueError):
+        logger.warning("Could not read the last run number from %s", last_runs_txt_file)
+        return None
+
+
+def median_durations(instrument_ids, last_n: int) -> Dict[int, Optional[float]]:
+    """
+    Computes the median reduction duration over the last N finished runs of each instrument.
+
+    Runs that never recorded a start time are measured from their creation. The last N runs of
+    every instrument are fetched in one query, numbering the runs of each instrument with a window
+    function. Django can't filter on a window until 4.2, so the query is wrapped in a subquery.
+
+    Args:
+        instrument_ids: The IDs of the instruments to compute the median for
+        last_n: How many of the most recent finished runs to consider
+
+    Returns:
+        Mapping of instrument ID to the median duration in seconds, or None if there are no finished runs
+    """
+    durations: Dict[int, list] = {instrument_id: [] for instrument_id in instrument_ids}
+    if not durations:
+        return {}
+    recency = Window(RowNumber(), partition_by=[F("instrument_id")], order_by=F("finished").desc())
+    ranked = ReductionRun.objects.filter(instrument_id__in=durations, finished__isnull=False) \
+        .annotate(recency=recency) \
+        .values_list("instrument_id", "created", "started", "finished", "recency")
+    sql, params = ranked.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM ({sql}) ranked WHERE ranked.{connection.ops.quote_name('recency')} <= %s",
+                       (*params, last_n))
+        for instrument_id, created, started, finished, _ in cursor.fetchall():
+            durations[instrument_id].append((finished - (started or created)).total_seconds())
+    return {instrument_id: statistics.median(times) if times else None for instrument_id, times in durations.items()}
+
+
+def collect_metrics(snapshot: StatisticsSnapshot, last_n: int = 50) -> dict:
+    """
+    Computes the health metrics for all instruments.
+
+    The run counts come from the incremental snapshot, and the last run details for every
+    instrument from one grouped query, rather than one set of queries per metric per instrument.
+
+    Args:
+        snapshot: The snapshot that keeps the run counts by status
+        last_n: How many of the most recent finished runs to use for the median reduction duration
+
+    Returns:
+        A dictionary with the metrics of every instrument, keyed by instrument name
+    """
+    refresh_connections()
+    now = timezone.now()
+    instruments = list(Instrument.objects.all())
+
+    totals = snapshot.update()
+    counts = {
+        instrument.id: {name: totals.get((instrument.name, value), 0)
+                        for value, name in STATUS_NAMES.items()}
+        for instrument in instruments
+    }
+
+    # don't use batch runs to check when the last run was
+    last_runs = {
+        row["instrument_id"]: row
+        for row in ReductionRun.objects.filter(batch_run=False).values("instrument_id").annotate(
+            last_created=Max("created"), last_run_number=Max("run_numbers__run_number"))
+    }
+    medians = median_durations([instrument.id for instrument in instruments], last_n)
+
+    metrics = {}
+    for instrument in instruments:
+        last_run = last_runs.get(instrument.id, {})
+        last_created = last_run.get("last_created")
+        last_run_number = last_run.get("last_run_number")
+        lastrun_txt = read_lastrun_txt(instrument.name)
+
+        metrics[instrument.name] = {
+            "paused": instrument.is_paused,
+            "last_run_age_seconds": (now - last_created).total_seconds() if last_created else None,
+            "lastrun_txt_lag": lastrun_txt - last_run_number if None not in (lastrun_txt, last_run_number) else None,
+            "runs_by_status": counts[instrument.id],
+            "median_reduction_duration_seconds": medians[instrument.id],
+        }
+    return {"generated_at": now.isoformat(), "instruments": metrics}
+
+
+def to_json(metrics: dict) -> str:
+    """Formats the metrics as JSON"""
+    return json.dumps(metrics, indent=1)
+
+
+def to_prometheus(metrics: dict) -> str:
+    """
+    Formats the metrics in the Prometheus text exposition format.
+
+    Metrics that could not be computed for an instrument (e.g. it has no runs) are left out.
+    """
+    gauges = {
+        "paused": "Whether the instrument is paused",
+        "last_run_age_seconds": "Seconds since the last non-batch run was created",
+        "lastrun_txt_lag": "Run number in lastrun.txt minus the last run number known to autoreduction",
+        "median_reduction_duration_seconds": "Median reduction duration of the most recent finished runs",
+    }
+    lines = []
+    for key, help_text in gauges.items():
+        name = f"{METRIC_PREFIX}_{key}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for instrument, values in metrics["instruments"].items():
+            if values[key] is not None:
+                lines.append(f'{name}{{instrument="{instrument}"}} {float(values[key])}')
+
+    name = f"{METRIC_PREFIX}_runs"
+    lines += [f"# HELP {name} Number of reduction runs by status", f"# TYPE {name} gauge"]
+    for instrument, values in metrics["instruments"].items():
+        for status, count in values["runs_by_status"].items():
+            lines.append(f'{name}{{instrument="{instrument}",status="{status}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+FORMATTERS = {"prometheus": to_prometheus, "json": to_json}
+
+
+def make_handler(cache: TTLCache):
+    """
+    Creates a request handler class that serves the metrics held in the cache.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves the metrics at /metrics (Prometheus) and /metrics.json (JSON)"""
+
+        def do_GET(self):  # pylint:disable=invalid-name
+            """Handles a scrape"""
+            if self.path == "/metrics":
+                body, content_type = to_prometheus(cache.get()), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = to_json(cache.get()), "application/json"
+            else:
+                self.send_error(404)
+                return
+            encoded = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+            logger.debug(format, *args)
+
+    return MetricsHandler
+
+
+def main(host: str = "127.0.0.1",
+         port: int = 9187,
+         ttl: float = 30,
+         last_n: int = 50,
+         once: str = "",
+         snapshot_path: Optional[str] = None):
+    """
+    Serves the health metrics over HTTP until interrupted.
+
+    Args:
+        host: The address to bind to. Defaults to localhost only
+        port: The port to listen on
+        ttl: Number of seconds for which computed metrics are reused between scrapes
+        last_n: How many of the most recent finished runs to use for the median reduction duration
+        once: If "prometheus" or "json", print the metrics once in that format and exit instead of serving them
+        snapshot_path: The SQLite file that keeps the run counts. Defaults to one in the local store directory
+
+    Raises:
+        ValueError: If once isn't one of the formats
+    """
+    if once and once not in FORMATTERS:
+        raise ValueError(f"Unknown format {once}, expected one of {', '.join(FORMATTERS)}")
+    snapshot = StatisticsSnapshot(snapshot_path)
+    if once:
+        formatter = FORMATTERS[once]
+        print(formatter(collect_metrics(snapshot, last_n)), end="")
+        return
+
+    cache = TTLCache(lambda: collect_metrics(snapshot, last_n), ttl)
+    server = HTTPServer((host, port), make_handler(cache))
+    logger.info("Serving health metrics on http://%s:%s/metrics", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire.Fire(main)  # pragma: no cover
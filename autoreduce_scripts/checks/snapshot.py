@@ -0,0 +1,113 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+An incremental snapshot of the number of reduction runs per instrument and status.
+
+Counting over the whole ReductionRun table gets slower as it grows. The snapshot instead
+keeps running totals in a local SQLite file, along with the highest run ID it has counted,
+so that each update only scans the runs created since the last one.
+
+Runs that were still queued or processing when they were scanned are kept aside and
+re-checked on the next update, so that they are counted under the status they finish with.
+Runs that are deleted after being counted are not subtracted from the totals.
+"""
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from autoreduce_scripts.checks import setup_django  # setup_django first or importing the model fails
+from autoreduce_scripts.local_store import connect, default_path
+
+setup_django()
+
+# pylint:disable=wrong-import-position,wrong-import-order,ungrouped-imports
+from autoreduce_db.reduction_viewer.models import ReductionRun, Status
+
+# pylint:disable=no-member
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS high_water_mark (id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS totals (
+    instrument TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (instrument, status)
+);
+CREATE TABLE IF NOT EXISTS pending_runs (
+    id INTEGER PRIMARY KEY,
+    instrument TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+"""
+
+
+class StatisticsSnapshot:
+    """
+    Keeps the number of runs per instrument and status up to date incrementally.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        """
+        Args:
+            path: The SQLite file holding the snapshot. Defaults to one in the local store directory
+        """
+        self.connection = connect(path or default_path("run_statistics.sqlite3"), SCHEMA)
+
+    @property
+    def high_water_mark(self) -> int:
+        """The highest run ID that has been counted"""
+        row = self.connection.execute("SELECT id FROM high_water_mark").fetchone()
+        return row[0] if row else 0
+
+    def update(self) -> Dict[Tuple[str, str], int]:
+        """
+        Counts the runs created since the last update and re-checks the runs that were pending then.
+
+        Returns:
+            The totals after the update, see `totals`
+        """
+        previous_mark = self.high_water_mark
+        pending_ids = [row[0] for row in self.connection.execute("SELECT id FROM pending_runs")]
+        pending_statuses = [Status.get_queued(), Status.get_processing()]
+
+        with transaction.atomic():
+            # bound the scan by the current maximum so runs created during the update are left for the next one
+            new_mark = ReductionRun.objects.aggregate(Max("pk"))["pk__max"] or previous_mark
+            to_scan = ReductionRun.objects.filter(Q(pk__gt=previous_mark, pk__lte=new_mark) | Q(pk__in=pending_ids),
+                                                  instrument__isnull=False)
+            settled = to_scan.exclude(status__in=pending_statuses) \
+                .values("instrument__name", "status__value") \
+                .annotate(count=Count("id"))
+            still_pending = to_scan.filter(status__in=pending_statuses) \
+                .values_list("pk", "instrument__name", "status__value")
+            settled, still_pending = list(settled), list(still_pending)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO totals (instrument, status, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (instrument, status) DO UPDATE SET count = count + excluded.count",
+                [(row["instrument__name"], row["status__value"], row["count"]) for row in settled])
+            self.connection.execute("DELETE FROM pending_runs")
+            self.connection.executemany("INSERT INTO pending_runs (id, instrument, status) VALUES (?, ?, ?)",
+                                        still_pending)
+            self.connection.execute("DELETE FROM high_water_mark")
+            self.connection.execute("INSERT INTO high_water_mark (id) VALUES (?)", (new_mark, ))
+        return self.totals()
+
+    def totals(self) -> Dict[Tuple[str, str], int]:
+        """
+        Returns the number of runs per instrument and status value, as of the last update.
+        """
+        totals = defaultdict(int)
+        for instrument, status, count in self.connection.execute("SELECT instrument, status, count FROM totals"):
+            totals[(instrument, status)] += count
+        for instrument, status in self.connection.execute("SELECT instrument, status FROM pending_runs"):
+            totals[(instrument, status)] += 1
+        return dict(totals)
@@ -0,0 +1,142 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from datetime import timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
+import shutil
+
+from django.test import TestCase
+
+from autoreduce_scripts.checks import setup_django  # pylint:disable=wrong-import-order,ungrouped-imports
+from autoreduce_db.reduction_viewer.models import Instrument, ReductionRun, Status
+from autoreduce_scripts.checks.daily.time_since_last_run import BASE_INSTRUMENT_LASTRUNS_TXT_DIR
+from autoreduce_scripts.checks.health_exporter import (TTLCache, collect_metrics, main, median_durations, to_json,
+                                                       to_prometheus)
+from autoreduce_scripts.checks.snapshot import StatisticsSnapshot
+
+# pylint:disable=no-member
+
+setup_django()
+
+
+class HealthExporterTest(TestCase):
+    """
+    Test the metrics computed by the health exporter
+    """
+    fixtures = ["status_fixture", "multiple_instruments_and_runs"]
+
+    def setUp(self) -> None:
+        self.instruments = Instrument.objects.all()
+        for instrument in self.instruments:
+            log_path = Path(BASE_INSTRUMENT_LASTRUNS_TXT_DIR.format(instrument))
+            log_path.mkdir(parents=True, exist_ok=True)
+            (log_path / "lastrun.txt").write_text(f"{instrument} 44444 0", encoding="utf-8")
+        self.snapshot_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.snapshot = StatisticsSnapshot(Path(self.snapshot_dir.name, "snapshot.sqlite3"))
+
+    def tearDown(self) -> None:
+        for instrument in self.instruments:
+            shutil.rmtree(Path(BASE_INSTRUMENT_LASTRUNS_TXT_DIR.format(instrument)))
+        self.snapshot.connection.close()
+        self.snapshot_dir.cleanup()
+
+    def test_collect_metrics(self):
+        """
+        Test that the metrics of every instrument are computed from the fixture runs
+        """
+        metrics = collect_metrics(self.snapshot)["instruments"]
+        assert set(metrics) == {"TESTINSTRUMENT", "SomeOtherInstrument"}
+
+        test_instrument = metrics["TESTINSTRUMENT"]
+        assert test_instrument["paused"] is False
+        assert test_instrument["last_run_age_seconds"] > timedelta(days=1).total_seconds()
+        assert test_instrument["lastrun_txt_lag"] == 44444 - 99999
+        assert test_instrument["median_reduction_duration_seconds"] == 300
+        assert test_instrument["runs_by_status"]["completed"] == 1
+        assert test_instrument["runs_by_status"]["queued"] == 0
+
+    def test_collect_metrics_counts_statuses(self):
+        """
+        Test that changing the status of a run is reflected in the counts
+        """
+        run = ReductionRun.objects.get(pk=2)
+        run.status = Status.get_error()
+        run.save()
+        counts = collect_metrics(self.snapshot)["instruments"]["SomeOtherInstrument"]["runs_by_status"]
+        assert counts["error"] == 1
+        assert counts["completed"] == 0
+
+    def test_collect_metrics_missing_lastrun_txt(self):
+        """
+        Test that a missing lastrun.txt leaves the lag empty instead of failing the whole scrape
+        """
+        (Path(BASE_INSTRUMENT_LASTRUNS_TXT_DIR.format("TESTINSTRUMENT")) / "lastrun.txt").unlink()
+        assert collect_metrics(self.snapshot)["instruments"]["TESTINSTRUMENT"]["lastrun_txt_lag"] is None
+
+    def test_instrument_without_runs(self):
+        """
+        Test that an instrument without runs has no age or duration metrics
+        """
+        Instrument.objects.last().reduction_runs.all().delete()
+        metrics = collect_metrics(self.snapshot)["instruments"]["SomeOtherInstrument"]
+        assert metrics["last_run_age_seconds"] is None
+        assert metrics["median_reduction_duration_seconds"] is None
+
+    def test_median_durations_single_query(self):
+        """
+        Test that the medians of all instruments come from one query, over the last N runs of each
+        """
+        latest = ReductionRun.objects.get(pk=2)
+        latest.pk = None
+        latest.started = latest.finished + timedelta(days=1)
+        latest.finished = latest.started + timedelta(seconds=60)
+        latest.save()
+        ids = [instrument.id for instrument in self.instruments]
+        with self.assertNumQueries(1):
+            medians = median_durations(ids, last_n=1)
+        assert medians[latest.instrument_id] == 60
+        assert medians[Instrument.objects.get(name="TESTINSTRUMENT").id] == 300
+
+    def test_main_unknown_format(self):
+        """
+        Test that an unknown format to print once is refused with the known ones
+        """
+        with self.assertRaisesRegex(ValueError, "prometheus, json"):
+            main(once="xml")
+
+    def test_formats(self):
+        """
+        Test that the metrics can be rendered as Prometheus text and JSON
+        """
+        metrics = collect_metrics(self.snapshot)
+        prometheus = to_prometheus(metrics)
+        assert 'autoreduce_runs{instrument="TESTINSTRUMENT",status="completed"} 1' in prometheus
+        assert 'autoreduce_median_reduction_duration_seconds{instrument="TESTINSTRUMENT"} 300.0' in prometheus
+        assert '"TESTINSTRUMENT"' in to_json(metrics)
+
+
+class TTLCacheTest(TestCase):
+    """
+    Test that results are reused within the TTL
+    """
+
+    @patch("autoreduce_scripts.checks.health_exporter.time")
+    def test_get(self, mock_time):
+        """
+        Test that the function is only called again after the TTL has expired
+        """
+        func = Mock()
+        cache = TTLCache(func, 30)
+        mock_time.monotonic.return_value = 100
+        cache.get()
+        mock_time.monotonic.return_value = 129
+        cache.get()
+        func.assert_called_once()
+        mock_time.monotonic.return_value = 130
+        assert cache.get() == func.return_value
+        assert func.call_count == 2
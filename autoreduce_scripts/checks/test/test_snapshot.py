@@ -0,0 +1,87 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from autoreduce_scripts.checks import setup_django  # pylint:disable=wrong-import-order,ungrouped-imports
+from autoreduce_db.reduction_viewer.models import ReductionRun, Status
+from autoreduce_scripts.checks.snapshot import StatisticsSnapshot
+
+# pylint:disable=no-member
+
+setup_django()
+
+
+class StatisticsSnapshotTest(TestCase):
+    """
+    Test that the snapshot counts runs incrementally
+    """
+    fixtures = ["status_fixture", "multiple_instruments_and_runs"]
+
+    def setUp(self) -> None:
+        self.snapshot_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.path = Path(self.snapshot_dir.name, "snapshot.sqlite3")
+        self.snapshot = StatisticsSnapshot(self.path)
+
+    def tearDown(self) -> None:
+        self.snapshot.connection.close()
+        self.snapshot_dir.cleanup()
+
+    @staticmethod
+    def copy_run(status) -> ReductionRun:
+        """Saves a copy of the first fixture run with the given status"""
+        run = ReductionRun.objects.get(pk=1)
+        run.pk = None
+        run.status = status
+        run.save()
+        return run
+
+    def test_update(self):
+        """
+        Test that the first update counts all runs and records the high water mark
+        """
+        totals = self.snapshot.update()
+        assert totals == {("TESTINSTRUMENT", "c"): 1, ("SomeOtherInstrument", "c"): 1}
+        assert self.snapshot.high_water_mark == 2
+
+    def test_update_only_adds_new_runs(self):
+        """
+        Test that a later update adds the new runs to the totals without recounting the old ones
+        """
+        self.snapshot.update()
+        self.copy_run(Status.get_error())
+        assert self.snapshot.update()[("TESTINSTRUMENT", "e")] == 1
+        assert self.snapshot.totals()[("TESTINSTRUMENT", "c")] == 1
+
+        # runs below the high water mark are not scanned again
+        ReductionRun.objects.filter(pk=1).update(status=Status.get_error())
+        assert self.snapshot.update()[("TESTINSTRUMENT", "e")] == 1
+
+    def test_pending_runs_are_rechecked(self):
+        """
+        Test that a run that was queued when it was counted is moved to the status it finished with
+        """
+        run = self.copy_run(Status.get_queued())
+        assert self.snapshot.update()[("TESTINSTRUMENT", "q")] == 1
+
+        run.status = Status.get_completed()
+        run.save()
+        totals = self.snapshot.update()
+        assert ("TESTINSTRUMENT", "q") not in totals
+        assert totals[("TESTINSTRUMENT", "c")] == 2
+
+    def test_snapshot_persists(self):
+        """
+        Test that the totals are kept between invocations
+        """
+        self.snapshot.update()
+        self.snapshot.connection.close()
+        self.snapshot = StatisticsSnapshot(self.path)
+        assert self.snapshot.high_water_mark == 2
+        assert self.snapshot.update() == {("TESTINSTRUMENT", "c"): 1, ("SomeOtherInstrument", "c"): 1}
@@ -0,0 +1,188 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Runs the manual submission, batch submission and removal scripts on a range of runs, offline,
+and reports how long each took.
+
+ICAT and Kafka are replaced by the fakes, with the given latency, error rate and concurrency
+limit. The autoreduction DB is a new SQLite file, with a fraction of the runs already reduced,
+so that the lookups hit both the DB and ICAT, and there are runs to remove. A NeXus file is
+written for each RB number, for the titles that are read from the datafiles. For example:
+
+autoreduce-load-test --runs 2000 --icat_latency 0.02 --error_rate 0.05 --max_concurrency 4
+
+get_icat_instrument_prefix logs in its own ICATClient, so it is pointed at the fake ICAT too.
+"""
+import contextlib
+import io
+import logging
+import time
+from pathlib import Path
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Sequence
+
+from autoreduce_scripts.manual_operations import manual_batch_submit, manual_remove, manual_submission
+from autoreduce_scripts.manual_operations.fakes import (FakeDatafile, FakeICATClient, FakePublisher, FaultInjector,
+                                                        make_catalogue, write_datafile)
+
+# pylint:disable=import-outside-toplevel,too-many-arguments,too-many-locals
+
+logger = logging.getLogger(__file__)
+
+SOFTWARE = {"name": "Mantid", "version": "6.2.0"}
+
+
+def setup_database(path: Path):
+    """
+    Configures Django with a new SQLite DB at the path, and creates its tables
+
+    Raises:
+        RuntimeError: If Django has already been configured, e.g. with the real DB
+    """
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+    from autoreduce_scripts.autoreduce_django.settings import INSTALLED_APPS
+
+    if settings.configured:
+        raise RuntimeError("Django is already configured, the load test needs its own DB")
+    database = {"ENGINE": "django.db.backends.sqlite3", "NAME": str(path)}
+    settings.configure(DATABASES={"default": database}, INSTALLED_APPS=INSTALLED_APPS)
+    django.setup()
+    call_command("migrate", verbosity=0)
+
+
+def store_runs(instrument: str, datafiles: Sequence[FakeDatafile], run_numbers: Sequence[int]):
+    """Stores the runs in the DB as reduced, like the queue processor would"""
+    from autoreduce_db.reduction_viewer.models import (DataLocation, Experiment, Instrument, ReductionArguments,
+                                                       ReductionRun, ReductionScript, RunNumber, Status)
+
+    instrument_record, _ = Instrument.objects.get_or_create(name=instrument)
+    script = ReductionScript.objects.create(text="")
+    arguments = ReductionArguments.objects.create(raw="{}", instrument=instrument_record)
+    status = Status.get_completed()
+    for datafile, run_number in zip(datafiles, run_numbers):
+        experiment, _ = Experiment.objects.get_or_create(reference_number=int(datafile.dataset.investigation.name))
+        reduction_run = ReductionRun.objects.create(run_version=0,
+                                                    run_title=f"Run {run_number}",
+                                                    experiment=experiment,
+                                                    instrument=instrument_record,
+                                                    arguments=arguments,
+                                                    script=script,
+                                                    status=status)
+        RunNumber.objects.create(reduction_run=reduction_run, run_number=run_number)
+        DataLocation.objects.create(reduction_run=reduction_run, file_path=datafile.location)
+
+
+def timed(stage: Callable[[], object]) -> Dict[str, object]:
+    """Runs the stage, and returns how long it took and the error it raised, if any"""
+    started = time.monotonic()
+    error = None
+    try:
+        stage()
+    except Exception as err:  # pylint:disable=broad-except
+        logger.warning("Stage failed", exc_info=True)
+        error = f"{type(err).__name__}: {err}"
+    return {"seconds": round(time.monotonic() - started, 3), "error": error}
+
+
+def fault_report(faults: FaultInjector) -> Dict[str, object]:
+    """Returns the statistics of the calls to a fake"""
+    stats = faults.stats
+    return {
+        "calls": stats.calls,
+        "errors": stats.errors,
+        "peak_concurrency": stats.peak_concurrency,
+        "queued_seconds": round(stats.queued_time, 3)
+    }
+
+
+def main(instrument: str = "MARI",
+         prefix: str = "MAR",
+         first_run: int = 1,
+         runs: int = 1000,
+         stored_fraction: float = 0.5,
+         batch_size: int = 100,
+         workers: int = manual_batch_submit.DEFAULT_WORKERS,
+         icat_latency: float = 0.005,
+         kafka_latency: float = 0.001,
+         error_rate: float = 0,
+         max_concurrency: int = 0,
+         seed: int = 0) -> Dict[str, object]:
+    """
+    Runs the load test
+
+    Args:
+        instrument: The instrument of the runs
+        prefix: The prefix of the instrument's datafiles in ICAT
+        first_run: The first run number
+        runs: The number of runs
+        stored_fraction: The fraction of the runs that are already in the DB, the others are only in ICAT
+        batch_size: The maximum number of runs in each part of the batch submission
+        workers: The number of runs the batch submission looks up at the same time
+        icat_latency: The number of seconds each ICAT query takes
+        kafka_latency: The number of seconds each publish takes
+        error_rate: The fraction of the ICAT queries and publishes that fail
+        max_concurrency: The number of calls ICAT and Kafka each serve at the same time. Unlimited if 0
+        seed: Seeds the choice of the failing calls
+
+    Returns:
+        The time each stage took, and what the fakes were asked to do
+    """
+    run_numbers: List[int] = list(range(first_run, first_run + runs))
+    instrument = instrument.upper()
+    with TemporaryDirectory() as tmp_dir:
+        setup_database(Path(tmp_dir, "autoreduce.sqlite3"))
+
+        def location(_, rb_number):
+            path = Path(tmp_dir, "archive", f"{rb_number}.nxs")
+            if not path.exists():
+                write_datafile(path, rb_number, f"Experiment {rb_number}")
+            return str(path)
+
+        catalogue = make_catalogue(instrument, run_numbers, prefix, location=location)
+        stored = int(len(run_numbers) * stored_fraction)
+        store_runs(instrument, list(catalogue.values())[:stored], run_numbers[:stored])
+
+        faults = {"error_rate": error_rate, "max_concurrency": max_concurrency, "seed": seed}
+        icat_client = FakeICATClient(catalogue, {instrument: prefix}, latency=icat_latency, **faults)
+        publisher = FakePublisher(latency=kafka_latency, **faults)
+        clients = {"publisher": publisher, "icat_client": icat_client}
+
+        batch = {"workers": workers, "max_batch_size": batch_size, "split_by": "rb_number"}
+
+        report = {"runs": len(run_numbers), "stored_runs": stored}
+        with patch("autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix",
+                   icat_client.get_icat_instrument_prefix):
+            report["submit"] = timed(lambda: manual_submission.main(instrument, run_numbers, SOFTWARE, **clients))
+            report["batch_submit"] = timed(
+                lambda: manual_batch_submit.main(instrument, run_numbers, SOFTWARE, **batch, **clients))
+        # manual_remove prints each run it removes
+        with contextlib.redirect_stdout(io.StringIO()):
+            report["remove"] = timed(
+                lambda: manual_remove.main(instrument, run_numbers, delete_all_versions=True, no_input=True))
+
+        for stage in ("submit", "batch_submit", "remove"):
+            report[stage]["runs_per_second"] = round(len(run_numbers) / max(report[stage]["seconds"], 1e-9), 1)
+        report["icat"] = fault_report(icat_client.faults)
+        report["kafka"] = dict(fault_report(publisher.faults),
+                               messages=len(publisher.published),
+                               messages_per_second=round(publisher.throughput(), 1))
+    return report
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    import fire
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire_entrypoint()  # pragma: no cover
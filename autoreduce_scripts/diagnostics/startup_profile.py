@@ -0,0 +1,226 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Reports how long each phase of starting one of the console scripts takes.
+
+The phases are:
+    - imports: importing the script's module in a fresh interpreter, broken down per
+      module from the output of ``python -X importtime``
+    - django_setup: ``django.setup()``
+    - db_connect: opening the database connection
+    - icat_login: logging into ICAT
+    - producer: creating the Kafka producer
+
+A phase that fails is reported with its error instead of stopping the profile, so e.g.
+the imports can still be profiled on a host that can't reach ICAT.
+
+Example, to print the 20 slowest items of starting the manual submission:
+
+autoreduce-profile-startup autoreduce-manual-submission --top 20
+"""
+import json
+import re
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from importlib.metadata import entry_points
+from typing import Callable, Dict, List, Optional, Sequence
+
+# pylint:disable=import-outside-toplevel
+
+# the lines written by -X importtime, e.g. "import time:       563 |      15340 |   json.decoder"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$")
+SCRIPT_PACKAGE = "autoreduce_scripts"
+
+
+@dataclass
+class ImportTiming:
+    """The time taken to import a single module"""
+    module: str
+    self_seconds: float
+    cumulative_seconds: float
+    depth: int
+
+
+@dataclass
+class PhaseTiming:
+    """The time taken by a phase of starting a script, and its error if it failed"""
+    name: str
+    seconds: float
+    error: Optional[str] = None
+
+
+def parse_importtime(output: str) -> List[ImportTiming]:
+    """
+    Parses the output of ``python -X importtime``. Lines that aren't import timings are ignored.
+
+    Args:
+        output: The stderr of the interpreter
+
+    Returns:
+        The timing of each imported module, in the order they finished importing
+    """
+    timings = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            timings.append(ImportTiming(module, int(self_us) / 1e6, int(cumulative_us) / 1e6, (len(indent) - 1) // 2))
+    return timings
+
+
+def resolve_module(script: str) -> str:
+    """
+    Finds the module of a console script.
+
+    Args:
+        script: The name of a console script, e.g. autoreduce-manual-submission, or a module path
+
+    Returns:
+        The module path, e.g. autoreduce_scripts.manual_operations.manual_submission
+    """
+    scripts = entry_points()
+    if hasattr(scripts, "select"):
+        console_scripts = scripts.select(group="console_scripts")
+    else:
+        # entry_points() returns a dict of groups before Python 3.10
+        console_scripts = scripts.get("console_scripts", [])
+    for entry_point in console_scripts:
+        if entry_point.name == script and entry_point.value.startswith(SCRIPT_PACKAGE):
+            return entry_point.value.split(":")[0]
+    return script
+
+
+def profile_imports(module: str) -> List[ImportTiming]:
+    """
+    Imports the module in a fresh interpreter and returns the timing of every module it imported
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True,
+                            text=True,
+                            check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    return parse_importtime(result.stderr)
+
+
+def time_phase(name: str, func: Callable[[], object]) -> PhaseTiming:
+    """
+    Times a phase, recording its error instead of raising it
+    """
+    start = time.perf_counter()
+    try:
+        func()
+    except Exception as err:  # pylint:disable=broad-except
+        return PhaseTiming(name, time.perf_counter() - start, f"{type(err).__name__}: {err}")
+    return PhaseTiming(name, time.perf_counter() - start)
+
+
+def django_setup():
+    """Sets up Django with the settings used by the scripts"""
+    from autoreduce_scripts.manual_operations import setup_django
+    setup_django()
+
+
+def db_connect():
+    """Opens the default database connection"""
+    from django.db import connection
+    connection.ensure_connection()
+
+
+def icat_login():
+    """Logs into ICAT"""
+    from autoreduce_scripts.manual_operations.manual_submission import login_icat
+    login_icat()
+
+
+def create_producer():
+    """Creates the Kafka producer"""
+    from autoreduce_scripts.manual_operations.manual_submission import login_queue
+    login_queue()
+
+
+# the phases after the imports, in the order a script goes through them
+PHASES: Dict[str, Callable[[], object]] = {
+    "django_setup": django_setup,
+    "db_connect": db_connect,
+    "icat_login": icat_login,
+    "producer": create_producer,
+}
+
+
+def profile_startup(module: str, skip: Sequence[str] = ()) -> dict:
+    """
+    Profiles every phase of starting a script.
+
+    Args:
+        module: The module of the script
+        skip: Names of phases not to run, e.g. icat_login on a host without access to ICAT
+
+    Returns:
+        The timing of each phase, and of each module imported by the script
+    """
+    start = time.perf_counter()
+    try:
+        imports = profile_imports(module)
+        phases = [PhaseTiming("imports", time.perf_counter() - start)]
+    except RuntimeError as err:
+        imports = []
+        phases = [PhaseTiming("imports", time.perf_counter() - start, str(err))]
+
+    phases += [time_phase(name, func) for name, func in PHASES.items() if name not in skip]
+    return {
+        "module": module,
+        "phases": [asdict(phase) for phase in phases],
+        "imports": [asdict(timing) for timing in imports],
+    }
+
+
+def to_table(profile: dict, top: int = 20) -> str:
+    """
+    Renders the phases, and the modules that took longest to import including their own imports,
+    as tables ranked from slowest to fastest
+    """
+    lines = [f"Startup of {profile['module']}", "", f"{'seconds':>10}  phase"]
+    for phase in sorted(profile["phases"], key=lambda phase: phase["seconds"], reverse=True):
+        error = f"  (failed: {phase['error']})" if phase["error"] else ""
+        lines.append(f"{phase['seconds']:>10.3f}  {phase['name']}{error}")
+
+    imports = sorted(profile["imports"], key=lambda timing: timing["cumulative_seconds"], reverse=True)
+    lines += ["", f"{'cumulative':>10}  {'self':>8}  module"]
+    for timing in imports[:top]:
+        lines.append(f"{timing['cumulative_seconds']:>10.3f}  {timing['self_seconds']:>8.3f}  {timing['module']}")
+    return "\n".join(lines)
+
+
+def main(script: str = "autoreduce-manual-submission", top: int = 20, json_output: bool = False, skip: tuple = ()):
+    """
+    Prints how long each phase of starting a script takes.
+
+    Args:
+        script: The name of a console script, e.g. autoreduce-manual-submission, or a module path
+        top: How many of the slowest imported modules to list in the table
+        json_output: Print the full profile as JSON instead of a table
+        skip: Names of phases not to run, out of django_setup, db_connect, icat_login and producer
+    """
+    if isinstance(skip, str):
+        skip = (skip, )
+    profile = profile_startup(resolve_module(script), skip)
+    print(json.dumps(profile, indent=1) if json_output else to_table(profile, top))
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    import fire
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire_entrypoint()  # pragma: no cover
@@ -0,0 +1,31 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import json
+import subprocess
+import sys
+from unittest import TestCase
+
+
+class LoadTestTest(TestCase):
+    """
+    Test the offline load test of the manual operations
+    """
+
+    def test_load_test(self):
+        """
+        Test that every stage runs against the fakes. It configures Django with its own DB,
+        so it runs in a fresh interpreter.
+        """
+        script = ("import json; from autoreduce_scripts.diagnostics.load_test import main; "
+                  "print(json.dumps(main(runs=60, icat_latency=0, kafka_latency=0)))")
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        report = json.loads(result.stdout.splitlines()[-1])
+        for stage in ("submit", "batch_submit", "remove"):
+            assert report[stage]["error"] is None
+        assert report["stored_runs"] == 30
+        # 60 runs on their own, and 60 in two parts of a batch, one for each RB number
+        assert report["kafka"]["messages"] == 62
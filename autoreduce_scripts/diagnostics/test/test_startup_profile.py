@@ -0,0 +1,107 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import json
+from dataclasses import asdict
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.diagnostics.startup_profile import (ImportTiming, PhaseTiming, main, parse_importtime,
+                                                            profile_imports, profile_startup, resolve_module, to_table)
+
+IMPORTTIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       150 |        150 |   _json
+import time:      1000 |       1150 | json
+Some other output
+import time:     20000 |     300000 | h5py
+"""
+
+
+class StartupProfileTest(TestCase):
+    """
+    Test the startup profile of the console scripts
+    """
+
+    def test_parse_importtime(self):
+        """
+        Test that the import timings are parsed with their nesting, ignoring other lines
+        """
+        assert parse_importtime(IMPORTTIME_OUTPUT) == [
+            ImportTiming("_json", 0.00015, 0.00015, 1),
+            ImportTiming("json", 0.001, 0.00115, 0),
+            ImportTiming("h5py", 0.02, 0.3, 0),
+        ]
+
+    def test_profile_imports(self):
+        """
+        Test that a real import is profiled in a fresh interpreter
+        """
+        modules = [timing.module for timing in profile_imports("json")]
+        assert "json" in modules
+        assert "json.decoder" in modules
+
+    def test_profile_imports_failure(self):
+        """
+        Test that an import that fails is reported in the imports phase
+        """
+        profile = profile_startup("autoreduce_scripts.does_not_exist",
+                                  skip=("django_setup", "db_connect", "icat_login", "producer"))
+        assert profile["imports"] == []
+        assert "ModuleNotFoundError" in profile["phases"][0]["error"]
+
+    def test_resolve_module(self):
+        """
+        Test that console script names are resolved to their module and module paths are kept
+        """
+        assert resolve_module("autoreduce-manual-submission") == \
+            "autoreduce_scripts.manual_operations.manual_submission"
+        assert resolve_module("autoreduce_scripts.checks.snapshot") == "autoreduce_scripts.checks.snapshot"
+
+    @patch("autoreduce_scripts.diagnostics.startup_profile.profile_imports",
+           return_value=parse_importtime(IMPORTTIME_OUTPUT))
+    def test_failed_phase_does_not_stop_profile(self, _):
+        """
+        Test that a phase that fails records its error and the later phases still run
+        """
+        producer = Mock()
+        phases = {"icat_login": Mock(side_effect=RuntimeError("Unable to connect to ICAT.")), "producer": producer}
+        with patch.dict("autoreduce_scripts.diagnostics.startup_profile.PHASES", phases, clear=True):
+            profile = profile_startup("json")
+
+        assert [phase["name"] for phase in profile["phases"]] == ["imports", "icat_login", "producer"]
+        assert profile["phases"][1]["error"] == "RuntimeError: Unable to connect to ICAT."
+        assert profile["phases"][2]["error"] is None
+        producer.assert_called_once()
+
+    def test_to_table(self):
+        """
+        Test that the table ranks the phases and imports from slowest to fastest
+        """
+        phases = [PhaseTiming("imports", 0.1), PhaseTiming("icat_login", 2.0, "RuntimeError: failed")]
+        imports = parse_importtime(IMPORTTIME_OUTPUT)
+        profile = {
+            "module": "json",
+            "phases": [asdict(phase) for phase in phases],
+            "imports": [asdict(timing) for timing in imports]
+        }
+        lines = to_table(profile, top=1).splitlines()
+        assert lines[3] == "     2.000  icat_login  (failed: RuntimeError: failed)"
+        assert lines[4] == "     0.100  imports"
+        assert lines[-1] == "     0.300     0.020  h5py"
+        # only the slowest import is listed
+        assert len(lines) == 8
+
+    @patch("autoreduce_scripts.diagnostics.startup_profile.profile_startup")
+    def test_main_json(self, profile_startup_mock: Mock):
+        """
+        Test that the profile of the resolved module is printed as JSON, skipping the given phase
+        """
+        profile_startup_mock.return_value = {"module": "m", "phases": [], "imports": []}
+        with patch("builtins.print") as print_mock:
+            main("autoreduce-manual-remove", json_output=True, skip="icat_login")
+        profile_startup_mock.assert_called_once_with("autoreduce_scripts.manual_operations.manual_remove",
+                                                     ("icat_login", ))
+        assert json.loads(print_mock.call_args[0][0]) == profile_startup_mock.return_value
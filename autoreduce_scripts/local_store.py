@@ -0,0 +1,45 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Small SQLite files kept on the local disk by the scripts, e.g. caches and snapshots
+that should survive between invocations without needing a table in the autoreduction DB.
+"""
+import sqlite3
+from pathlib import Path
+
+from autoreduce_utils.settings import AUTOREDUCE_HOME_ROOT
+
+LOCAL_STORE_DIR = Path(AUTOREDUCE_HOME_ROOT, "scripts")
+
+
+def default_path(name: str) -> Path:
+    """
+    Returns the path of a store with the given file name in the local store directory
+    """
+    return LOCAL_STORE_DIR / name
+
+
+def connect(path: Path, schema: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Opens the SQLite file at path, creating it and its tables if they don't exist yet.
+
+    Args:
+        path: The path to the SQLite file
+        schema: SQL statements creating the tables. They should use CREATE ... IF NOT EXISTS
+        check_same_thread: Whether only the thread that opened the connection may use it.
+                           Connections shared between threads must be used under a lock
+
+    Returns:
+        The open connection
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(path), timeout=30, check_same_thread=check_same_thread)
+    # lets readers carry on while another process is writing
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(schema)
+    return connection
@@ -8,15 +8,17 @@
 # pylint:disable=import-outside-toplevel
 
 
-def setup_django():
-    """Sets up the env to allow access to a django DB"""
+def setup_django(worker_mode: bool = False):
+    """
+    Sets up the env to allow access to a django DB
+
+    Args:
+        worker_mode: Keep DB connections open for the life of the process, for long running services
+    """
     import django
     from django.conf import settings
-    from autoreduce_scripts.autoreduce_django.settings import DATABASES, INSTALLED_APPS
+    from autoreduce_scripts.autoreduce_django.settings import INSTALLED_APPS, database_settings
 
     if not settings.configured:
-        settings.configure(DATABASES=DATABASES, INSTALLED_APPS=INSTALLED_APPS)
+        settings.configure(DATABASES=database_settings(worker_mode), INSTALLED_APPS=INSTALLED_APPS)
         django.setup()
-
-
-setup_django()
@@ -0,0 +1,238 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+A local index of the NeXus datafiles on the archive, so that runs can be found without ICAT
+and without checking candidate paths on the mount.
+
+The index is a SQLite file holding the path, RB number, title and mtime of each datafile,
+keyed by (instrument, run number), so a lookup is a single B-tree search. It also records the
+mtime of each cycle directory it has scanned. Updating the index only lists the directories
+whose mtime has changed, and only reads the headers of the files that are new or modified.
+
+To index every instrument on the archive, or only some of them:
+
+autoreduce-index-archive
+autoreduce-index-archive --instruments "[MARI,WISH]"
+
+get_run_data looks runs up in the index at the default path, if it has been built.
+"""
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from autoreduce_scripts.local_store import connect, default_path
+from autoreduce_scripts.manual_operations.archive_resolver import (archive_location, archive_root, cycle_directories,
+                                                                   cycle_sort_key, data_directory, read_header)
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_INDEX_PATH = default_path("archive_index.sqlite3")
+# the prefix and run number of a datafile name, e.g. MAR and 25581 in MAR25581.nxs
+DATAFILE_NAME = re.compile(r"[A-Za-z]+(\d+)\.nxs")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datafiles (
+    instrument TEXT NOT NULL,
+    run_number INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    rb_number TEXT NOT NULL,
+    title TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (instrument, run_number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS datafiles_directory ON datafiles (directory);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    instrument TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+"""
+
+
+class ArchiveIndex:
+    """
+    The index of the datafiles on the archive. It can be shared between threads.
+    """
+
+    def __init__(self, path: Path = DEFAULT_INDEX_PATH):
+        self.connection = connect(path, SCHEMA, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def lookup(self, instrument: str, run_number: int) -> Optional[Tuple[str, str, str]]:
+        """
+        Returns:
+            The datafile location, RB number and title of the run, or None if it isn't in the index
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, rb_number, title FROM datafiles WHERE instrument = ? AND run_number = ?",
+                (instrument, run_number)).fetchone()
+        return None if row is None else tuple(row)
+
+    def indexed_files(self, directory: str) -> Dict[str, float]:
+        """Returns the mtime of each file indexed in the directory, by path. Must be called with the lock held"""
+        rows = self.connection.execute("SELECT path, mtime FROM datafiles WHERE directory = ?", (directory, ))
+        return dict(rows.fetchall())
+
+    def update_directory(self, instrument: str, directory: Path) -> int:
+        """
+        Indexes the new and modified datafiles of a cycle directory, and forgets the removed ones,
+        unless the directory hasn't changed since it was last indexed.
+
+        The headers are read from the archive before the lock is taken, so lookups and the
+        index's write transaction don't wait on the mount. If any header can't be read, the
+        directory's mtime isn't recorded, so the next update lists it again and retries the
+        datafiles that aren't in the index yet.
+
+        Returns:
+            The number of datafiles whose header was read
+        """
+        try:
+            mtime = os.stat(directory).st_mtime
+            with os.scandir(directory) as entries:
+                files = {entry.path: entry for entry in entries if DATAFILE_NAME.fullmatch(entry.name)}
+        except OSError:
+            logger.warning("Could not list %s", directory, exc_info=True)
+            return 0
+
+        with self.lock:
+            row = self.connection.execute("SELECT mtime FROM directories WHERE path = ?", (str(directory), )).fetchone()
+            if row is not None and row[0] == mtime:
+                return 0
+            indexed = self.indexed_files(str(directory))
+
+        datafiles = []
+        failed = False
+        for path, entry in files.items():
+            try:
+                modified = indexed.get(path) != entry.stat().st_mtime
+            except OSError:
+                logger.warning("Could not stat %s", path)
+                failed = True
+                continue
+            if modified:
+                datafile = self.read_datafile(instrument, directory, entry)
+                failed = failed or datafile is None
+                if datafile is not None:
+                    datafiles.append(datafile)
+
+        with self.lock, self.connection:
+            removed = [(path, ) for path in indexed if path not in files]
+            self.connection.executemany("DELETE FROM datafiles WHERE path = ?", removed)
+            self.connection.executemany(
+                "INSERT INTO datafiles (instrument, run_number, path, directory, rb_number, title, mtime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (instrument, run_number) DO UPDATE SET "
+                "path = excluded.path, directory = excluded.directory, rb_number = excluded.rb_number, "
+                "title = excluded.title, mtime = excluded.mtime WHERE excluded.mtime >= datafiles.mtime", datafiles)
+            if failed:
+                self.connection.execute("DELETE FROM directories WHERE path = ?", (str(directory), ))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO directories (path, instrument, mtime) VALUES (?, ?, ?)",
+                                        (str(directory), instrument, mtime))
+        return len(datafiles)
+
+    @staticmethod
+    def read_datafile(instrument: str, directory: Path, entry: os.DirEntry) -> Optional[tuple]:
+        """
+        Reads the header of the datafile. When the row is written, a run found in several cycles
+        keeps the most recently modified datafile.
+
+        Returns:
+            The datafiles row of the datafile, or None if its header could not be read
+        """
+        try:
+            rb_number, title = read_header(Path(entry.path))
+        except RuntimeError:
+            logger.warning("Could not read the header of %s", entry.path)
+            return None
+        run_number = int(DATAFILE_NAME.fullmatch(entry.name).group(1))
+        return instrument, run_number, entry.path, str(directory), rb_number, title, entry.stat().st_mtime
+
+    def update(self, instrument: str, root: Optional[Path] = None) -> int:
+        """
+        Updates the index with the instrument's cycle directories, oldest first
+
+        Returns:
+            The number of datafiles whose header was read
+        """
+        cycles = sorted(cycle_directories(data_directory(instrument, root)), key=cycle_sort_key)
+        return sum(self.update_directory(instrument, cycle) for cycle in cycles)
+
+
+def archive_instruments(root: Path) -> List[str]:
+    """Returns the instruments with a directory on the archive, e.g. MARI for NDXMARI"""
+    try:
+        with os.scandir(root) as entries:
+            return sorted(entry.name[3:] for entry in entries if entry.name.startswith("NDX") and entry.is_dir())
+    except OSError:
+        return []
+
+
+def lookup(instrument: str, run_number: int, path: Optional[Path] = None) -> Optional[Tuple[str, str, str]]:
+    """
+    Looks the run up in the index, if it has been built
+
+    Returns:
+        The datafile location in UNC form, see archive_resolver.archive_location, RB number and title of the run,
+        or None if the index doesn't exist, doesn't hold the run, or the datafile has been moved since it was indexed
+    """
+    index = open_index(path or DEFAULT_INDEX_PATH)
+    if index is None:
+        return None
+    run_data = index.lookup(instrument, run_number)
+    if run_data is None or not os.path.exists(run_data[0]):
+        return None
+    location, rb_number, title = run_data
+    return archive_location(Path(location)), rb_number, title
+
+
+_INDEXES: Dict[Path, ArchiveIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def open_index(path: Path) -> Optional[ArchiveIndex]:
+    """Returns the index at the path, opened once per process, or None if it doesn't exist"""
+    with _INDEXES_LOCK:
+        if path not in _INDEXES:
+            if not Path(path).exists():
+                return None
+            _INDEXES[path] = ArchiveIndex(path)
+        return _INDEXES[path]
+
+
+def main(instruments: Optional[Iterable[str]] = None, root: Optional[str] = None, index_path: Optional[str] = None):
+    """
+    Builds or updates the index of the archive
+
+    Args:
+        instruments: The instruments to index. Defaults to all the instruments on the archive
+        root: The root of the archive. Defaults to ARCHIVE_ROOT
+        index_path: The index file. Defaults to the one get_run_data uses
+    """
+    archive = Path(root) if root else archive_root()
+    if isinstance(instruments, str):
+        instruments = [instruments]
+    index = ArchiveIndex(Path(index_path) if index_path else DEFAULT_INDEX_PATH)
+    for instrument in (instruments or archive_instruments(archive)):
+        read = index.update(instrument.upper(), archive)
+        logger.info("Indexed %s new or modified datafiles of %s", read, instrument)
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    import fire  # pylint:disable=import-outside-toplevel
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire_entrypoint()  # pragma: no cover
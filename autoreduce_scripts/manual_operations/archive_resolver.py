@@ -0,0 +1,194 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Finds a run's datafile directly on the archive mount, without asking ICAT.
+
+Datafiles are stored in ARCHIVE_ROOT/NDX<instrument>/Instrument/data/cycle_<year>_<number>/ and
+named like they are in ICAT: the instrument's prefix or full name, followed by the run number
+padded to 5 or 8 digits, e.g. MAR25581.nxs or WISH00038774.nxs. The candidate names are checked
+with stat in each cycle directory, newest first, and the RB number and title are read from
+the header of the NeXus file that is found. Only the MAX_CYCLES newest cycles are checked, so that
+a miss costs a bounded number of stats on the network mount; older runs are left to ICAT, or to
+the archive index if it has been built.
+
+The location of the datafile is returned in the same UNC form as ICAT and the database give it,
+e.g. \\\\isis\\inst$\\NDXMARI\\Instrument\\data\\cycle_22_1\\MAR25581.nxs, whatever the mount is.
+
+The instrument's prefix comes from ICAT too, so instead it is worked out from the names of the
+files in the newest cycle directory, once per process.
+"""
+import logging
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from autoreduce_scripts.manual_operations.instrumentation import measure
+
+# pylint:disable=import-outside-toplevel
+
+logger = logging.getLogger(__file__)
+
+# the number of newest cycle directories that are searched for a datafile
+MAX_CYCLES = 8
+# the root of the archive, as it is named in the datafile locations of ICAT and the database
+UNC_ARCHIVE_ROOT = "\\\\isis\\inst$\\"
+
+CYCLE_PATTERN = re.compile(r"cycle_(\d+)_(\w+)")
+DATAFILE_PATTERN = re.compile(r"([A-Za-z]+)\d+\.\w+")
+
+
+def archive_root() -> Path:
+    """Returns the root of the archive mount, from the autoreduce_utils settings"""
+    from autoreduce_utils.settings import ARCHIVE_ROOT
+
+    return Path(ARCHIVE_ROOT)
+
+
+def data_directory(instrument: str, root: Optional[Path] = None) -> Path:
+    """Returns the directory holding the cycle directories of the instrument"""
+    return (root or archive_root()) / f"NDX{instrument}" / "Instrument" / "data"
+
+
+def archive_location(path: Path, root: Optional[Path] = None) -> str:
+    """
+    Returns the location of a datafile on the archive in the UNC form used by ICAT and the database,
+    e.g. \\\\isis\\inst$\\NDXMARI\\Instrument\\data\\cycle_22_1\\MAR25581.nxs.
+    Paths that aren't under the root of the archive are returned as they are.
+    """
+    try:
+        relative = path.relative_to(root or archive_root())
+    except ValueError:
+        return str(path)
+    return UNC_ARCHIVE_ROOT + "\\".join(relative.parts)
+
+
+def candidate_file_names(instrument: str, prefix: Optional[str], run_number: int, file_ext: str) -> List[str]:
+    """
+    Returns the names the run's datafile could have, in the order they are tried:
+    with the instrument's prefix then its full name, with the run number padded to 5 then 8 digits.
+    The names with the prefix are left out if it isn't known.
+    """
+    names = [prefix] if prefix and prefix != instrument else []
+    names.append(instrument)
+    return [f"{name}{str(run_number).zfill(width)}.{file_ext}" for name in names for width in (5, 8)]
+
+
+def cycle_sort_key(directory: Path) -> Tuple[int, str]:
+    """Sorts cycle directories by year then number, e.g. cycle_98_1 before cycle_22_1"""
+    match = CYCLE_PATTERN.fullmatch(directory.name)
+    if match is None:
+        return (-1, directory.name)
+    year = int(match.group(1))
+    return (year + (1900 if year >= 70 else 2000), match.group(2).zfill(4))
+
+
+def cycle_directories(data_dir: Path) -> List[Path]:
+    """
+    Returns the instrument's cycle directories, newest first, or none if the data directory doesn't exist
+    """
+    try:
+        with os.scandir(data_dir) as entries:
+            cycles = [Path(entry.path) for entry in entries if entry.name.startswith("cycle_") and entry.is_dir()]
+    except OSError:
+        return []
+    return sorted(cycles, key=cycle_sort_key, reverse=True)
+
+
+@lru_cache(maxsize=None)
+def instrument_prefix(data_dir: Path) -> Optional[str]:
+    """
+    Works out the prefix of the instrument's datafiles, e.g. MAR for MARI, from the most common prefix
+    of the files in its newest cycle directory.
+
+    Returns:
+        The prefix, or None if there are no datafiles to work it out from
+    """
+    for cycle in cycle_directories(data_dir):
+        try:
+            with os.scandir(cycle) as entries:
+                prefixes = Counter(
+                    match.group(1).upper() for match in (DATAFILE_PATTERN.fullmatch(entry.name) for entry in entries)
+                    if match is not None)
+        except OSError:
+            continue
+        if prefixes:
+            return prefixes.most_common(1)[0][0]
+    return None
+
+
+def read_header(location: Path) -> Tuple[str, str]:
+    """
+    Reads the RB number and title from the first entry of the NeXus file
+
+    Raises:
+        RuntimeError: If the file can't be opened, or doesn't have an RB number and title
+    """
+    import h5py
+
+    try:
+        with measure("read_datafile"), h5py.File(location, mode="r") as nxs_file:
+            for _, entry in nxs_file.items():
+                rb_num, title = (entry.get(key)[:][0].decode("utf-8") for key in ("experiment_identifier", "title"))
+                return str(rb_num), str(title)
+    except Exception as err:
+        raise RuntimeError(f"Could not read the RB number and title from {location}") from err
+    raise RuntimeError(f"Datafile at {location} does not have any entries")
+
+
+def find_datafile(instrument: str,
+                  run_number: int,
+                  file_ext: str,
+                  root: Optional[Path] = None,
+                  max_cycles: int = MAX_CYCLES) -> Optional[Path]:
+    """
+    Looks for the run's datafile in the instrument's `max_cycles` newest cycle directories, newest first
+
+    Returns:
+        The path of the datafile, or None if it isn't in those cycles
+    """
+    data_dir = data_directory(instrument, root)
+    file_names = candidate_file_names(instrument, instrument_prefix(data_dir), run_number, file_ext)
+    for cycle in cycle_directories(data_dir)[:max_cycles]:
+        for file_name in file_names:
+            path = cycle / file_name
+            try:
+                os.stat(path)
+            except OSError:
+                continue
+            return path
+    return None
+
+
+def get_run_data_from_archive(instrument: str,
+                              run_number: int,
+                              file_ext: str,
+                              root: Optional[Path] = None) -> Optional[Tuple[str, str, str]]:
+    """
+    Retrieves a run's data-file location, RB number and title from the archive mount
+
+    Args:
+        instrument: The name of instrument
+        run_number: The run number
+        file_ext: The expected file extension
+        root: The root of the archive. Defaults to ARCHIVE_ROOT
+
+    Returns:
+        The data file location in UNC form, RB number and run title, or None if the datafile isn't
+        in the newest cycles of the archive or its header can't be read
+    """
+    location = find_datafile(instrument, run_number, file_ext, root)
+    if location is None:
+        return None
+    try:
+        rb_num, run_title = read_header(location)
+    except RuntimeError:
+        logger.warning("Found %s but could not read its header", location, exc_info=True)
+        return None
+    return archive_location(location, root), rb_num, run_title
@@ -0,0 +1,134 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Avoids looking up and submitting the same run several times when overlapping submissions run at once.
+
+- ResolutionCoalescer shares one lookup of a run between the threads that need it at the same time.
+- PublicationLog records when each (instrument, run number, reduction arguments) was last published
+  to data_ready in a local SQLite file shared by all the scripts on the host. A run is not published
+  again within the window, unless the submission is forced.
+"""
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Hashable, Optional
+
+from autoreduce_scripts.local_store import connect, default_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS publications (
+    instrument TEXT NOT NULL,
+    run_number INTEGER NOT NULL,
+    arguments_hash TEXT NOT NULL,
+    published_at REAL NOT NULL,
+    PRIMARY KEY (instrument, run_number, arguments_hash)
+);
+"""
+
+
+def arguments_hash(reduction_arguments: Optional[dict]) -> str:
+    """
+    Returns a hash of the reduction arguments that doesn't depend on the order of their keys
+    """
+    encoded = json.dumps(reduction_arguments, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResolutionCoalescer:
+    """
+    Shares a single call of a function between threads that make it with the same key at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight: Dict[Hashable, Future] = {}
+
+    def resolve(self, key: Hashable, func: Callable, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), unless another thread is already making the call with the same key,
+        in which case it waits for that call and returns its result, or raises its exception.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as err:  # pylint:disable=broad-except
+                future.set_exception(err)
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+        return future.result()
+
+
+class PublicationLog:
+    """
+    Records the runs published to data_ready, to suppress publishing them again within a window.
+    """
+
+    def __init__(self, window: float, path: Optional[Path] = None):
+        """
+        Args:
+            window: The number of seconds after publishing a run during which it is not published again
+            path: The SQLite file holding the log. Defaults to one in the local store directory
+        """
+        self.window = window
+        self.connection = connect(path or default_path("publications.sqlite3"), SCHEMA)
+        # the claims are made in explicit transactions
+        self.connection.isolation_level = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """Closes the connection to the log"""
+        self.connection.close()
+
+    def claim(self, instrument: str, run_number: int, reduction_arguments: Optional[dict]) -> bool:
+        """
+        Records that the run is about to be published, unless it was published within the window.
+        Claims from concurrent processes are serialised, so only one of them succeeds.
+
+        Returns:
+            Whether the run should be published
+        """
+        key = (instrument, run_number, arguments_hash(reduction_arguments))
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT published_at FROM publications WHERE instrument = ? AND run_number = ? AND arguments_hash = ?",
+                key).fetchone()
+            if row is not None and now - row[0] < self.window:
+                return False
+            self.connection.execute(
+                "INSERT OR REPLACE INTO publications (instrument, run_number, arguments_hash, published_at) "
+                "VALUES (?, ?, ?, ?)", (*key, now))
+            return True
+        finally:
+            self.connection.execute("COMMIT")
+
+    def release(self, instrument: str, run_number: int, reduction_arguments: Optional[dict]):
+        """
+        Removes the record of the run, e.g. when publishing it failed after it was claimed
+        """
+        self.connection.execute(
+            "DELETE FROM publications WHERE instrument = ? AND run_number = ? AND arguments_hash = ?",
+            (instrument, run_number, arguments_hash(reduction_arguments)))
+
+
+RESOLUTIONS = ResolutionCoalescer()
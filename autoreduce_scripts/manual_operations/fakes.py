@@ -0,0 +1,300 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+In-process stand-ins for ICAT and the Kafka producer, for tests and load tests that run offline.
+
+FakeICATClient answers the Datafile queries of icat_queries from a catalogue generated by
+make_catalogue, and FakePublisher records the messages it is given. Both can be slowed down,
+made to fail some of their calls with the errors the real clients raise, and limited in
+the number of calls they serve at the same time, see FaultInjector.
+"""
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from autoreduce_scripts.manual_operations.archive_resolver import candidate_file_names
+
+# pylint:disable=import-outside-toplevel
+
+# a JPQL string literal, with its quotes escaped by doubling them
+STRING_LITERAL = re.compile(r"'((?:[^']|'')*)'")
+DATAFILE_QUERY = "SELECT df FROM Datafile df WHERE df.name "
+INSTRUMENT_QUERY = "SELECT i FROM Instrument i"
+
+
+@dataclass
+class CallStats:
+    """
+    What a fake has been asked to do
+    """
+    calls: int = 0
+    errors: int = 0
+    peak_concurrency: int = 0
+    # the total time spent waiting for a free slot, in seconds
+    queued_time: float = 0
+    first_call: Optional[float] = None
+    last_call: Optional[float] = None
+
+
+class FaultInjector:
+    """
+    Adds latency and errors to calls, and limits how many are served at the same time.
+    It can be shared between threads.
+    """
+
+    def __init__(self,
+                 error: Callable[[], Exception],
+                 latency: float = 0,
+                 error_rate: float = 0,
+                 max_concurrency: int = 0,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            error: Makes the error raised by a failing call
+            latency: The number of seconds each call takes
+            error_rate: The fraction of the calls that fail, chosen at random
+            max_concurrency: The number of calls served at the same time, the others wait for a slot.
+                             Unlimited if 0
+            seed: Seeds the choice of the failing calls, so that runs can be repeated
+        """
+        self.error = error
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self.random = random.Random(seed)
+        self.stats = CallStats()
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        queued_at = time.monotonic()
+        if self.slots is not None:
+            self.slots.acquire()  # pylint:disable=consider-using-with
+        with self.lock:
+            now = time.monotonic()
+            self.stats.queued_time += now - queued_at
+            self.stats.calls += 1
+            if self.stats.first_call is None:
+                self.stats.first_call = now
+            self.active += 1
+            self.stats.peak_concurrency = max(self.stats.peak_concurrency, self.active)
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.stats.errors += 1
+        try:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            if fail:
+                raise self.error()
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *_):
+        with self.lock:
+            self.active -= 1
+            self.stats.last_call = time.monotonic()
+        if self.slots is not None:
+            self.slots.release()
+
+
+@dataclass(frozen=True)
+class FakeInstrument:
+    """The part of an ICAT Instrument that the scripts read"""
+    name: str
+    fullName: str  # pylint:disable=invalid-name
+
+
+@dataclass(frozen=True)
+class FakeInvestigation:
+    """The part of an ICAT Investigation that the scripts read"""
+    name: str
+
+
+@dataclass(frozen=True)
+class FakeDataset:
+    """The part of an ICAT Dataset that the scripts read"""
+    investigation: FakeInvestigation
+
+
+@dataclass(frozen=True)
+class FakeDatafile:
+    """The part of an ICAT Datafile that the scripts read"""
+    name: str
+    location: str
+    dataset: FakeDataset
+
+
+def make_catalogue(instrument: str,
+                   run_numbers: Iterable[int],
+                   prefix: Optional[str] = None,
+                   file_ext: str = "nxs",
+                   runs_per_rb: int = 50,
+                   first_rb_number: int = 1920000,
+                   location: Optional[Callable[[str, str], str]] = None) -> Dict[str, FakeDatafile]:
+    """
+    Generates the datafiles of the runs, named like in ICAT, with a new RB number every `runs_per_rb` runs
+
+    Args:
+        instrument: The name of the instrument
+        run_numbers: The runs to make datafiles for
+        prefix: The instrument's prefix. Defaults to its full name
+        file_ext: The extension of the datafiles
+        runs_per_rb: The number of consecutive runs with the same RB number
+        first_rb_number: The RB number of the first runs
+        location: Returns the location of a datafile from its name and RB number.
+                  Defaults to the datafile's path on the archive
+
+    Returns:
+        The datafiles by name
+    """
+    catalogue = {}
+    for index, run_number in enumerate(run_numbers):
+        rb_number = str(first_rb_number + index // runs_per_rb)
+        name = candidate_file_names(instrument, prefix, run_number, file_ext)[0]
+        path = location(name, rb_number) if location else f"/archive/NDX{instrument}/Instrument/data/cycle_22_1/{name}"
+        catalogue[name] = FakeDatafile(name, path, FakeDataset(FakeInvestigation(rb_number)))
+    return catalogue
+
+
+def icat_error() -> Exception:
+    """The error ICAT raises when it fails, which resilience.ICAT retries"""
+    from icat.exception import ICATInternalError
+
+    return ICATInternalError("Injected failure")
+
+
+class FakeICATClient:
+    """
+    An ICAT that answers Datafile queries by name from a catalogue, and Instrument queries.
+    Use it in place of ICATClient.
+    """
+
+    def __init__(self, catalogue: Dict[str, FakeDatafile], prefixes: Optional[Dict[str, str]] = None, **faults):
+        """
+        Args:
+            catalogue: The datafiles by name, see make_catalogue
+            prefixes: The prefix of each instrument, by its full name
+            faults: The latency, error_rate, max_concurrency and seed of the calls, see FaultInjector
+        """
+        self.catalogue = catalogue
+        self.instruments = [FakeInstrument(prefix, name) for name, prefix in (prefixes or {}).items()]
+        self.faults = FaultInjector(icat_error, **faults)
+        self.queries: List[str] = []
+
+    def connect(self):
+        """Does nothing, there is nothing to connect to"""
+
+    def refresh(self):
+        """Does nothing, the session never expires"""
+
+    def disconnect(self):
+        """Does nothing, there is nothing to disconnect from"""
+
+    def execute_query(self, query: str) -> list:
+        """
+        Returns all the instruments, or the datafiles with the names in a query from icat_queries,
+        in the order they are in the query
+
+        Raises:
+            NotImplementedError: If the query isn't one of those
+        """
+        if query != INSTRUMENT_QUERY and not query.startswith(DATAFILE_QUERY):
+            raise NotImplementedError(f"FakeICATClient cannot answer {query}")
+        with self.faults:
+            self.queries.append(query)
+            if query == INSTRUMENT_QUERY:
+                return list(self.instruments)
+            names = (name.replace("''", "'") for name in STRING_LITERAL.findall(query))
+            return [self.catalogue[name] for name in names if name in self.catalogue]
+
+    def get_icat_instrument_prefix(self, instrument_fullname: str) -> str:
+        """
+        Looks up the instrument's prefix like isisicat_prefix_mapping.get_icat_instrument_prefix,
+        which logs in its own ICATClient, so that it can be replaced by this
+
+        Raises:
+            RuntimeError: If the query fails or the instrument isn't known
+        """
+        try:
+            instruments = self.execute_query(INSTRUMENT_QUERY)
+        except Exception as exc:
+            raise RuntimeError("ICAT instrument query failed") from exc
+        instrument = next((x for x in instruments if x.fullName == instrument_fullname), None)
+        if instrument is None:
+            raise RuntimeError(f"Instrument with fullname {instrument_fullname} not found in ICAT.")
+        return instrument.name
+
+
+def kafka_error() -> Exception:
+    """The error the producer raises when its queue is full, which resilience.KAFKA retries"""
+    return BufferError("Injected failure")
+
+
+@dataclass
+class PublishedMessage:
+    """A message given to FakePublisher"""
+    topic: str
+    message: object
+    published_at: float = field(default_factory=time.monotonic)
+
+
+class FakePublisher:
+    """
+    A producer that records the messages it is given. Use it in place of Publisher.
+    """
+
+    def __init__(self, **faults):
+        """
+        Args:
+            faults: The latency, error_rate, max_concurrency and seed of the calls, see FaultInjector
+        """
+        self.faults = FaultInjector(kafka_error, **faults)
+        self.published: List[PublishedMessage] = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, messages, key=None, timeout=2) -> int:  # pylint:disable=unused-argument
+        """
+        Records the messages, like Publisher.publish
+
+        Returns:
+            The number of messages still in the queue, always 0
+        """
+        if not isinstance(messages, list):
+            messages = [messages]
+        with self.faults:
+            # serialize like the real producer, so invalid messages fail the same way
+            for message in messages:
+                message.json()
+            with self.lock:
+                self.published.extend(PublishedMessage(topic, message) for message in messages)
+        return 0
+
+    def throughput(self) -> float:
+        """Returns the number of messages published per second, between the first and last publish"""
+        stats = self.faults.stats
+        if stats.first_call is None or stats.last_call == stats.first_call:
+            return 0
+        return len(self.published) / (stats.last_call - stats.first_call)
+
+
+def write_datafile(path: Path, rb_number: str, title: str):
+    """Writes a NeXus file with the RB number and title stored the same way as in the ISIS datafiles"""
+    import h5py
+    import numpy as np
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, "w") as hdffile:
+        dtype = h5py.special_dtype(vlen=bytes)
+        group = hdffile.create_group("raw_data_1")
+        group.create_dataset("experiment_identifier", data=np.array([rb_number.encode()], dtype=dtype))
+        group.create_dataset("title", data=np.array([title.encode()], dtype=dtype))
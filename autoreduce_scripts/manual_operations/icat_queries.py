@@ -0,0 +1,87 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+The JPQL queries sent to ICAT, built from templates with named parameters, e.g.
+
+DATAFILES_BY_NAME.bind(names=["MAR25581.nxs", "MARI25581.nxs"])
+
+ICAT's search API takes the whole query as one string and has no bound parameters, so the
+values are bound on the client. Each template is parsed once into its literal text and its
+parameters. Strings are bound as JPQL literals with their quotes escaped, so a value can't
+change the query, and lists are bound as IN lists, so one query can look up several values.
+A template always gives the same query shape for the same number of values.
+"""
+import re
+from functools import lru_cache
+from typing import Sequence, Tuple, Union
+
+Value = Union[str, int]
+
+PARAMETER = re.compile(r":(\w+)")
+
+
+def literal(value: Value) -> str:
+    """
+    Returns the value as a JPQL literal
+
+    Raises:
+        TypeError: If the value isn't a string or an int
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise TypeError(f"Cannot bind {value!r} in an ICAT query")
+    if isinstance(value, int):
+        return str(value)
+    return "'" + value.replace("'", "''") + "'"
+
+
+class QueryTemplate:
+    """
+    A query with named parameters, written as :name
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        # the literal text and the parameter names alternate, starting and ending with text
+        self.parts: Tuple[str, ...] = tuple(PARAMETER.split(text))
+
+    @property
+    def parameters(self) -> Tuple[str, ...]:
+        """The names of the parameters, in the order they appear"""
+        return self.parts[1::2]
+
+    def bind(self, **values: Union[Value, Sequence[Value]]) -> str:
+        """
+        Returns the query with the values in place of the parameters.
+        A list or tuple is bound as an IN list, e.g. ('a', 'b')
+
+        Raises:
+            KeyError: If a parameter has no value
+            ValueError: If a list is empty, as JPQL has no empty IN list
+            TypeError: If a value isn't a string or an int, or a list of them
+        """
+        query = list(self.parts)
+        for index in range(1, len(query), 2):
+            value = values[query[index]]
+            if isinstance(value, (list, tuple)):
+                if not value:
+                    raise ValueError(f"Cannot bind an empty list to :{query[index]}")
+                query[index] = "(" + ", ".join(literal(item) for item in value) + ")"
+            else:
+                query[index] = literal(value)
+        return "".join(query)
+
+
+@lru_cache(maxsize=None)
+def query_template(text: str) -> QueryTemplate:
+    """Returns the template of the query, parsed once per process"""
+    return QueryTemplate(text)
+
+
+DATAFILE_BY_NAME = query_template(
+    "SELECT df FROM Datafile df WHERE df.name = :name INCLUDE df.dataset AS ds, ds.investigation")
+DATAFILES_BY_NAME = query_template(
+    "SELECT df FROM Datafile df WHERE df.name IN :names INCLUDE df.dataset AS ds, ds.investigation")
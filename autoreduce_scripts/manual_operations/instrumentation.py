@@ -0,0 +1,291 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Counts and times the slow calls of the manual operations, to find where a submission spends its time.
+
+The calls are grouped into stages:
+    - db_query: each query to the autoreduction DB, through Django's execute_wrapper
+    - icat_query: icat_datafile_query
+    - read_datafile: reading the header of a NeXus file
+    - publish: publishing to Kafka
+    - delete: deleting a reduction run, which includes its db_query calls
+
+Each stage has a latency histogram, and the calls made while a run is being processed are also
+counted against that run. Nothing is recorded unless profiling is on, e.g. with --profile, which
+prints a summary at the end, or --profile_json, which also writes everything to a JSON file:
+
+autoreduce-manual-submission MARI 1234 --profile
+
+The profile being recorded is held in a context variable, so requests profiled at the same time,
+e.g. by the submission service, each get their own. Threads started while profiling must run in
+a copy of the context to record into it, see contextvars.copy_context.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+# pylint:disable=import-outside-toplevel
+
+logger = logging.getLogger(__file__)
+
+# the upper bounds of the histogram buckets, in seconds
+BUCKET_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, float("inf"))
+# the number of runs listed in the summary
+SLOWEST_RUNS = 10
+
+NULL_CONTEXT = nullcontext()
+
+
+class Histogram:
+    """
+    Counts the calls of a stage in buckets of latency
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKET_BOUNDS)
+
+    def observe(self, seconds: float):
+        """Adds a call that took `seconds`"""
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the upper bound of the bucket holding the percentile, or the max if it is in the last bucket"""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        """Returns the histogram as JSON-friendly values, leaving out the empty buckets"""
+        return {
+            "count": self.count,
+            "seconds": self.total,
+            "max_seconds": self.max,
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "buckets": {str(bound): count
+                        for bound, count in zip(BUCKET_BOUNDS, self.buckets) if count},
+        }
+
+
+class Measurement:
+    """
+    Times a call and records it in the profile when it ends
+    """
+
+    def __init__(self, profile: "Profile", stage: str):
+        self.profile = profile
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.profile.record(self.stage, time.perf_counter() - self.started)
+
+
+class Profile:
+    """
+    The histograms of the stages, and the calls of each run. It can be shared between threads.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {}
+        self.runs: Dict[str, Dict[str, dict]] = {}
+        self.lock = threading.Lock()
+        # the run each thread is processing
+        self.local = threading.local()
+
+    @property
+    def current_run(self) -> Optional[str]:
+        """The run the calling thread is processing"""
+        return getattr(self.local, "run", None)
+
+    def measure(self, stage: str) -> Measurement:
+        """Returns a context manager that times a call of the stage"""
+        return Measurement(self, stage)
+
+    def record(self, stage: str, seconds: float):
+        """Records a call of the stage, against the run being processed if there is one"""
+        run = self.current_run
+        with self.lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+            if run is not None:
+                calls = self.runs.setdefault(run, {}).setdefault(stage, {"count": 0, "seconds": 0.0})
+                calls["count"] += 1
+                calls["seconds"] += seconds
+
+    @contextmanager
+    def run(self, name: str) -> Iterator[None]:
+        """Counts the calls made by the calling thread against the run, and records how long it took"""
+        previous, self.local.run = self.current_run, name
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.local.run = previous
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.runs.setdefault(name, {}).setdefault("total", {"seconds": 0.0})["seconds"] += elapsed
+
+    def run_seconds(self, run: str) -> float:
+        """Returns how long the run took to process"""
+        return self.runs[run].get("total", {}).get("seconds", 0.0)
+
+    def slowest_runs(self, limit: int = SLOWEST_RUNS) -> List[str]:
+        """Returns the runs that took the longest, slowest first"""
+        return sorted(self.runs, key=self.run_seconds, reverse=True)[:limit]
+
+    def to_dict(self) -> dict:
+        """Returns the profile as JSON-friendly values"""
+        with self.lock:
+            stages = {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+            runs = {run: {stage: dict(stats) for stage, stats in calls.items()} for run, calls in self.runs.items()}
+        return {"stages": stages, "runs": runs}
+
+    def summary(self) -> str:
+        """Returns a table of the stages, and the slowest runs"""
+        lines = [f"{'stage':<14}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for stage, histogram in sorted(self.stages.items()):
+            mean = histogram.total / histogram.count
+            lines.append(f"{stage:<14}{histogram.count:>8}{histogram.total:>10.3f}{mean * 1000:>10.1f}"
+                         f"{histogram.percentile(0.5) * 1000:>10.1f}{histogram.percentile(0.95) * 1000:>10.1f}"
+                         f"{histogram.max * 1000:>10.1f}")
+        if self.runs:
+            lines.append("slowest runs:")
+        for run in self.slowest_runs():
+            calls = ", ".join(f"{stage} {stats['count']}" for stage, stats in self.runs[run].items()
+                              if stage != "total")
+            lines.append(f"  {run:<20}{self.run_seconds(run):>8.3f} s  {calls}")
+        return "\n".join(lines)
+
+
+# the profile being recorded in the current context, if profiling is on
+_ACTIVE: "ContextVar[Optional[Profile]]" = ContextVar("profile", default=None)
+# the number of profiles recording DB queries, see database_wrapped
+_WRAPPED = 0
+_WRAPPED_LOCK = threading.Lock()
+
+
+def measure(stage: str):
+    """
+    Returns a context manager that times a call of the stage, or does nothing if profiling is off
+    """
+    profile = _ACTIVE.get()
+    return profile.measure(stage) if profile is not None else NULL_CONTEXT
+
+
+def run_scope(name: str):
+    """
+    Returns a context manager that counts the calls made by the calling thread against the run,
+    or does nothing if profiling is off
+    """
+    profile = _ACTIVE.get()
+    return profile.run(name) if profile is not None else NULL_CONTEXT
+
+
+def database_wrapper(execute, sql, params, many, context):
+    """Times the queries of a Django connection, see connection.execute_wrapper"""
+    with measure("db_query"):
+        return execute(sql, params, many, context)
+
+
+def install_database_wrapper(connection, **_):
+    """Adds database_wrapper to the connection, once. Connected to Django's connection_created signal"""
+    if database_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(database_wrapper)
+
+
+@contextmanager
+def database_wrapped() -> Iterator[None]:
+    """
+    Times the queries of the calling thread's connections, and of the connections opened
+    until the end of the block by any thread. The queries are recorded in the profile of the
+    context they are made in. The wrapper stays installed until the last of the blocks
+    running at the same time ends
+    """
+    from django.conf import settings
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+
+    global _WRAPPED  # pylint:disable=global-statement
+
+    with _WRAPPED_LOCK:
+        _WRAPPED += 1
+        connection_created.connect(install_database_wrapper)
+    if settings.configured:
+        for connection in connections.all():
+            install_database_wrapper(connection)
+    try:
+        yield
+    finally:
+        with _WRAPPED_LOCK:
+            _WRAPPED -= 1
+            last = _WRAPPED == 0
+            if last:
+                connection_created.disconnect(install_database_wrapper)
+        if last and settings.configured:
+            for connection in connections.all():
+                if database_wrapper in connection.execute_wrappers:
+                    connection.execute_wrappers.remove(database_wrapper)
+
+
+@contextmanager
+def profiling(enabled: bool = True,
+              json_path: Optional[str] = None,
+              print_summary: bool = True) -> Iterator[Optional[Profile]]:
+    """
+    Records a profile of the calls made in the block, then prints its summary to stderr,
+    and writes it to `json_path` if it is given. A profile that can't be written is logged,
+    so that it doesn't hide an error raised by the block
+
+    Args:
+        enabled: Whether to profile. If False, and there is no json_path, the block runs as usual
+        json_path: The file to write the profile to
+        print_summary: Whether to print the summary, e.g. False if the caller returns it instead
+
+    Yields:
+        The profile, or None if profiling is off
+    """
+    outer = _ACTIVE.get()
+    if not (enabled or json_path) or outer is not None:
+        # nested calls in the same context add to the outer profile
+        yield outer
+        return
+
+    profile = Profile()
+    token = _ACTIVE.set(profile)
+    try:
+        with database_wrapped():
+            yield profile
+    finally:
+        _ACTIVE.reset(token)
+        if print_summary:
+            print(profile.summary(), file=sys.stderr)
+        if json_path:
+            try:
+                Path(json_path).write_text(json.dumps(profile.to_dict(), indent=1), encoding="utf-8")
+            except OSError:
+                logger.exception("Could not write the profile to %s", json_path)
@@ -1,14 +1,34 @@
-import logging
-from typing import Iterable, Optional
+"""
+Submits several runs of an instrument as a single reduction.
+
+Large batches can be split into several batch submissions, so that the reduction cluster can work on
+them in parallel, and each message stays small. With --split_by rb_number each part holds the runs of
+one RB number, with --split_by contiguous each part is a block of consecutive run numbers, and
+--max_batch_size limits the number of runs in each part. They can be combined, e.g.
 
-import fire
+main("MARI", [1, 2, 3, 7, 8], split_by="contiguous", max_batch_size=2)
+
+submits [1, 2], [3] and [7, 8]. The parts are published one after another, and the description of each
+names its part and the ID of the batch it was split from.
+"""
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
-from autoreduce_scripts.manual_operations import setup_django
+from autoreduce_scripts.manual_operations.manual_submission import get_run_data, login_queue, make_message, submit_run
+from autoreduce_scripts.manual_operations.instrumentation import measure, profiling, run_scope
+from autoreduce_scripts.manual_operations.resilience import KAFKA
 
-setup_django()
+# pylint: disable=too-many-locals,too-many-arguments
 
-# pylint:disable=wrong-import-position
-from autoreduce_scripts.manual_operations.manual_submission import get_run_data, login_queue, submit_run
+# the number of runs looked up at the same time
+DEFAULT_WORKERS = 8
+# the ways a batch can be split, besides by size
+SPLIT_BY = ("rb_number", "contiguous")
 
 
 def all_equal(iterator):
@@ -21,48 +41,274 @@ def all_equal(iterator):
     return all(first == x for x in iterator)
 
 
-# pylint: disable=too-many-locals
+def mismatch_message(rb_numbers: Dict[int, str]) -> str:
+    """
+    Describes which runs have which RB number, e.g. "1920000 (runs 1234, 1235), 1930000 (run 1236)"
+    """
+    runs_by_rb: "OrderedDict[str, List[int]]" = OrderedDict()
+    for run, rb_num in sorted(rb_numbers.items()):
+        runs_by_rb.setdefault(rb_num, []).append(run)
+    return ", ".join(f"{rb_num} (run{'s' if len(runs) > 1 else ''} {', '.join(str(run) for run in runs)})"
+                     for rb_num, runs in runs_by_rb.items())
+
+
+def resolve_runs(instrument: str,
+                 runs: List[int],
+                 icat_client=None,
+                 workers: int = DEFAULT_WORKERS,
+                 same_rb_number: bool = True) -> List[Tuple[str, str, str]]:
+    """
+    Looks up the data location, RB number and title of the runs concurrently.
+
+    The runs must all have the same RB number. As soon as a run with a different RB number
+    than the others is found, the runs that haven't been looked up yet are abandoned.
+
+    Args:
+        instrument: The name of the instrument
+        runs: The run numbers
+        icat_client: Client to access the ICAT service. The lookups share it, and take turns
+                     to query it, see manual_submission.icat_client_lock
+        workers: The number of runs looked up at the same time
+        same_rb_number: Whether the runs must have the same RB number
+
+    Returns:
+        The location, RB number and title of each run, in the order of the runs
+
+    Raises:
+        RuntimeError: If the runs have mismatching RB numbers, naming the runs of each RB number,
+                      or the first error raised by a lookup
+    """
+    # pylint:disable=import-outside-toplevel
+    from autoreduce_scripts.autoreduce_django.connections import close_thread_connections
+
+    results: List[Optional[Tuple[str, str, str]]] = [None] * len(runs)
+    rb_numbers: Dict[int, str] = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    next_index = iter(range(len(runs)))
+
+    def take_index() -> Optional[int]:
+        with lock:
+            return None if stop.is_set() else next(next_index, None)
+
+    def work():
+        try:
+            index = take_index()
+            while index is not None:
+                with run_scope(f"{instrument}{runs[index]}"):
+                    run_data = get_run_data(instrument, runs[index], "nxs", icat_client=icat_client)
+                results[index] = run_data
+                with lock:
+                    rb_numbers[runs[index]] = run_data[1]
+                    # compared with the first RB number found, rather than all of them
+                    if same_rb_number and run_data[1] != next(iter(rb_numbers.values())):
+                        stop.set()
+                index = take_index()
+        except Exception:
+            stop.set()
+            raise
+        finally:
+            close_thread_connections()
+
+    workers = max(1, min(workers, len(runs)))
+    with ThreadPoolExecutor(workers) as executor:
+        # each worker runs in a copy of the context, so that its calls are recorded in the caller's profile
+        futures = [executor.submit(copy_context().run, work) for _ in range(workers)]
+    for future in futures:
+        future.result()
+
+    if same_rb_number and not all_equal(rb_numbers.values()):
+        raise RuntimeError(f"Submitted runs have mismatching RB numbers: {mismatch_message(rb_numbers)}")
+    return results
+
+
+def validate_split(max_batch_size: int, split_by: Sequence[str]):
+    """
+    Raises a ValueError if the batch can't be split as asked, see split_batch
+    """
+    unknown = set(split_by) - set(SPLIT_BY)
+    if unknown:
+        raise ValueError(f"Cannot split a batch by {', '.join(sorted(unknown))}. Expected {' or '.join(SPLIT_BY)}")
+    if max_batch_size < 0:
+        raise ValueError("max_batch_size must not be negative")
+
+
+def split_batch(runs: List[int],
+                rb_numbers: List[str],
+                max_batch_size: int = 0,
+                split_by: Sequence[str] = ()) -> List[List[int]]:
+    """
+    Splits a batch into parts
+
+    Args:
+        runs: The run numbers of the batch
+        rb_numbers: The RB number of each run
+        max_batch_size: The maximum number of runs in each part. Unlimited if 0
+        split_by: "rb_number" to split the runs of each RB number into their own parts,
+                  "contiguous" to split the runs into blocks of consecutive run numbers
+
+    Returns:
+        The indices of the runs of each part. The runs keep their order within each part
+    """
+    validate_split(max_batch_size, split_by)
+    parts = [list(range(len(runs)))]
+    if "rb_number" in split_by:
+        by_rb_number: "OrderedDict[str, List[int]]" = OrderedDict()
+        for index in parts[0]:
+            by_rb_number.setdefault(rb_numbers[index], []).append(index)
+        parts = list(by_rb_number.values())
+    if "contiguous" in split_by:
+        blocks = []
+        for part in parts:
+            blocks.append([part[0]])
+            for previous, index in zip(part, part[1:]):
+                if runs[index] == runs[previous] + 1:
+                    blocks[-1].append(index)
+                else:
+                    blocks.append([index])
+        parts = blocks
+    if max_batch_size:
+        parts = [part[start:start + max_batch_size] for part in parts for start in range(0, len(part), max_batch_size)]
+    return parts
+
+
+def submit_parts(publisher, instrument: str, runs: List[int], run_data: List[Tuple[str, str, str]],
+                 parts: List[List[int]], description: str, **submit_kwargs) -> dict:
+    """
+    Publishes the parts of a batch one after another, as one batch submission each.
+
+    Each part is retried on its own, so that a part that has been published isn't published again
+    when a later part fails.
+
+    Args:
+        publisher: The Kafka producer to use to send messages to the queue
+        instrument: The name of the instrument
+        runs: The run numbers of the batch
+        run_data: The location, RB number and title of each run
+        parts: The indices of the runs of each part, see split_batch
+        description: The description of the batch, to which the part is added
+        submit_kwargs: The keyword arguments passed on to make_message, e.g. software
+
+    Returns:
+        A summary of the batch, with its ID and the dict representation of the message of each part
+
+    Raises:
+        RuntimeError: If a part could not be published, naming the parts that were published and those that weren't
+    """
+    if publisher is None:
+        raise RuntimeError("Producer not connected, cannot submit runs")
+
+    batch_id = uuid.uuid4().hex
+    messages = []
+    for number, part in enumerate(parts, start=1):
+        part_runs = [runs[index] for index in part]
+        locations, rb_numbers, titles = (list(values) for values in zip(*[run_data[index] for index in part]))
+        link = f"part {number} of {len(parts)} of batch {batch_id}"
+        messages.append(
+            make_message(rb_numbers[0],
+                         instrument,
+                         locations,
+                         part_runs,
+                         titles,
+                         description=f"{description} ({link})" if description else link.capitalize(),
+                         **submit_kwargs))
+
+    for number, message in enumerate(messages, start=1):
+        try:
+            with measure("publish"):
+                KAFKA.call(publisher.publish, topic="data_ready", messages=[message])
+        except Exception as err:
+            published = [part.run_number for part in messages[:number - 1]]
+            unpublished = [part.run_number for part in messages[number - 1:]]
+            raise RuntimeError(f"Could not publish part {number} of {len(parts)} of batch {batch_id}: {err}. "
+                               f"Published the parts {published}, not the parts {unpublished}") from err
+    summary = {
+        "batch_id": batch_id,
+        "instrument": instrument,
+        "run_number": runs,
+        "parts": [message.to_dict() for message in messages],
+    }
+    logging.getLogger(__file__).info("Submitted batch %s of %s runs in %s parts: %s", batch_id, len(runs), len(parts),
+                                     [message.run_number for message in messages])
+    return summary
+
+
 def main(instrument,
          runs: Iterable[int],
          software: Optional[dict] = None,
          reduction_script: Optional[str] = None,
          reduction_arguments: Optional[dict] = None,
          user_id: int = -1,
-         description: str = ""):
-    """Submits the runs for this instrument as a single reduction"""
-
-    logger = logging.getLogger(__file__)
-    logger.info("Submitting runs %s for instrument %s", runs, instrument)
-    instrument = instrument.upper()
-
-    activemq_client = login_queue()
-    locations, rb_numbers, titles = [], [], []
-    for run in runs:
-        location, rb_num, run_title = get_run_data(instrument, run, "nxs")
-        locations.append(location)
-        rb_numbers.append(rb_num)
-        titles.append(run_title)
-    if not all_equal(rb_numbers):
-        raise RuntimeError("Submitted runs have mismatching RB numbers")
-    return submit_run(activemq_client,
-                      rb_numbers[0],
-                      instrument,
-                      locations,
-                      runs,
-                      run_title=titles,
-                      software=software,
-                      reduction_script=reduction_script,
-                      reduction_arguments=reduction_arguments,
-                      user_id=user_id,
-                      description=description)
+         description: str = "",
+         publisher=None,
+         icat_client=None,
+         workers: int = DEFAULT_WORKERS,
+         max_batch_size: int = 0,
+         split_by: Union[str, Sequence[str]] = (),
+         profile: bool = False,
+         profile_json: Optional[str] = None):
+    """
+    Submits the runs for this instrument as a single reduction, or several if the batch is split
+
+    The publisher and ICAT client are created if they are not given, see manual_submission.main.
+    The runs are looked up `workers` at a time, see resolve_runs. The batch is split
+    by `max_batch_size` and `split_by`, see split_batch. With `profile` or `profile_json`,
+    the calls made are profiled as in manual_submission.main.
+
+    Returns:
+        The dict representation of the message that was submitted, or if the batch was split
+        into several parts, a summary of them, see submit_parts
+    """
+
+    with profiling(profile, profile_json):
+        logger = logging.getLogger(__file__)
+        # the runs may be a generator, which can only be read once
+        runs = list(runs)
+        logger.info("Submitting runs %s for instrument %s", runs, instrument)
+        instrument = instrument.upper()
+
+        split_by = (split_by, ) if isinstance(split_by, str) else tuple(split_by)
+        validate_split(max_batch_size, split_by)
+        activemq_client = publisher if publisher is not None else login_queue()
+        run_data = resolve_runs(instrument,
+                                runs,
+                                icat_client=icat_client,
+                                workers=workers,
+                                same_rb_number="rb_number" not in split_by)
+        locations, rb_numbers, titles = (list(values) for values in zip(*run_data))
+
+        parts = split_batch(runs, rb_numbers, max_batch_size, split_by)
+        if len(parts) > 1:
+            return submit_parts(activemq_client,
+                                instrument,
+                                runs,
+                                run_data,
+                                parts,
+                                description,
+                                software=software,
+                                reduction_script=reduction_script,
+                                reduction_arguments=reduction_arguments,
+                                user_id=user_id)
+        return submit_run(activemq_client,
+                          rb_numbers[0],
+                          instrument,
+                          locations,
+                          runs,
+                          run_title=titles,
+                          software=software,
+                          reduction_script=reduction_script,
+                          reduction_arguments=reduction_arguments,
+                          user_id=user_id,
+                          description=description)
 
 
 def fire_entrypoint():
     """
     Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
     """
+    import fire  # pylint:disable=import-outside-toplevel
     fire.Fire(main)  # pragma: no cover
 
 
 if __name__ == "__main__":
-    fire.Fire(main)  # pragma: no cover
+    fire_entrypoint()  # pragma: no cover
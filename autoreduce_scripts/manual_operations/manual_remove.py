@@ -6,19 +6,18 @@
 # ############################################################################### #
 """
 Functionality to remove a reduction run from the database
+
+Django is set up when a ManualRemove is created rather than on import,
+so that --help and argument validation don't wait for it.
 """
 from __future__ import print_function
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
-import fire
-from django.db import IntegrityError
 from autoreduce_scripts.manual_operations import setup_django
+from autoreduce_scripts.manual_operations.instrumentation import measure, profiling, run_scope
 from autoreduce_scripts.manual_operations.util import get_run_range
 
-setup_django()
-
-# pylint:disable=wrong-import-position,wrong-import-order,invalid-name
-from autoreduce_db.reduction_viewer.models import DataLocation, Instrument, ReductionRun, ReductionLocation
+# pylint:disable=import-outside-toplevel,invalid-name
 
 
 class ManualRemove:
@@ -31,6 +30,7 @@ class ManualRemove:
         Args:
             instrument: The name of the instrument associated with runs
         """
+        setup_django()
         self.database = object()
         self.to_delete = {}
         self.instrument = instrument
@@ -42,6 +42,8 @@ class ManualRemove:
         Args:
             pk: The primary key of the batch run to find
         """
+        from autoreduce_db.reduction_viewer.models import ReductionRun
+
         # put it into list to have the same behaviour as find_run_versions_in_database
         result = [ReductionRun.objects.get(pk=pk)]
         self.to_delete[pk] = result
@@ -56,6 +58,8 @@ class ManualRemove:
         Returns:
             The result of the query
         """
+        from autoreduce_db.reduction_viewer.models import Instrument, ReductionRun
+
         instrument_record, _ = Instrument.objects.get_or_create(name=self.instrument)
         result = ReductionRun.objects \
             .filter(instrument=instrument_record.id) \
@@ -120,6 +124,8 @@ class ManualRemove:
         """
         Delete all records from the database that match those found in self.to_delete
         """
+        from django.db import IntegrityError
+
         # Make a copy to ensure dict being iterated stays same size through processing
         to_delete_copy = self.to_delete.copy()
         for _, job_list in to_delete_copy.items():
@@ -127,7 +133,8 @@ class ManualRemove:
                 print(f'Deleting {run.title()}')
 
                 try:
-                    run.delete()
+                    with measure("delete"):
+                        run.delete()
                 except IntegrityError as err:
                     print(f"Encountered integrity error: {err}\n\n"
                           "Reverting to old behaviour - manual deletion. This can take much longer.")
@@ -147,6 +154,8 @@ class ManualRemove:
         Args:
             reduction_run_id: The id of the associated reduction job
         """
+        from autoreduce_db.reduction_viewer.models import ReductionLocation
+
         ReductionLocation.objects.filter(reduction_run_id=reduction_run_id).delete()
 
     @staticmethod
@@ -157,6 +166,8 @@ class ManualRemove:
         Args:
             reduction_run_id: The id of the associated reduction job
         """
+        from autoreduce_db.reduction_viewer.models import DataLocation
+
         DataLocation.objects.filter(reduction_run_id=reduction_run_id).delete()
 
     @staticmethod
@@ -167,6 +178,8 @@ class ManualRemove:
         Args:
             reduction_run_id: The id of the associated reduction job
         """
+        from autoreduce_db.reduction_viewer.models import ReductionRun
+
         ReductionRun.objects.filter(id=reduction_run_id).delete()
 
     @staticmethod
@@ -218,7 +231,10 @@ def remove(instrument, run_number, delete_all_versions: bool, batch_run: bool):
         batch_run: Changes how to search for the run - normal runs are found by run number,
                    batch runs are found by their primary key, due to lack of a unique run number
     """
+    from autoreduce_scripts.autoreduce_django.connections import refresh_connections
+
     manual_remove = ManualRemove(instrument)
+    refresh_connections()
     if not batch_run:
         manual_remove.find_run_versions_in_database(run_number)
     else:
@@ -251,7 +267,9 @@ def main(instrument: str,
          last_run: int = None,
          delete_all_versions=False,
          no_input=False,
-         batch=False):
+         batch=False,
+         profile: bool = False,
+         profile_json: Optional[str] = None):
     """
     Parse user input and run the script to remove runs for a given instrument
 
@@ -262,6 +280,9 @@ def main(instrument: str,
         last_run: Optional last run to be removed
         delete_all_versions: Deletes all versions for a run without asking
         no_input: Whether to prompt the user when deleting many runs
+        profile: Print how many DB queries and deletes were made, and how long they took, at the end.
+                 See instrumentation
+        profile_json: Also write the profile, with the calls made for each run, to this file
 
     Returns:
         List of run numbers that were submitted.
@@ -276,8 +297,10 @@ def main(instrument: str,
     if not no_input and len(run_numbers) >= 10:
         user_input_check(instrument, run_numbers)
 
-    for run in run_numbers:
-        remove(instrument, run, delete_all_versions, batch)
+    with profiling(profile, profile_json):
+        for run in run_numbers:
+            with run_scope(f"{instrument}{run}"):
+                remove(instrument, run, delete_all_versions, batch)
 
     # ensure the range is generated when returning to the caller
     return list(run_numbers)
@@ -287,8 +310,9 @@ def fire_entrypoint():
     """
     Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
     """
+    import fire
     fire.Fire(main)  # pragma: no cover
 
 
 if __name__ == "__main__":  # pragma: no cover
-    fire.Fire(main)
+    fire_entrypoint()
@@ -6,34 +6,98 @@
 # ############################################################################### #
 """
 A module for creating and submitting manual submissions to autoreduction
+
+Django, h5py, the ICAT client and the Kafka producer are slow to import, so they are only
+imported by the functions that use them. This keeps --help and argument validation fast,
+and runs whose data is already in the database never load h5py or the ICAT client.
 """
-from typing import Iterable, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 import logging
+import threading
+import time
 import traceback
+from contextlib import nullcontext
+from weakref import WeakKeyDictionary
+
+from autoreduce_scripts.manual_operations import archive_index
+from autoreduce_scripts.manual_operations.archive_resolver import candidate_file_names, get_run_data_from_archive
+from autoreduce_scripts.manual_operations.dedupe import RESOLUTIONS, PublicationLog
+from autoreduce_scripts.manual_operations.icat_queries import DATAFILE_BY_NAME, DATAFILES_BY_NAME
+from autoreduce_scripts.manual_operations.instrumentation import measure, profiling, run_scope
+from autoreduce_scripts.manual_operations.miss_cache import default_cache
+from autoreduce_scripts.manual_operations.resilience import DATABASE, ICAT, KAFKA
+from autoreduce_scripts.manual_operations import rb_categories
+from autoreduce_scripts.manual_operations.rb_categories import RBCategory
+from autoreduce_scripts.manual_operations.scheduling import PendingSubmission, SubmissionScheduler, categorize
+from autoreduce_scripts.manual_operations import setup_django
 
-import fire
-import h5py
+if TYPE_CHECKING:
+    from autoreduce_utils.clients.icat_client import ICATClient
+    from autoreduce_utils.clients.producer import Publisher
+    from autoreduce_utils.message.message import Message
 
-from autoreduce_utils.clients.connection_exception import ConnectionException
-from autoreduce_utils.clients.icat_client import ICATClient
-from autoreduce_utils.clients.tools.isisicat_prefix_mapping import get_icat_instrument_prefix
-from autoreduce_utils.message.message import Message
-from autoreduce_utils.clients.producer import Publisher
+# pylint:disable=import-outside-toplevel,no-member,too-many-arguments,too-many-return-statements,too-many-locals
 
-from autoreduce_scripts.manual_operations.rb_categories import RBCategory
-from autoreduce_scripts.manual_operations import setup_django
+logger = logging.getLogger(__file__)
 
-setup_django()
+# the lock of each ICAT client, see icat_client_lock
+_ICAT_CLIENT_LOCKS: "WeakKeyDictionary[object, threading.Lock]" = WeakKeyDictionary()
+_ICAT_CLIENT_LOCKS_LOCK = threading.Lock()
 
-# pylint:disable=wrong-import-order,wrong-import-position,no-member,too-many-arguments,too-many-return-statements
 
-from autoreduce_db.reduction_viewer.models import ReductionRun
+class DatafileNotFoundError(RuntimeError):
+    """Raised when a run's datafile can't be found in ICAT, or was recently not found"""
 
-logger = logging.getLogger(__file__)
+
+class PartialSubmissionError(RuntimeError):
+    """
+    Raised at the end of a submission when some of the runs could not be submitted.
+    The other runs have been submitted.
+    """
+
+    def __init__(self, submitted: list, failed: Dict[Tuple[str, int], Exception]):
+        """
+        Args:
+            submitted: The messages that were submitted
+            failed: The error each run failed with, by instrument and run number
+        """
+        self.submitted = submitted
+        self.failed = failed
+        failures = "\n".join(f"{instrument}{run_number}: {type(err).__name__}: {err}"
+                             for (instrument, run_number), err in failed.items())
+        super().__init__(f"Submitted {len(submitted)} runs, {len(failed)} failed:\n{failures}")
+
+
+def make_message(rb_number: Union[str, List[str]],
+                 instrument: str,
+                 data_file_location: Union[str, List[str]],
+                 run_number: Union[int, Iterable[int]],
+                 run_title: Union[str, List[str]],
+                 software: Optional[dict] = None,
+                 reduction_script: str = None,
+                 reduction_arguments: dict = None,
+                 user_id=-1,
+                 description="") -> "Message":
+    """
+    Makes the message that submits a run, or a batch of runs, for autoreduction. See submit_run
+    """
+    from autoreduce_utils.message.message import Message
+
+    return Message(rb_number=rb_number,
+                   instrument=instrument,
+                   data=data_file_location,
+                   run_number=run_number,
+                   facility="ISIS",
+                   started_by=user_id,
+                   reduction_script=reduction_script,
+                   reduction_arguments=reduction_arguments,
+                   description=description,
+                   run_title=run_title,
+                   software=software)
 
 
 def submit_run(
-    publisher: Publisher,
+    publisher: "Publisher",
     rb_number: Union[str, List[str]],
     instrument: str,
     data_file_location: Union[str, List[str]],
@@ -61,18 +125,18 @@ def submit_run(
     if publisher is None:
         raise RuntimeError("Producer not connected, cannot submit runs")
 
-    message = Message(rb_number=rb_number,
-                      instrument=instrument,
-                      data=data_file_location,
-                      run_number=run_number,
-                      facility="ISIS",
-                      started_by=user_id,
-                      reduction_script=reduction_script,
-                      reduction_arguments=reduction_arguments,
-                      description=description,
-                      run_title=run_title,
-                      software=software)
-    publisher.publish(topic="data_ready", messages=message)
+    message = make_message(rb_number,
+                           instrument,
+                           data_file_location,
+                           run_number,
+                           run_title,
+                           software=software,
+                           reduction_script=reduction_script,
+                           reduction_arguments=reduction_arguments,
+                           user_id=user_id,
+                           description=description)
+    with measure("publish"):
+        KAFKA.call(publisher.publish, topic="data_ready", messages=message)
     logger.info("Submitted run: %s", message.serialize(indent=1))
     return message.to_dict()
 
@@ -86,81 +150,107 @@ def get_run_data_from_database(instrument: str, run_number: int) -> Tuple[Option
         run_number: The run number of the data to be retrieved
     Returns:
          The data file location and rb_number, or None if this information is not in the database
+    Raises:
+        CircuitOpenError: If the database has failed repeatedly, see resilience.DATABASE
     """
 
-    # Find the latest version of a reduction run record to read information from it.
-    # Does NOT include batch runs, instead looks at individual runs
-    reduction_run_record = ReductionRun.objects.filter(instrument__name=instrument,
-                                                       run_numbers__run_number=run_number,
-                                                       batch_run=False).order_by('run_version').first()
+    setup_django()
+    from autoreduce_db.reduction_viewer.models import ReductionRun
+    from autoreduce_scripts.autoreduce_django.connections import refresh_connections
+
+    def query():
+        refresh_connections()
+
+        # Find the latest version of a reduction run record to read information from it.
+        # Does NOT include batch runs, instead looks at individual runs
+        reduction_run_record = ReductionRun.objects.filter(instrument__name=instrument,
+                                                           run_numbers__run_number=run_number,
+                                                           batch_run=False).order_by('run_version').first()
+
+        if not reduction_run_record:
+            return None, None, None
+
+        data_location = reduction_run_record.data_location.first().file_path
+        experiment_number = str(reduction_run_record.experiment.reference_number)
+        run_title = reduction_run_record.run_title
+
+        return data_location, experiment_number, run_title
 
-    if not reduction_run_record:
-        return None, None, None
+    return DATABASE.call(query)
 
-    data_location = reduction_run_record.data_location.first().file_path
-    experiment_number = str(reduction_run_record.experiment.reference_number)
-    run_title = reduction_run_record.run_title
 
-    return data_location, experiment_number, run_title
+def icat_client_lock(icat_client) -> threading.Lock:
+    """
+    Returns the lock of the ICAT client. The suds based client isn't thread safe, and refreshes or
+    logs in again when it is used, so threads sharing a client query it one at a time.
+    """
+    with _ICAT_CLIENT_LOCKS_LOCK:
+        return _ICAT_CLIENT_LOCKS.setdefault(icat_client, threading.Lock())
 
 
-def icat_datafile_query(icat_client, file_name):
+def icat_datafile_query(icat_client, file_name: Union[str, Sequence[str]]):
     """
     Search for file name in icat and return it if it exist.
+    The query is retried if ICAT fails, see resilience.ICAT. The client can be shared between threads,
+    see icat_client_lock.
 
     Args:
         icat_client: Client to access the ICAT service
-        file_name: file name to search for in icat
+        file_name: file name to search for in icat, or a list of file names to search for in one query
     Returns:
-        ICAT datafile entry if found
+        ICAT datafile entries if found
     """
     if icat_client is None:
         raise RuntimeError("ICAT not connected")
 
-    return icat_client.execute_query("SELECT df FROM Datafile df WHERE df.name = '" + file_name +
-                                     "' INCLUDE df.dataset AS ds, ds.investigation")
+    if isinstance(file_name, str):
+        query = DATAFILE_BY_NAME.bind(name=file_name)
+    else:
+        query = DATAFILES_BY_NAME.bind(names=list(file_name))
+
+    def execute_query(query):
+        with icat_client_lock(icat_client):
+            return icat_client.execute_query(query)
 
+    with measure("icat_query"):
+        return ICAT.call(execute_query, query)
 
-def get_run_data_from_icat(instrument, run_number, file_ext) -> Tuple[str, str]:
+
+def get_run_data_from_icat(instrument, run_number, file_ext, icat_client=None) -> Tuple[str, str]:
     """
     Retrieves a run's data-file location and rb_number from ICAT.
-    Attempts first with the default file name, then with prepended zeroes.
+    All the names the datafile could have are looked up in one query. If several are found,
+    the default file name is preferred, then the name with prepended zeroes.
 
     Args:
-        icat_client: Client to access the ICAT service
         instrument: The name of instrument
         run_number: The run number to be processed
         file_ext: The expected file extension
+        icat_client: Client to access the ICAT service. If None, a new one is logged in
 
     Returns:
         The data file location, rb_number (experiment reference) and run_title
-    """
-    icat_client = login_icat()
-
-    # look for file-name assuming file-name uses prefix instrument name
-    icat_instrument_prefix = get_icat_instrument_prefix(instrument)
-    file_name = f"{icat_instrument_prefix}{str(run_number).zfill(5)}.{file_ext}"
-    datafile = icat_datafile_query(icat_client, file_name)
-
-    if not datafile:
-        logger.info("Cannot find datafile '%s' in ICAT. Will try with zeros in front of run number.", file_name)
-        file_name = f"{icat_instrument_prefix}{str(run_number).zfill(8)}.{file_ext}"
-        datafile = icat_datafile_query(icat_client, file_name)
 
-    # look for file-name assuming file-name uses full instrument name
-    if not datafile:
-        logger.info("Cannot find datafile '%s' in ICAT. Will try using full instrument name.", file_name)
-        file_name = f"{instrument}{str(run_number).zfill(5)}.{file_ext}"
-        datafile = icat_datafile_query(icat_client, file_name)
-
-    if not datafile:
-        logger.info("Cannot find datafile '%s' in ICAT. Will try with zeros in front of run number.", file_name)
-        file_name = f"{instrument}{str(run_number).zfill(8)}.{file_ext}"
-        datafile = icat_datafile_query(icat_client, file_name)
+    Raises:
+        DatafileNotFoundError: If none of the names are in ICAT
+    """
+    from autoreduce_utils.clients.tools.isisicat_prefix_mapping import get_icat_instrument_prefix
 
-    if not datafile:
-        raise RuntimeError(f"Cannot find datafile '{file_name}' in ICAT.")
-    return datafile[0].location, datafile[0].dataset.investigation.name  # pylint: disable=unsubscriptable-object
+    if icat_client is None:
+        icat_client = login_icat()
+
+    # look for the file-name with the instrument's prefix, then its full name, with 5 then 8 digits
+    file_names = candidate_file_names(instrument, get_icat_instrument_prefix(instrument), run_number, file_ext)
+    datafiles = {}
+    for datafile in icat_datafile_query(icat_client, file_names) or []:
+        datafiles.setdefault(datafile.name, datafile)
+    for file_name in file_names:
+        if file_name in datafiles:
+            break
+        logger.info("Cannot find datafile '%s' in ICAT.", file_name)
+    else:
+        raise DatafileNotFoundError(f"Cannot find datafile '{file_names[-1]}' in ICAT.")
+    return datafiles[file_name].location, datafiles[file_name].dataset.investigation.name
 
 
 def overwrite_icat_calibration_placeholder(location: str, value: Union[str, int], key: str) -> str:
@@ -178,18 +268,27 @@ def overwrite_icat_calibration_placeholder(location: str, value: Union[str, int]
     return value
 
 
-def get_run_data(instrument: str, run_number: Union[str, int], file_ext: str) -> Tuple[str, str, str]:
+def get_run_data(instrument: str,
+                 run_number: Union[str, int],
+                 file_ext: str,
+                 icat_client: Optional["ICATClient"] = None,
+                 recheck: bool = False) -> Tuple[str, str, str]:
     """
     Retrieves a run's data-file location and rb_number from the auto-reduction database,
-    or ICAT (if it is not in the database)
+    or the archive index or mount (if it is not in the database), or ICAT (if it is not on the archive either)
 
     Args:
         instrument: The name of instrument
         run_number: The run number to be processed
         file_ext: The expected file extension
+        icat_client: Client to access the ICAT service. If None, one is logged in if the run is not in the database
+        recheck: Look the run up in ICAT even if it was recently not found there, see miss_cache
 
     Returns:
         The data file location and rb_number
+
+    Raises:
+        DatafileNotFoundError: If the run can't be found anywhere, or wasn't found recently
     """
     try:
         parsed_run_number = int(run_number)
@@ -201,9 +300,30 @@ def get_run_data(instrument: str, run_number: Union[str, int], file_ext: str) ->
     if data_location is not None and experiment_number is not None and run_title is not None:
         return data_location, experiment_number, run_title
     logger.info("Cannot find datafile for run_number %s in Auto-reduction database. "
-                "Will try ICAT...", parsed_run_number)
+                "Will try the archive...", parsed_run_number)
+
+    run_data = archive_index.lookup(instrument, parsed_run_number) if file_ext == "nxs" else None
+    if run_data is None:
+        run_data = get_run_data_from_archive(instrument, parsed_run_number, file_ext)
+    if run_data is not None:
+        return run_data
+    # only the ICAT query is skipped for recent misses, so a run shows up as soon as it is in the DB or on the archive
+    misses = default_cache()
+    if misses is not None and recheck:
+        misses.forget(instrument, parsed_run_number, file_ext)
+    elif misses is not None:
+        missed_at = misses.missed_at(instrument, parsed_run_number, file_ext)
+        if missed_at is not None:
+            raise DatafileNotFoundError(f"Cannot find datafile for {instrument}{parsed_run_number}, it was not found "
+                                        f"at {time.ctime(missed_at)}. Recheck to look for it again.")
+    logger.info("Cannot find datafile for run_number %s on the archive. Will try ICAT...", parsed_run_number)
 
-    location, rb_num = get_run_data_from_icat(instrument, parsed_run_number, file_ext)
+    try:
+        location, rb_num = get_run_data_from_icat(instrument, parsed_run_number, file_ext, icat_client=icat_client)
+    except DatafileNotFoundError:
+        if misses is not None:
+            misses.record(instrument, parsed_run_number, file_ext)
+        raise
 
     # ICAT seems to do some replacements for calibration runs, overwriting the real RB number & the title
     rb_num = overwrite_icat_calibration_placeholder(location, rb_num, 'experiment_identifier')
@@ -211,13 +331,16 @@ def get_run_data(instrument: str, run_number: Union[str, int], file_ext: str) ->
     return location, rb_num, run_title
 
 
-def login_icat() -> ICATClient:
+def login_icat() -> "ICATClient":
     """
     Log into the ICATClient
 
     Returns:
         The client connected, or None if failed
     """
+    from autoreduce_utils.clients.connection_exception import ConnectionException
+    from autoreduce_utils.clients.icat_client import ICATClient
+
     print("Logging into ICAT")
     icat_client = ICATClient()
     try:
@@ -228,13 +351,15 @@ def login_icat() -> ICATClient:
     return icat_client
 
 
-def login_queue() -> Publisher:
+def login_queue() -> "Publisher":
     """
     Log into the QueueClient
 
     Returns:
         The client connected, or raise exception
     """
+    from autoreduce_utils.clients.producer import Publisher
+
     publisher = Publisher()
     return publisher
 
@@ -264,18 +389,20 @@ def read_from_datafile(location: str, key: str) -> str:
     Returns:
         The RB number read from the datafile
     """
+    import h5py
 
     location = windows_to_linux_path(location)
-    try:
-        nxs_file = h5py.File(location, mode="r")
-    except OSError as err:
-        raise RuntimeError(f"Cannot open file '{location}'") from err
-
-    for (_, entry) in nxs_file.items():
+    with measure("read_datafile"):
         try:
-            return str(entry.get(key)[:][0].decode("utf-8"))
-        except Exception as err:
-            raise RuntimeError("Could not read RB number from datafile") from err
+            nxs_file = h5py.File(location, mode="r")
+        except OSError as err:
+            raise RuntimeError(f"Cannot open file '{location}'") from err
+
+        for (_, entry) in nxs_file.items():
+            try:
+                return str(entry.get(key)[:][0].decode("utf-8"))
+            except Exception as err:
+                raise RuntimeError("Could not read RB number from datafile") from err
     raise RuntimeError(f"Datafile at {location} does not have any items that can be iterated")
 
 
@@ -286,25 +413,147 @@ def categorize_rb_number(rb_num: str):
 
     This is because ICAT will overwrite the real RB number for calibration runs!
     """
-    if len(rb_num) != 7:
-        return RBCategory.UNCATEGORIZED
-
-    if rb_num[2] == "0":
-        return RBCategory.DIRECT_ACCESS
-    elif rb_num[2] in ["1", "2"]:
-        return RBCategory.RAPID_ACCESS
-    elif rb_num[2] == "3" and rb_num[3] == "0":
-        return RBCategory.COMMISSIONING
-    elif rb_num[2] == "3" and rb_num[3] == "5":
-        return RBCategory.CALIBRATION
-    elif rb_num[2] == "5":
-        return RBCategory.INDUSTRIAL_ACCESS
-    elif rb_num[2] == "6":
-        return RBCategory.INTERNATIONAL_PARTNERS
-    elif rb_num[2] == "9":
-        return RBCategory.XPESS_ACCESS
-    else:
-        return RBCategory.UNCATEGORIZED
+    return rb_categories.categorize_rb_number(rb_num)
+
+
+def submit_resolved_run(publisher: "Publisher", instrument: str, run_number: int, run_data: Tuple[str, str, str],
+                        **submit_kwargs) -> Optional[dict]:
+    """
+    Submits a run whose data has been found with get_run_data.
+
+    Args:
+        publisher: The Kafka producer to use to send messages to the queue
+        instrument: The name of the instrument
+        run_number: The run number
+        run_data: The data file location, RB number and run title of the run
+        submit_kwargs: The keyword arguments passed on to submit_run, e.g. software and description
+
+    Returns:
+        The dict representation of the message that was submitted,
+        or None if the run could not be submitted because its RB number or location are unknown or invalid
+    """
+    location, rb_num, run_title = run_data
+    if not location and not rb_num:
+        logger.error("Unable to find RB number and location for %s%s", instrument, run_number)
+        return None
+    try:
+        category = categorize_rb_number(rb_num)
+        logger.info("Run is in category %s", category)
+    except RuntimeError:
+        logger.warning("Could not categorize the run due to an invalid RB number. It will be not be submitted.\n%s",
+                       traceback.format_exc())
+        return None
+
+    return submit_run(publisher, rb_num, instrument, location, run_number, run_title=run_title, **submit_kwargs)
+
+
+def submit_campaign(runs: Mapping[str, Union[int, Iterable[int]]],
+                    weights: Optional[Mapping[Union[RBCategory, str], float]] = None,
+                    rate_limits: Optional[Mapping[Union[RBCategory, str], float]] = None,
+                    publisher: Optional["Publisher"] = None,
+                    icat_client: Optional["ICATClient"] = None,
+                    dedupe_window: float = 0,
+                    force: bool = False,
+                    recheck: bool = False,
+                    **submit_kwargs) -> list:
+    """
+    Looks up all the runs, then publishes them in the order given by a SubmissionScheduler.
+
+    Args:
+        runs: The run numbers to submit for each instrument
+        weights: The weight of each category, see SubmissionScheduler
+        rate_limits: The maximum number of runs per second of each category, see SubmissionScheduler
+        publisher: The Kafka producer to submit with. If None, a new one is created
+        icat_client: Client to access the ICAT service. If None, one is logged in when a run is not in the database
+        dedupe_window: As in main
+        force: As in main
+        recheck: As in main
+        submit_kwargs: The keyword arguments passed on to submit_run, e.g. software and description
+
+    Returns:
+        The messages that were submitted, in the order they were published
+
+    Raises:
+        PartialSubmissionError: If any of the runs failed. The others are still submitted
+    """
+    if publisher is None:
+        publisher = login_queue()
+    reduction_arguments = submit_kwargs.get("reduction_arguments")
+    scheduler = SubmissionScheduler(weights, rate_limits)
+    # runs that have been claimed in the publication log, but not published yet
+    unpublished = set()
+
+    with (PublicationLog(dedupe_window) if dedupe_window > 0 and not force else nullcontext()) as publications:
+
+        def release(instrument, run_number):
+            unpublished.discard((instrument, run_number))
+            if publications is not None:
+                publications.release(instrument, run_number, reduction_arguments)
+
+        submitted_runs = []
+        failed = {}
+        try:
+            for instrument, instrument_runs in runs.items():
+                instrument = instrument.upper()
+                for run_number in ([instrument_runs] if isinstance(instrument_runs, int) else instrument_runs):
+                    if publications is not None and not publications.claim(instrument, run_number, reduction_arguments):
+                        logger.info("Not submitting %s%s as it was submitted in the last %s seconds", instrument,
+                                    run_number, dedupe_window)
+                        continue
+                    unpublished.add((instrument, run_number))
+                    try:
+                        with run_scope(f"{instrument}{run_number}"):
+                            run_data = RESOLUTIONS.resolve((instrument, run_number),
+                                                           get_run_data,
+                                                           instrument,
+                                                           run_number,
+                                                           "nxs",
+                                                           icat_client=icat_client,
+                                                           recheck=recheck)
+                    except Exception as err:  # pylint:disable=broad-except
+                        logger.error("Could not look up %s%s: %s", instrument, run_number, err)
+                        failed[(instrument, run_number)] = err
+                        release(instrument, run_number)
+                        continue
+                    scheduler.add(PendingSubmission(instrument, run_number, run_data, categorize(run_data)))
+
+            logger.info("Publishing %s runs", len(scheduler))
+            for submission in scheduler:
+                try:
+                    with run_scope(f"{submission.instrument}{submission.run_number}"):
+                        message = submit_resolved_run(publisher, submission.instrument, submission.run_number,
+                                                      submission.run_data, **submit_kwargs)
+                except Exception as err:  # pylint:disable=broad-except
+                    logger.error("Could not submit %s%s: %s", submission.instrument, submission.run_number, err)
+                    failed[(submission.instrument, submission.run_number)] = err
+                    message = None
+                if message is None:
+                    release(submission.instrument, submission.run_number)
+                else:
+                    unpublished.discard((submission.instrument, submission.run_number))
+                    submitted_runs.append(message)
+        finally:
+            for instrument, run_number in list(unpublished):
+                release(instrument, run_number)
+    return report_submission(submitted_runs, failed)
+
+
+def report_submission(submitted_runs: list, failed: Dict[Tuple[str, int], Exception]) -> list:
+    """
+    Logs how many runs were submitted, and which failed
+
+    Returns:
+        The submitted runs
+
+    Raises:
+        PartialSubmissionError: If any of the runs failed
+    """
+    if not failed:
+        logger.info("Submitted %s runs", len(submitted_runs))
+        return submitted_runs
+    error = PartialSubmissionError(submitted_runs, failed)
+    logger.error("%s", error)
+    raise error from next(iter(failed.values()))
 
 
 def main(instrument: str,
@@ -313,7 +562,17 @@ def main(instrument: str,
          reduction_script: Optional[str] = None,
          reduction_arguments: Optional[dict] = None,
          user_id=-1,
-         description="") -> list:
+         description="",
+         publisher: Optional["Publisher"] = None,
+         icat_client: Optional["ICATClient"] = None,
+         dedupe_window: float = 0,
+         force: bool = False,
+         schedule: bool = False,
+         priority_weights: Optional[dict] = None,
+         rate_limits: Optional[dict] = None,
+         recheck: bool = False,
+         profile: bool = False,
+         profile_json: Optional[str] = None) -> list:
     """
     Manually submit an instrument run from reduction.
     All run number between `first_run` and `last_run` are submitted.
@@ -332,55 +591,106 @@ def main(instrument: str,
         user_id: The user ID that submitted the request. Using this script directly
                  and the run detection use -1, which is mapped to "Autoreduction service"
         description: A custom description of the run, if provided by the user
+        publisher: The Kafka producer to submit with. If None, a new one is created
+        icat_client: Client to access the ICAT service. If None, one is logged in when a run is not in the database
+        dedupe_window: Runs already published with the same reduction arguments in the last
+                       `dedupe_window` seconds, by any script on this host, are not published again.
+                       Disabled if 0
+        force: Publish the runs even if they were published within the dedupe window
+        schedule: Look up all the runs first, then publish them in order of the priority of their RB category,
+                  see scheduling.SubmissionScheduler. Implied by priority_weights and rate_limits
+        priority_weights: The weight of each RB category when scheduling, e.g. {"calibration": 10}
+        rate_limits: The maximum number of runs per second of each RB category when scheduling
+        recheck: Ask ICAT about runs it recently didn't find again, rather than failing straight away.
+                 See miss_cache
+        profile: Print how many DB and ICAT queries, datafile reads and publishes were made,
+                 and how long they took, at the end. See instrumentation
+        profile_json: Also write the profile, with the calls made for each run, to this file
 
     Returns:
         A list of run numbers that were submitted.
-    """
-
-    instrument = instrument.upper()
-
-    publisher = login_queue()
 
-    submitted_runs = []
-
-    if not isinstance(runs, Iterable):
-        runs = [runs]
+    Raises:
+        PartialSubmissionError: If any of the runs failed, e.g. because ICAT was down or they could not be found.
+                                The other runs are still submitted
+    """
 
-    for run_number in runs:
-        location, rb_num, run_title = get_run_data(instrument, run_number, "nxs")
-        if not location and not rb_num:
-            logger.error("Unable to find RB number and location for %s%s", instrument, run_number)
-            continue
-        try:
-            category = categorize_rb_number(rb_num)
-            logger.info("Run is in category %s", category)
-        except RuntimeError:
-            logger.warning("Could not categorize the run due to an invalid RB number. It will be not be submitted.\n%s",
-                           traceback.format_exc())
-            continue
-
-        submitted_runs.append(
-            submit_run(publisher,
-                       rb_num,
-                       instrument,
-                       location,
-                       run_number,
-                       run_title=run_title,
-                       software=software,
-                       reduction_script=reduction_script,
-                       reduction_arguments=reduction_arguments,
-                       user_id=user_id,
-                       description=description))
-
-    return submitted_runs
+    with profiling(profile, profile_json):
+        instrument = instrument.upper()
+
+        if publisher is None:
+            publisher = login_queue()
+
+        submitted_runs = []
+
+        if not isinstance(runs, Iterable):
+            runs = [runs]
+
+        if schedule or priority_weights or rate_limits:
+            return submit_campaign({instrument: runs},
+                                   priority_weights,
+                                   rate_limits,
+                                   publisher=publisher,
+                                   icat_client=icat_client,
+                                   dedupe_window=dedupe_window,
+                                   force=force,
+                                   recheck=recheck,
+                                   software=software,
+                                   reduction_script=reduction_script,
+                                   reduction_arguments=reduction_arguments,
+                                   user_id=user_id,
+                                   description=description)
+
+        failed = {}
+        with (PublicationLog(dedupe_window) if dedupe_window > 0 and not force else nullcontext()) as publications:
+            for run_number in runs:
+                if publications is not None and not publications.claim(instrument, run_number, reduction_arguments):
+                    logger.info("Not submitting %s%s as it was submitted in the last %s seconds", instrument,
+                                run_number, dedupe_window)
+                    continue
+
+                message = None
+                try:
+                    with run_scope(f"{instrument}{run_number}"):
+                        # overlapping submissions running in other threads share the lookup of the run
+                        run_data = RESOLUTIONS.resolve((instrument, run_number),
+                                                       get_run_data,
+                                                       instrument,
+                                                       run_number,
+                                                       "nxs",
+                                                       icat_client=icat_client,
+                                                       recheck=recheck)
+                        message = submit_resolved_run(publisher,
+                                                      instrument,
+                                                      run_number,
+                                                      run_data,
+                                                      software=software,
+                                                      reduction_script=reduction_script,
+                                                      reduction_arguments=reduction_arguments,
+                                                      user_id=user_id,
+                                                      description=description)
+                except Exception as err:  # pylint:disable=broad-except
+                    # carry on with the other runs, and report the failures at the end
+                    logger.error("Could not submit %s%s: %s", instrument, run_number, err)
+                    failed[(instrument, run_number)] = err
+                finally:
+                    # also released if the submission is interrupted, so the run isn't blocked for the window
+                    if message is None and publications is not None:
+                        publications.release(instrument, run_number, reduction_arguments)
+
+                if message is not None:
+                    submitted_runs.append(message)
+
+        return report_submission(submitted_runs, failed)
 
 
 def fire_entrypoint():
     """
     Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
     """
+    import fire
     fire.Fire(main)  # pragma: no cover
 
 
 if __name__ == "__main__":
-    fire.Fire(main)  # pragma: no cover
+    fire_entrypoint()  # pragma: no cover
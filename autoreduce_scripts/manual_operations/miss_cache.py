@@ -0,0 +1,92 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Remembers the runs that could not be found in the autoreduction DB, on the archive or in ICAT.
+
+Looking up a missing run ends with an ICAT query, the slowest of the lookups, which is paid again
+for every gap each time a range of runs is resubmitted. Misses are recorded in a local SQLite file
+shared by the scripts on the host, and for AUTOREDUCE_MISS_CACHE_TTL seconds (10 minutes by default,
+0 disables the cache) get_run_data doesn't ask ICAT about them again. The DB and the archive are
+still checked first, so a run that has just been ingested is found straight away.
+Pass recheck to ask ICAT again anyway.
+"""
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from autoreduce_scripts.local_store import connect, default_path
+
+DEFAULT_TTL = float(os.environ.get("AUTOREDUCE_MISS_CACHE_TTL", 600))
+DEFAULT_CACHE_PATH = default_path("missing_runs.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS misses (
+    instrument TEXT NOT NULL,
+    run_number INTEGER NOT NULL,
+    file_ext TEXT NOT NULL,
+    missed_at REAL NOT NULL,
+    PRIMARY KEY (instrument, run_number, file_ext)
+);
+"""
+
+
+class MissCache:
+    """
+    Records when runs were last looked up and not found. It can be shared between threads.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, path: Path = DEFAULT_CACHE_PATH):
+        """
+        Args:
+            ttl: The number of seconds a miss is remembered for
+            path: The SQLite file holding the misses
+        """
+        self.ttl = ttl
+        self.connection = connect(path, SCHEMA, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def missed_at(self, instrument: str, run_number: int, file_ext: str) -> Optional[float]:
+        """
+        Returns:
+            When the run was last looked up and not found, or None if it wasn't within the TTL
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT missed_at FROM misses WHERE instrument = ? AND run_number = ? AND file_ext = ?",
+                (instrument, run_number, file_ext)).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        return row[0]
+
+    def record(self, instrument: str, run_number: int, file_ext: str):
+        """Records that the run was just looked up and not found"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO misses (instrument, run_number, file_ext, missed_at) VALUES (?, ?, ?, ?)",
+                (instrument, run_number, file_ext, time.time()))
+            # forget the expired misses, so the file doesn't keep growing
+            self.connection.execute("DELETE FROM misses WHERE missed_at < ?", (time.time() - self.ttl, ))
+
+    def forget(self, instrument: str, run_number: int, file_ext: str):
+        """Removes the record of a miss, e.g. because the run has been found"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM misses WHERE instrument = ? AND run_number = ? AND file_ext = ?",
+                                    (instrument, run_number, file_ext))
+
+
+@lru_cache(maxsize=None)
+def open_cache(ttl: float, path: Path) -> MissCache:
+    """Returns the cache at the path, opened once per process"""
+    return MissCache(ttl, path)
+
+
+def default_cache() -> Optional[MissCache]:
+    """Returns the cache of the host, or None if it is disabled"""
+    return open_cache(DEFAULT_TTL, DEFAULT_CACHE_PATH) if DEFAULT_TTL > 0 else None
@@ -1,4 +1,20 @@
+"""
+The categories of RB numbers, and the rules for categorizing them by their digits.
+
+categorize_rb_numbers categorizes arrays of RB numbers at once with NumPy, for reports over
+many historical runs. NumPy is only imported when it is used, to keep the scripts quick to start.
+"""
 from enum import Enum
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# pylint:disable=import-outside-toplevel,too-many-return-statements
+
+# the length of a categorizable RB number, e.g. 1920000
+RB_NUMBER_LENGTH = 7
 
 
 class RBCategory(Enum):
@@ -10,3 +26,104 @@ class RBCategory(Enum):
     INTERNATIONAL_PARTNERS = "international_partners"
     XPESS_ACCESS = "xpess_access"
     UNCATEGORIZED = "uncategorized"
+
+
+# the categories in the order of their codes, as returned by categorize_rb_numbers
+CATEGORIES = tuple(RBCategory)
+CATEGORY_CODES = {category: code for code, category in enumerate(CATEGORIES)}
+
+
+def categorize_digits(third: str, fourth: str) -> RBCategory:
+    """
+    Map the third and fourth characters of a 7 digit RB number to its category
+    """
+    if third == "0":
+        return RBCategory.DIRECT_ACCESS
+    elif third in ["1", "2"]:
+        return RBCategory.RAPID_ACCESS
+    elif third == "3" and fourth == "0":
+        return RBCategory.COMMISSIONING
+    elif third == "3" and fourth == "5":
+        return RBCategory.CALIBRATION
+    elif third == "5":
+        return RBCategory.INDUSTRIAL_ACCESS
+    elif third == "6":
+        return RBCategory.INTERNATIONAL_PARTNERS
+    elif third == "9":
+        return RBCategory.XPESS_ACCESS
+    else:
+        return RBCategory.UNCATEGORIZED
+
+
+def categorize_rb_number(rb_number: Union[str, int, None]) -> RBCategory:
+    """
+    Categorize a single RB number. RB numbers that aren't 7 characters long, or are missing, are uncategorized
+    """
+    rb_number = str(rb_number or "")
+    if len(rb_number) != RB_NUMBER_LENGTH:
+        return RBCategory.UNCATEGORIZED
+    return categorize_digits(rb_number[2], rb_number[3])
+
+
+@lru_cache(maxsize=None)
+def lookup_table() -> "np.ndarray":
+    """
+    Returns the category codes of every pair of third and fourth characters, indexed by their code points.
+    Code points above 255 are looked up as 255, which is not a digit.
+    """
+    import numpy as np
+
+    table = np.empty((256, 256), dtype=np.uint8)
+    for third in range(256):
+        for fourth in range(256):
+            table[third, fourth] = CATEGORY_CODES[categorize_digits(chr(third), chr(fourth))]
+    return table
+
+
+def categorize_rb_numbers(rb_numbers: Union[Iterable, "np.ndarray"]) -> "np.ndarray":
+    """
+    Categorize many RB numbers at once, following the same rules as categorize_rb_number.
+
+    Args:
+        rb_numbers: The RB numbers, as strings or integers
+
+    Returns:
+        The code of the category of each RB number, indexing CATEGORIES
+    """
+    import numpy as np
+
+    rb_numbers = np.asarray(rb_numbers if isinstance(rb_numbers, np.ndarray) else list(rb_numbers))
+    if rb_numbers.dtype.kind != "U":
+        rb_numbers = rb_numbers.astype(str)
+    rb_numbers = rb_numbers.ravel()
+    width = rb_numbers.dtype.itemsize // 4
+    uncategorized = CATEGORY_CODES[RBCategory.UNCATEGORIZED]
+    if width < RB_NUMBER_LENGTH:
+        return np.full(len(rb_numbers), uncategorized, dtype=np.uint8)
+
+    # each row holds the code points of one RB number, padded with zeros
+    characters = np.ascontiguousarray(rb_numbers).view(np.uint32).reshape(len(rb_numbers), width)
+    has_length = characters[:, RB_NUMBER_LENGTH - 1] != 0
+    if width > RB_NUMBER_LENGTH:
+        has_length &= characters[:, RB_NUMBER_LENGTH] == 0
+
+    third, fourth = (np.minimum(characters[:, index], 255) for index in (2, 3))
+    codes = lookup_table()[third, fourth]
+    codes[~has_length] = uncategorized
+    return codes
+
+
+def count_categories(codes: "np.ndarray") -> Dict[RBCategory, int]:
+    """
+    Count the RB numbers in each category
+
+    Args:
+        codes: The category codes returned by categorize_rb_numbers
+
+    Returns:
+        The number of RB numbers in each category, including the categories without any
+    """
+    import numpy as np
+
+    counts = np.bincount(codes, minlength=len(CATEGORIES))
+    return {category: int(count) for category, count in zip(CATEGORIES, counts)}
@@ -0,0 +1,207 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Retries and circuit breakers for the backends the submission scripts depend on: ICAT,
+the autoreduction DB and Kafka.
+
+A call that fails with one of the backend's transient errors is retried with exponential
+backoff and full jitter, up to the policy's number of attempts. When several calls in a row
+have failed after all their attempts, the backend's circuit breaker opens, and calls fail
+straight away with CircuitOpenError instead of waiting on a backend that is down. After the
+reset timeout one trial call is let through, which closes the breaker again if it succeeds.
+
+Errors that aren't transient, e.g. an invalid query, are raised without retrying.
+"""
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple, Type, TypeVar
+
+# pylint:disable=import-outside-toplevel
+
+logger = logging.getLogger(__file__)
+
+T = TypeVar("T")
+Errors = Tuple[Type[BaseException], ...]
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend whose circuit breaker is open"""
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How many times a call is attempted, and how long to wait between the attempts
+    """
+    attempts: int = 4
+    base_delay: float = 0.5
+    max_delay: float = 10
+
+    def delay(self, attempt: int) -> float:
+        """
+        Returns a random delay between 0 and base_delay * 2^attempt, capped at max_delay,
+        so that scripts retrying at the same time don't all hit the backend together
+
+        Args:
+            attempt: The number of attempts that have failed so far, minus one
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a backend after `failure_threshold` calls in a row have failed, for `reset_timeout` seconds.
+    It can be shared between threads.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the breaker has opened and not closed again since"""
+        return self.opened_at is not None
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: If the breaker is open, unless the reset timeout has passed and
+                              no other trial call is in progress
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_in_progress or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Not calling {self.name}, after {self.failures} failed calls in a row")
+            self.trial_in_progress = True
+
+    def record_success(self):
+        """Closes the breaker"""
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("%s is back, closing its circuit breaker", self.name)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        """Opens the breaker if the threshold has been reached, or restarts the timeout if a trial call failed"""
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error("%s failed %s calls in a row, opening its circuit breaker for %s seconds", self.name,
+                                 self.failures, self.reset_timeout)
+                self.opened_at = time.monotonic()
+
+    def abandon_trial(self):
+        """Lets another trial call through, without recording whether the backend is healthy"""
+        with self.lock:
+            self.trial_in_progress = False
+
+    def reset(self):
+        """Closes the breaker and forgets the failures"""
+        self.record_success()
+
+
+class Backend:
+    """
+    A service that is called with retries, behind a circuit breaker
+    """
+
+    def __init__(self,
+                 name: str,
+                 transient_errors: Callable[[], Errors],
+                 policy: RetryPolicy = DEFAULT_POLICY,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            name: The name of the service, for logging
+            transient_errors: Returns the errors that are worth retrying. It is a function so that
+                              the client libraries are only imported when the backend is called
+            policy: The retry policy
+            breaker: The circuit breaker. Defaults to a new one
+        """
+        self.name = name
+        self.transient_errors = transient_errors
+        self.policy = policy
+        self.breaker = breaker or CircuitBreaker(name)
+
+    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Calls the function, retrying it on transient errors
+
+        Raises:
+            CircuitOpenError: If the breaker is open
+            Exception: The error of the last attempt, or the first error that isn't transient
+        """
+        errors = self.transient_errors()
+        self.breaker.before_call()
+        failed_attempts = 0
+        while True:
+            try:
+                result = func(*args, **kwargs)
+            except errors as err:
+                failed_attempts += 1
+                if failed_attempts >= self.policy.attempts:
+                    self.breaker.record_failure()
+                    raise
+                delay = self.policy.delay(failed_attempts - 1)
+                logger.warning("Calling %s failed with %r, retrying in %.1f seconds", self.name, err, delay)
+                time.sleep(delay)
+            except Exception:
+                # the backend answered, even if it was with an error
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # e.g. KeyboardInterrupt, which says nothing about the backend
+                self.breaker.abandon_trial()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+
+def icat_errors() -> Errors:
+    """The errors of the ICAT client that are worth retrying"""
+    from autoreduce_utils.clients.connection_exception import ConnectionException
+    from icat.exception import ICATInternalError, ICATSessionError
+
+    return (ICATInternalError, ICATSessionError, ConnectionException, OSError)
+
+
+def database_errors() -> Errors:
+    """The errors of the DB that are worth retrying"""
+    from django.db import InterfaceError, OperationalError
+
+    return (InterfaceError, OperationalError)
+
+
+def kafka_errors() -> Errors:
+    """The errors of the Kafka producer that are worth retrying"""
+    from confluent_kafka import KafkaException
+
+    return (BufferError, KafkaException)
+
+
+ICAT = Backend("ICAT", icat_errors)
+DATABASE = Backend("the autoreduction DB", database_errors)
+KAFKA = Backend("Kafka", kafka_errors)
+BACKENDS = (ICAT, DATABASE, KAFKA)
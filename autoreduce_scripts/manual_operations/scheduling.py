@@ -0,0 +1,228 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Orders large submission campaigns so that urgent runs are published to data_ready first.
+
+All the runs of a campaign are looked up before any is published. SubmissionScheduler then
+interleaves them by the priority of their RB number's category, e.g. calibration and commissioning
+runs are published ahead of user data without starving it:
+
+- Each category is picked in proportion to its weight, using smooth weighted round robin,
+  so with weights 8 and 2 the order is 4 runs of the first category for each of the second.
+- Within a category, the instruments take turns, so one instrument's backlog doesn't hold up the others.
+- A category can be limited to a number of runs per second. While it is limited, the other
+  categories go ahead.
+
+To resubmit runs of an instrument, publishing at most 1 rapid access run per second:
+
+autoreduce-manual-submission MARI "[1234,1235,1236]" --rate_limits '{"rapid_access": 1}'
+
+manual_submission.submit_campaign schedules the runs of several instruments together.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+from autoreduce_scripts.manual_operations.rb_categories import RBCategory, categorize_rb_number
+
+# the relative priority of the categories. Calibration and commissioning runs are needed
+# to reduce the user data, so they go first
+DEFAULT_WEIGHTS = {
+    RBCategory.CALIBRATION: 8,
+    RBCategory.COMMISSIONING: 8,
+    RBCategory.RAPID_ACCESS: 4,
+    RBCategory.DIRECT_ACCESS: 2,
+    RBCategory.INDUSTRIAL_ACCESS: 2,
+    RBCategory.INTERNATIONAL_PARTNERS: 2,
+    RBCategory.XPESS_ACCESS: 2,
+    RBCategory.UNCATEGORIZED: 1,
+}
+
+
+class TokenBucket:
+    """
+    Limits how often something can happen, to `rate` times per second on average
+    with bursts of up to `capacity` times.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Args:
+            rate: The number of tokens added per second
+            capacity: The maximum number of tokens held. The bucket starts full
+
+        Raises:
+            ValueError: If the rate isn't positive or the capacity is less than 1, as no token would ever be taken
+        """
+        if rate <= 0:
+            raise ValueError(f"The rate must be positive, got {rate}")
+        if capacity < 1:
+            raise ValueError(f"The capacity must be at least 1, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """
+        Returns the number of seconds until a token is available, 0 if one is available now
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a token if one is available, without waiting.
+
+        Returns:
+            Whether a token was taken
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available.
+        """
+        while not self.try_acquire():
+            time.sleep(self.wait_time())
+
+
+def to_category(category: Union[RBCategory, str]) -> RBCategory:
+    """
+    Returns the category, given as an RBCategory or its value or name, e.g. "calibration"
+    """
+    if isinstance(category, RBCategory):
+        return category
+    try:
+        return RBCategory(category.lower())
+    except ValueError as err:
+        raise ValueError(f"Unknown RB category {category}. "
+                         f"Expected one of {', '.join(item.value for item in RBCategory)}") from err
+
+
+@dataclass
+class PendingSubmission:
+    """A run that has been looked up and is waiting to be published"""
+    instrument: str
+    run_number: int
+    run_data: Tuple[str, str, str]
+    category: RBCategory
+
+
+class SubmissionScheduler:
+    """
+    Interleaves pending submissions by the priority of their category, and the instruments
+    within each category, optionally limiting the rate of each category.
+    """
+
+    def __init__(self,
+                 weights: Optional[Mapping[Union[RBCategory, str], float]] = None,
+                 rate_limits: Optional[Mapping[Union[RBCategory, str], float]] = None):
+        """
+        Args:
+            weights: The weight of each category, overriding DEFAULT_WEIGHTS
+            rate_limits: The maximum number of runs per second of each category. Unlimited if not given
+        """
+        self.weights = dict(DEFAULT_WEIGHTS)
+        for category, weight in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError(f"The weight of {category} must be positive")
+            self.weights[to_category(category)] = float(weight)
+        self.buckets = {}
+        for category, rate in (rate_limits or {}).items():
+            if rate <= 0:
+                raise ValueError(f"The rate limit of {category} must be positive")
+            self.buckets[to_category(category)] = TokenBucket(rate, max(1, int(rate)))
+        self.pending: Dict[RBCategory, "OrderedDict[str, deque]"] = {}
+        self.credit: Dict[RBCategory, float] = {category: 0.0 for category in RBCategory}
+
+    def __len__(self) -> int:
+        return sum(len(runs) for instruments in self.pending.values() for runs in instruments.values())
+
+    def add(self, submission: PendingSubmission):
+        """
+        Adds a submission. Submissions of the same instrument and category keep the order they were added in
+        """
+        instruments = self.pending.setdefault(submission.category, OrderedDict())
+        instruments.setdefault(submission.instrument, deque()).append(submission)
+
+    def ready_categories(self) -> Tuple[List[RBCategory], float]:
+        """
+        Returns:
+            The categories with pending submissions that aren't rate limited right now,
+            and if there are none, how long until one of them is
+        """
+        ready, wait = [], float("inf")
+        for category in self.pending:
+            bucket = self.buckets.get(category)
+            category_wait = 0 if bucket is None else bucket.wait_time()
+            if category_wait == 0:
+                ready.append(category)
+            wait = min(wait, category_wait)
+        return ready, wait
+
+    def pick_category(self, ready: List[RBCategory]) -> RBCategory:
+        """
+        Picks the next category with smooth weighted round robin, so that over time each category
+        is picked in proportion to its weight, and the picks of the categories are spread out
+        """
+        for category in ready:
+            self.credit[category] += self.weights[category]
+        # max picks the first of equal credits, so ties go to the category that was added first
+        category = max(ready, key=lambda item: self.credit[item])
+        self.credit[category] -= sum(self.weights[item] for item in ready)
+        return category
+
+    def pop(self, category: RBCategory) -> PendingSubmission:
+        """
+        Takes the next submission of the category, from the instrument whose turn it is
+        """
+        instruments = self.pending[category]
+        instrument, runs = next(iter(instruments.items()))
+        submission = runs.popleft()
+        # the instrument goes to the back of the queue
+        del instruments[instrument]
+        if runs:
+            instruments[instrument] = runs
+        if not instruments:
+            del self.pending[category]
+            self.credit[category] = 0.0
+        return submission
+
+    def __iter__(self) -> Iterator[PendingSubmission]:
+        """
+        Takes the submissions in the order they should be published, waiting while all the
+        pending categories are rate limited
+        """
+        while self.pending:
+            ready, wait = self.ready_categories()
+            if not ready:
+                time.sleep(wait)
+                continue
+            category = self.pick_category(ready)
+            bucket = self.buckets.get(category)
+            if bucket is not None:
+                bucket.acquire()
+            yield self.pop(category)
+
+
+def categorize(run_data: Tuple[str, str, str]) -> RBCategory:
+    """Returns the category of the run's RB number"""
+    return categorize_rb_number(run_data[1])
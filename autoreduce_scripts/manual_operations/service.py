@@ -0,0 +1,282 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+A long running service that submits, batch submits and removes runs on request.
+
+Each manual submission otherwise starts a new process that sets up Django, logs into ICAT
+and creates a Kafka producer before doing any work. The service does that once, keeps the
+connections warm, and takes requests over a local Unix socket. Requests are queued and
+processed at most `rate` per second, with bursts of up to `burst` requests.
+
+Each request is one line of JSON, with the action and the keyword arguments of the script's main:
+
+    {"action": "submit", "args": {"instrument": "MARI", "runs": [1234, 1235]}}
+
+Actions are "submit" (manual_submission), "batch" (manual_batch_submit) and "remove"
+(manual_remove). The response is one line of JSON, either {"ok": true, "result": ...}
+or {"ok": false, "error": "..."}. `request` sends a request and waits for the response.
+
+A request with "profile" set is profiled by the service, and the summary of the profile is
+returned in the response, as {"ok": true, "result": ..., "profile": "..."}, rather than printed
+to the service's stderr. `request` prints it to the client's stderr, as the scripts do.
+A "profile_json" file is written by the service.
+
+The service can't prompt, so removals are always done without asking for confirmation, and
+removing a run with multiple versions fails unless delete_all_versions is set.
+
+The workers share the service's ICAT client, and take turns to query it, see
+manual_submission.icat_client_lock. The socket is only accessible to the user running the service.
+
+To start the service:
+
+autoreduce-submission-service --socket_path /tmp/autoreduce.sock --rate 5
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from autoreduce_scripts.local_store import default_path
+from autoreduce_scripts.manual_operations import manual_batch_submit, manual_remove, manual_submission, setup_django
+from autoreduce_scripts.manual_operations.instrumentation import profiling
+from autoreduce_scripts.manual_operations.scheduling import TokenBucket
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_SOCKET_PATH = default_path("submission_service.sock")
+
+
+class ServiceBusyError(RuntimeError):
+    """Raised when the service's queue is full"""
+
+
+class SubmissionService:
+    """
+    Processes submit, batch and remove requests from a queue with warm ICAT and Kafka connections.
+    """
+
+    def __init__(self, rate: float = 5.0, burst: int = 10, queue_size: int = 100, workers: int = 1):
+        """
+        Args:
+            rate: The average number of requests processed per second
+            burst: The number of requests that can be processed at once after the service has been idle
+            queue_size: The number of requests that can wait. Further requests are refused until there is room
+            workers: The number of requests processed at the same time
+
+        Raises:
+            ValueError: If the rate isn't positive or the burst is less than 1
+        """
+        self.requests: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        self.publisher = None
+        self.icat_client = None
+        self.actions: Dict[str, Callable[..., object]] = {
+            "submit": self.submit,
+            "batch": self.batch,
+            "remove": self.remove,
+        }
+
+    def start(self):
+        """
+        Sets up Django, connects to Kafka and ICAT, and starts processing requests.
+
+        If ICAT can't be reached the service still starts, and requests that need ICAT log in themselves.
+        """
+        setup_django(worker_mode=True)
+        self.publisher = manual_submission.login_queue()
+        try:
+            self.icat_client = manual_submission.login_icat()
+        except RuntimeError:
+            logger.warning("Could not log into ICAT. Requests will try to log in again when they need it.")
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """
+        Stops processing requests once the ones already queued are done
+        """
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def enqueue(self, action: str, args: Optional[dict] = None) -> Future:
+        """
+        Queues a request.
+
+        Args:
+            action: One of submit, batch or remove
+            args: The keyword arguments of the action
+
+        Returns:
+            A future that is resolved with the response of the request, i.e. its "result",
+            and the summary of its "profile" if it was profiled
+
+        Raises:
+            ValueError: If the action is unknown
+            ServiceBusyError: If the queue is full
+        """
+        if action not in self.actions:
+            raise ValueError(f"Unknown action '{action}'. Expected one of {', '.join(self.actions)}")
+        future: Future = Future()
+        try:
+            self.requests.put_nowait((action, args or {}, future))
+        except queue.Full as err:
+            raise ServiceBusyError(f"The service is busy, there are {self.requests.maxsize} requests queued") from err
+        return future
+
+    def _work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            action, args, future = request
+            # anything that fails fails the request, so that the worker carries on with the queue
+            try:
+                self.bucket.acquire()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                with profiling(args.pop("profile", False), args.pop("profile_json", None),
+                               print_summary=False) as profile:
+                    response = {"result": self.actions[action](**args)}
+                if profile is not None:
+                    response["profile"] = profile.summary()
+                future.set_result(response)
+            except Exception as err:  # pylint:disable=broad-except
+                logger.exception("Request %s %s failed", action, args)
+                if not future.cancelled():
+                    future.set_exception(err)
+
+    def submit(self, **kwargs):
+        """Submits runs with manual_submission, using the service's connections"""
+        return manual_submission.main(publisher=self.publisher, icat_client=self.icat_client, **kwargs)
+
+    def batch(self, **kwargs):
+        """Submits runs as a batch with manual_batch_submit, using the service's connections"""
+        return manual_batch_submit.main(publisher=self.publisher, icat_client=self.icat_client, **kwargs)
+
+    @staticmethod
+    def remove(**kwargs):
+        """Removes runs with manual_remove, without prompting for confirmation, whatever no_input the client sent"""
+        kwargs.pop("no_input", None)
+        return manual_remove.main(**kwargs, no_input=True)
+
+
+def make_handler(service: SubmissionService):
+    """
+    Creates a request handler class that passes requests to the service
+    """
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        """Reads one JSON request per line and writes one JSON response per line"""
+
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    response = {"ok": True, **service.enqueue(request["action"], request.get("args")).result()}
+                except Exception as err:  # pylint:disable=broad-except
+                    response = {"ok": False, "error": f"{type(err).__name__}: {err}"}
+                self.wfile.write(json.dumps(response, default=str).encode("utf-8") + b"\n")
+
+    return RequestHandler
+
+
+def request(action: str, socket_path: str = str(DEFAULT_SOCKET_PATH), timeout: Optional[float] = None, **kwargs):
+    """
+    Sends a request to the service and waits for it to be processed.
+    If the request was profiled, the summary of the profile is printed to stderr.
+
+    Args:
+        action: One of submit, batch or remove
+        socket_path: The Unix socket the service listens on
+        timeout: Seconds to wait for the response. Waits indefinitely if None
+        kwargs: The keyword arguments of the action
+
+    Returns:
+        The result of the action
+
+    Raises:
+        RuntimeError: If the request failed
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"action": action, "args": kwargs}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as response_file:
+            response = json.loads(response_file.readline())
+    if not response["ok"]:
+        raise RuntimeError(response["error"])
+    if "profile" in response:
+        print(response["profile"], file=sys.stderr)
+    return response["result"]
+
+
+def create_server(path: Path, service: SubmissionService) -> socketserver.ThreadingUnixStreamServer:
+    """
+    Creates the server listening on the Unix socket at the path. The socket is created with
+    permissions for the current user only, so that no one else can connect in the meantime
+    """
+    previous_umask = os.umask(0o177)
+    try:
+        return socketserver.ThreadingUnixStreamServer(str(path), make_handler(service))
+    finally:
+        os.umask(previous_umask)
+
+
+def main(socket_path: str = str(DEFAULT_SOCKET_PATH),
+         rate: float = 5.0,
+         burst: int = 10,
+         queue_size: int = 100,
+         workers: int = 1):
+    """
+    Runs the service until interrupted.
+
+    Args:
+        socket_path: The Unix socket to listen on. Only the user running the service can connect to it
+        rate: The average number of requests processed per second
+        burst: The number of requests that can be processed at once after the service has been idle
+        queue_size: The number of requests that can wait before further requests are refused
+        workers: The number of requests processed at the same time
+    """
+    path = Path(socket_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        path.unlink()
+
+    service = SubmissionService(rate, burst, queue_size, workers)
+    service.start()
+    server = create_server(path, service)
+    logger.info("Submission service listening on %s", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        path.unlink()
+        service.stop()
+
+
+def fire_entrypoint():
+    """
+    Entrypoint into the Fire CLI interface. Used via setup.py console_scripts
+    """
+    import fire  # pylint:disable=import-outside-toplevel
+    fire.Fire(main)  # pragma: no cover
+
+
+if __name__ == "__main__":
+    fire_entrypoint()  # pragma: no cover
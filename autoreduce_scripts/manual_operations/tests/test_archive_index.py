@@ -0,0 +1,111 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.archive_index import ArchiveIndex, lookup, main
+from autoreduce_scripts.manual_operations.archive_resolver import data_directory, read_header
+from autoreduce_scripts.manual_operations.fakes import write_datafile
+
+
+class ArchiveIndexTest(TestCase):
+    """
+    Test indexing the datafiles on the archive
+    """
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.root = Path(self.tmp_dir.name, "archive")
+        self.index_path = Path(self.tmp_dir.name, "archive_index.sqlite3")
+        self.cycle = data_directory("MARI", self.root) / "cycle_22_1"
+        write_datafile(self.cycle / "MAR01234.nxs", "1920000", "Vanadium")
+        write_datafile(self.cycle / "MAR01235.nxs", "1920000", "Sample")
+        write_datafile(data_directory("WISH", self.root) / "cycle_22_1" / "WISH00038774.nxs", "1920001", "Empty")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_update_is_incremental(self):
+        """
+        Test that only changed directories are listed, and only new files have their header read
+        """
+        index = ArchiveIndex(self.index_path)
+        assert index.update("MARI", self.root) == 2
+        assert index.lookup("MARI", 1234) == (str(self.cycle / "MAR01234.nxs"), "1920000", "Vanadium")
+        assert index.update("MARI", self.root) == 0
+
+        write_datafile(self.cycle / "MAR01236.nxs", "1920000", "Sample 2")
+        (self.cycle / "MAR01234.nxs").unlink()
+        # make sure the directory's mtime changes on file systems with a coarse resolution
+        os.utime(self.cycle, (0, 0))
+        assert index.update("MARI", self.root) == 1
+        assert index.lookup("MARI", 1236)[2] == "Sample 2"
+        assert index.lookup("MARI", 1234) is None
+
+    def test_failed_header_is_retried(self):
+        """
+        Test that a datafile whose header could not be read is retried by the next update,
+        even though the directory hasn't changed
+        """
+        index = ArchiveIndex(self.index_path)
+
+        def fail_for_1235(location: Path):
+            if location.name == "MAR01235.nxs":
+                raise RuntimeError("Could not read")
+            return read_header(location)
+
+        with patch("autoreduce_scripts.manual_operations.archive_index.read_header", side_effect=fail_for_1235):
+            assert index.update("MARI", self.root) == 1
+        assert index.lookup("MARI", 1235) is None
+
+        assert index.update("MARI", self.root) == 1
+        assert index.lookup("MARI", 1235)[2] == "Sample"
+        assert index.update("MARI", self.root) == 0
+
+    def test_headers_are_read_outside_the_transaction(self):
+        """
+        Test that the index isn't locked or in a write transaction while the headers are read from the archive
+        """
+        index = ArchiveIndex(self.index_path)
+
+        def check_unlocked(location: Path):
+            assert not index.lock.locked()
+            assert not index.connection.in_transaction
+            return read_header(location)
+
+        with patch("autoreduce_scripts.manual_operations.archive_index.read_header", side_effect=check_unlocked):
+            assert index.update("MARI", self.root) == 2
+
+    def test_main_and_lookup(self):
+        """
+        Test that main indexes every instrument on the archive, and lookup only returns datafiles that still exist
+        """
+        assert lookup("MARI", 1234, self.index_path) is None
+        main(root=str(self.root), index_path=str(self.index_path))
+
+        assert lookup("WISH", 38774, self.index_path)[1:] == ("1920001", "Empty")
+        assert lookup("MARI", 1235, self.index_path)[1:] == ("1920000", "Sample")
+        (self.cycle / "MAR01235.nxs").unlink()
+        assert lookup("MARI", 1235, self.index_path) is None
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_database",
+           return_value=(None, None, None))
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_archive")
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_icat")
+    def test_get_run_data_uses_index(self, mock_from_icat: Mock, mock_from_archive: Mock, _):
+        """
+        Test that get_run_data finds indexed runs without checking the archive or ICAT
+        """
+        ArchiveIndex(self.index_path).update("MARI", self.root)
+        with patch("autoreduce_scripts.manual_operations.archive_index.DEFAULT_INDEX_PATH", self.index_path):
+            assert ms.get_run_data("MARI", 1234, "nxs")[1:] == ("1920000", "Vanadium")
+        mock_from_archive.assert_not_called()
+        mock_from_icat.assert_not_called()
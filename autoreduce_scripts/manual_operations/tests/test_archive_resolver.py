@@ -0,0 +1,101 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.archive_resolver import (archive_location, candidate_file_names,
+                                                                   cycle_directories, data_directory, find_datafile,
+                                                                   get_run_data_from_archive, instrument_prefix)
+from autoreduce_scripts.manual_operations.fakes import write_datafile
+
+
+class ArchiveResolverTest(TestCase):
+    """
+    Test finding runs on the archive mount
+    """
+
+    def setUp(self) -> None:
+        self.archive = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.root = Path(self.archive.name)
+        self.data_dir = data_directory("MARI", self.root)
+        write_datafile(self.data_dir / "cycle_21_1" / "MAR01234.nxs", "1910000", "Old vanadium")
+        write_datafile(self.data_dir / "cycle_22_1" / "MAR01234.nxs", "1920000", "Vanadium")
+        write_datafile(self.data_dir / "cycle_22_1" / "MARI00001235.nxs", "1920001", "Sample")
+        (self.data_dir / "cycle_22_1" / "MAR01236.nxs").write_text("not a NeXus file")
+        instrument_prefix.cache_clear()
+
+    def tearDown(self) -> None:
+        self.archive.cleanup()
+
+    def test_candidate_file_names(self):
+        """
+        Test that the names are tried in the same order as in ICAT, leaving out the prefix when it isn't known
+        """
+        expected = ["MAR01234.nxs", "MAR00001234.nxs", "MARI01234.nxs", "MARI00001234.nxs"]
+        assert candidate_file_names("MARI", "MAR", 1234, "nxs") == expected
+        assert candidate_file_names("WISH", None, 38774, "nxs") == ["WISH38774.nxs", "WISH00038774.nxs"]
+
+    def test_cycles_and_prefix(self):
+        """
+        Test that cycles are sorted newest first, and the prefix is worked out from the datafiles
+        """
+        (self.data_dir / "cycle_98_1").mkdir()
+        assert [cycle.name for cycle in cycle_directories(self.data_dir)] == ["cycle_22_1", "cycle_21_1", "cycle_98_1"]
+        assert cycle_directories(self.root / "missing") == []
+        assert instrument_prefix(self.data_dir) == "MAR"
+
+    def test_get_run_data_from_archive(self):
+        """
+        Test that the newest datafile is found with any of the names, and misses return None
+        """
+        location, rb_num, title = get_run_data_from_archive("MARI", 1234, "nxs", self.root)
+        assert location == "\\\\isis\\inst$\\NDXMARI\\Instrument\\data\\cycle_22_1\\MAR01234.nxs"
+        assert (rb_num, title) == ("1920000", "Vanadium")
+
+        assert get_run_data_from_archive("MARI", 1235, "nxs", self.root)[1:] == ("1920001", "Sample")
+        assert get_run_data_from_archive("MARI", 1236, "nxs", self.root) is None
+        assert get_run_data_from_archive("MARI", 9999, "nxs", self.root) is None
+        assert get_run_data_from_archive("WISH", 1234, "nxs", self.root) is None
+
+    def test_archive_location(self):
+        """
+        Test that locations are given in the same UNC form as ICAT and the database, which maps back to the mount
+        """
+        path = self.data_dir / "cycle_22_1" / "MAR01234.nxs"
+        location = archive_location(path, self.root)
+        assert location == "\\\\isis\\inst$\\NDXMARI\\Instrument\\data\\cycle_22_1\\MAR01234.nxs"
+        assert ms.windows_to_linux_path(location) == "/isis/NDXMARI/Instrument/data/cycle_22_1/MAR01234.nxs"
+        assert archive_location(Path("/elsewhere/MAR01234.nxs"), self.root) == "/elsewhere/MAR01234.nxs"
+
+    def test_newest_cycles_only(self):
+        """
+        Test that only the newest cycles are searched, so that a miss has a bounded cost
+        """
+        assert find_datafile("MARI", 1234, "nxs", self.root, max_cycles=1).parent.name == "cycle_22_1"
+        (self.data_dir / "cycle_22_1" / "MAR01234.nxs").unlink()
+        assert find_datafile("MARI", 1234, "nxs", self.root, max_cycles=1) is None
+        assert find_datafile("MARI", 1234, "nxs", self.root).parent.name == "cycle_21_1"
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_database",
+           return_value=(None, None, None))
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_icat")
+    def test_get_run_data_skips_icat(self, mock_from_icat: Mock, _):
+        """
+        Test that ICAT is only asked for runs that aren't on the archive
+        """
+        with patch("autoreduce_scripts.manual_operations.archive_resolver.archive_root", return_value=self.root):
+            assert ms.get_run_data("MARI", 1234, "nxs")[1:] == ("1920000", "Vanadium")
+            mock_from_icat.assert_not_called()
+
+            mock_from_icat.return_value = ("/archive/MAR09999.nxs", "1930000")
+            with patch("autoreduce_scripts.manual_operations.manual_submission.read_from_datafile",
+                       return_value="Title"):
+                assert ms.get_run_data("MARI", 9999, "nxs") == ("/archive/MAR09999.nxs", "1930000", "Title")
+            mock_from_icat.assert_called_once()
@@ -0,0 +1,165 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.dedupe import PublicationLog, ResolutionCoalescer, arguments_hash
+
+
+class ResolutionCoalescerTest(TestCase):
+    """
+    Test that concurrent lookups of the same run are shared
+    """
+
+    def test_resolve(self):
+        """
+        Test that threads resolving the same key at the same time share one call, including its exception
+        """
+        started, release = threading.Event(), threading.Event()
+
+        def lookup(run_number):
+            started.set()
+            release.wait(5)
+            if run_number < 0:
+                raise RuntimeError("Invalid run")
+            return run_number
+
+        func = Mock(side_effect=lookup)
+        coalescer = ResolutionCoalescer()
+        with ThreadPoolExecutor(4) as executor:
+            first = executor.submit(coalescer.resolve, 1234, func, 1234)
+            started.wait(5)
+            second = executor.submit(coalescer.resolve, 1234, func, 1234)
+            # give the second thread time to find the call in progress
+            time.sleep(0.1)
+            release.set()
+            assert first.result() == second.result() == 1234
+        func.assert_called_once()
+        assert not coalescer.in_flight
+
+        with self.assertRaises(RuntimeError):
+            coalescer.resolve(-1, func, -1)
+        assert not coalescer.in_flight
+
+
+class PublicationLogTest(TestCase):
+    """
+    Test that publications are suppressed within the window
+    """
+
+    def setUp(self) -> None:
+        self.log_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.path = Path(self.log_dir.name, "publications.sqlite3")
+
+    def tearDown(self) -> None:
+        self.log_dir.cleanup()
+
+    def test_arguments_hash(self):
+        """
+        Test that the hash doesn't depend on the order of the arguments
+        """
+        assert arguments_hash({"a": 1, "b": 2}) == arguments_hash({"b": 2, "a": 1})
+        assert arguments_hash({"a": 1}) != arguments_hash({"a": 2})
+        assert arguments_hash(None) != arguments_hash({})
+
+    @patch("autoreduce_scripts.manual_operations.dedupe.time")
+    def test_claim(self, mock_time: Mock):
+        """
+        Test that a run can only be claimed again once the window has passed, or with different arguments
+        """
+        log = PublicationLog(60, self.path)
+        mock_time.time.return_value = 1000
+        assert log.claim("MARI", 1234, {"ei": 10})
+        assert not log.claim("MARI", 1234, {"ei": 10})
+        assert log.claim("MARI", 1234, {"ei": 20})
+
+        # another process sees the same log
+        assert not PublicationLog(60, self.path).claim("MARI", 1234, {"ei": 10})
+
+        mock_time.time.return_value = 1060
+        assert log.claim("MARI", 1234, {"ei": 10})
+
+    def test_release(self):
+        """
+        Test that a released run can be claimed again straight away
+        """
+        log = PublicationLog(60, self.path)
+        assert log.claim("MARI", 1234, None)
+        log.release("MARI", 1234, None)
+        assert log.claim("MARI", 1234, None)
+
+    def test_close(self):
+        """
+        Test that the log's connection is closed at the end of a with block
+        """
+        with PublicationLog(60, self.path) as log:
+            assert log.claim("MARI", 1234, None)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            log.claim("MARI", 1235, None)
+
+
+@patch("autoreduce_scripts.manual_operations.manual_submission.login_queue")
+@patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data",
+       return_value=("/archive/MARI1234.nxs", "1920000", "Run 1234"))
+@patch("autoreduce_scripts.manual_operations.manual_submission.submit_run")
+class SubmissionDedupeTest(TestCase):
+    """
+    Test that manual_submission.main doesn't publish a run twice within the window
+    """
+
+    def setUp(self) -> None:
+        self.log_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        path = Path(self.log_dir.name, "publications.sqlite3")
+        self.log_patch = patch("autoreduce_scripts.manual_operations.manual_submission.PublicationLog",
+                               side_effect=lambda window: PublicationLog(window, path))
+        self.log_patch.start()
+
+    def tearDown(self) -> None:
+        self.log_patch.stop()
+        self.log_dir.cleanup()
+
+    def test_duplicate_is_skipped(self, mock_submit_run: Mock, *_):
+        """
+        Test that a run submitted again within the window is skipped, unless forced
+        """
+        assert len(ms.main("MARI", [1234], dedupe_window=60)) == 1
+        assert not ms.main("MARI", [1234], dedupe_window=60)
+        assert len(ms.main("MARI", [1234], dedupe_window=60, force=True)) == 1
+        assert mock_submit_run.call_count == 2
+
+    def test_failed_submission_is_released(self, mock_submit_run: Mock, *_):
+        """
+        Test that a run that failed to publish can be submitted again straight away
+        """
+        mock_submit_run.side_effect = [RuntimeError("Kafka is down"), {"run_number": 1234}]
+        with self.assertRaises(RuntimeError):
+            ms.main("MARI", [1234], dedupe_window=60)
+        assert ms.main("MARI", [1234], dedupe_window=60) == [{"run_number": 1234}]
+
+    def test_interrupted_submission_is_released(self, mock_submit_run: Mock, *_):
+        """
+        Test that a run whose submission was interrupted can be submitted again straight away
+        """
+        mock_submit_run.side_effect = [KeyboardInterrupt, {"run_number": 1234}]
+        with self.assertRaises(KeyboardInterrupt):
+            ms.main("MARI", [1234], dedupe_window=60)
+        assert ms.main("MARI", [1234], dedupe_window=60) == [{"run_number": 1234}]
+
+    def test_disabled_by_default(self, mock_submit_run: Mock, *_):
+        """
+        Test that without a window every submission is published
+        """
+        ms.main("MARI", [1234])
+        ms.main("MARI", [1234])
+        assert mock_submit_run.call_count == 2
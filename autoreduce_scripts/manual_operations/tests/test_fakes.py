@@ -0,0 +1,82 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+from icat.exception import ICATInternalError
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.fakes import (FakeICATClient, FakePublisher, FaultInjector, icat_error,
+                                                        make_catalogue)
+from autoreduce_scripts.manual_operations.icat_queries import DATAFILE_BY_NAME
+from autoreduce_scripts.manual_operations.resilience import ICAT
+
+
+class FakesTest(TestCase):
+    """
+    Test the stand-ins for ICAT and Kafka
+    """
+
+    def test_catalogue_queries(self):
+        """
+        Test that the fake ICAT answers the queries built by icat_queries, and the instrument prefix lookup
+        """
+        catalogue = make_catalogue("MARI", range(1, 101), "MAR", runs_per_rb=50)
+        icat_client = FakeICATClient(catalogue, {"MARI": "MAR"})
+        datafiles = icat_client.execute_query(DATAFILE_BY_NAME.bind(name="MAR00051.nxs"))
+        assert [datafile.name for datafile in datafiles] == ["MAR00051.nxs"]
+
+        with patch("autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix",
+                   icat_client.get_icat_instrument_prefix):
+            location, rb_number = ms.get_run_data_from_icat("MARI", 100, "nxs", icat_client=icat_client)
+            with self.assertRaises(ms.DatafileNotFoundError):
+                ms.get_run_data_from_icat("MARI", 101, "nxs", icat_client=icat_client)
+        assert location == "/archive/NDXMARI/Instrument/data/cycle_22_1/MAR00100.nxs"
+        assert rb_number == "1920001"
+        assert len(icat_client.queries) == 5
+        with self.assertRaises(NotImplementedError):
+            icat_client.execute_query("SELECT i FROM Investigation i")
+
+    @patch("autoreduce_scripts.manual_operations.resilience.time")
+    def test_injected_errors_are_retried(self, _):
+        """
+        Test that the injected errors are the ones the backends retry
+        """
+        icat_client = FakeICATClient(make_catalogue("MARI", [1]), error_rate=1)
+        with self.assertRaises(ICATInternalError):
+            ms.icat_datafile_query(icat_client, "MARI00001.nxs")
+        assert icat_client.faults.stats.calls == icat_client.faults.stats.errors == ICAT.policy.attempts
+        ICAT.breaker.reset()
+
+    def test_concurrency_limit(self):
+        """
+        Test that calls over the limit wait for a slot
+        """
+        faults = FaultInjector(icat_error, latency=0.01, max_concurrency=2)
+
+        def call():
+            with faults:
+                pass
+
+        with ThreadPoolExecutor(4) as executor:
+            for _ in range(8):
+                executor.submit(call)
+        assert faults.stats.calls == 8
+        assert faults.stats.peak_concurrency == 2
+        assert faults.stats.queued_time > 0
+
+    def test_publisher(self):
+        """
+        Test that the fake producer records the messages and its throughput
+        """
+        publisher = FakePublisher(latency=0.001)
+        for run_number in (1, 2):
+            ms.submit_run(publisher, "1920000", "MARI", "/archive/MAR1.nxs", run_number, "Title", {"name": "Mantid"})
+        assert [(published.topic, published.message.run_number)
+                for published in publisher.published] == [("data_ready", 1), ("data_ready", 2)]
+        assert publisher.throughput() > 0
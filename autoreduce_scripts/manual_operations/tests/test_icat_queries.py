@@ -0,0 +1,40 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from unittest import TestCase
+
+from autoreduce_scripts.manual_operations.icat_queries import DATAFILE_BY_NAME, literal, query_template
+
+
+class ICATQueriesTest(TestCase):
+    """
+    Test binding values to the ICAT query templates
+    """
+
+    def test_bind(self):
+        """
+        Test that strings are quoted and escaped, and lists are bound as IN lists
+        """
+        template = query_template("SELECT i FROM Investigation i WHERE i.name IN :names AND i.id = :id")
+        assert template is query_template(template.text)
+        assert template.parameters == ("names", "id")
+        assert template.bind(names=["1920000", "RB'1"], id=3) == \
+            "SELECT i FROM Investigation i WHERE i.name IN ('1920000', 'RB''1') AND i.id = 3"
+
+        injected = DATAFILE_BY_NAME.bind(name="x' OR df.name LIKE '%")
+        assert "df.name = 'x'' OR df.name LIKE ''%' INCLUDE" in injected
+
+    def test_invalid_values(self):
+        """
+        Test that values that can't be bound safely are rejected
+        """
+        with self.assertRaises(ValueError):
+            query_template("SELECT df FROM Datafile df WHERE df.name IN :names").bind(names=[])
+        with self.assertRaises(KeyError):
+            DATAFILE_BY_NAME.bind()
+        for value in (None, True, 1.5, object()):
+            with self.assertRaises(TypeError):
+                literal(value)
@@ -0,0 +1,45 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import json
+import subprocess
+import sys
+from unittest import TestCase
+
+from parameterized import parameterized
+
+# Importing a script must not set up Django or load these, they are only needed once a run is processed.
+# The imports took ~0.45s when they included Django setup, h5py and the ICAT client
+HEAVY_MODULES = ["django", "h5py", "fire", "icat", "autoreduce_utils.clients.producer", "autoreduce_db", "numpy"]
+
+LOADED_MODULES = """
+import importlib, json, sys
+importlib.import_module(sys.argv[1])
+print(json.dumps([name for name in sys.argv[2:] if name in sys.modules]))
+"""
+
+
+class ImportTimeTest(TestCase):
+    """
+    Test that importing the manual operation scripts is cheap. Each import is
+    checked in a fresh interpreter, as the test process already has everything loaded.
+    What is loaded is checked rather than how long it takes, which depends on the machine.
+    """
+
+    @parameterized.expand([
+        ["autoreduce_scripts.manual_operations.manual_submission"],
+        ["autoreduce_scripts.manual_operations.manual_remove"],
+        ["autoreduce_scripts.manual_operations.manual_batch_submit"],
+    ])
+    def test_import_is_lazy(self, module: str):
+        """
+        Test that the import doesn't load the heavy dependencies
+        """
+        output = subprocess.run([sys.executable, "-c", LOADED_MODULES, module, *HEAVY_MODULES],
+                                check=True,
+                                capture_output=True,
+                                text=True).stdout
+        assert json.loads(output) == []
@@ -0,0 +1,139 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import io
+import json
+import threading
+from contextlib import redirect_stderr
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from autoreduce_scripts.manual_operations import instrumentation
+from autoreduce_scripts.manual_operations import manual_batch_submit
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.fakes import FakePublisher
+from autoreduce_scripts.manual_operations.instrumentation import Histogram, measure, profiling, run_scope
+
+SOFTWARE = {"name": "Mantid", "version": "6.2.0"}
+
+
+class InstrumentationTest(TestCase):
+    """
+    Test recording the calls of the manual operations
+    """
+
+    def test_histogram(self):
+        """
+        Test that calls are counted in the bucket of their latency, and the percentiles are bucket bounds
+        """
+        histogram = Histogram()
+        for seconds in (0.0005, 0.0015, 0.0015, 0.003, 20):
+            histogram.observe(seconds)
+        assert histogram.to_dict()["buckets"] == {"0.001": 1, "0.002": 2, "0.005": 1, "inf": 1}
+        assert histogram.percentile(0.5) == 0.002
+        assert histogram.percentile(1) == 20
+
+    def test_off_by_default(self):
+        """
+        Test that nothing is recorded unless profiling is on
+        """
+        assert measure("publish") is instrumentation.NULL_CONTEXT
+        assert run_scope("MARI1") is instrumentation.NULL_CONTEXT
+        with profiling(False) as profile:
+            assert profile is None
+
+    def test_database_queries(self):
+        """
+        Test that the DB queries of a run are recorded against it, and the profile is written as JSON
+        """
+        with TemporaryDirectory() as tmp_dir, redirect_stderr(io.StringIO()) as stderr:
+            json_path = Path(tmp_dir, "profile.json")
+            with profiling(json_path=str(json_path)), run_scope("ARMI101"):
+                ms.get_run_data_from_database("ARMI", 101)
+            ms.get_run_data_from_database("ARMI", 101)
+            recorded = json.loads(json_path.read_text(encoding="utf-8"))
+
+        assert recorded["stages"]["db_query"]["count"] == recorded["runs"]["ARMI101"]["db_query"]["count"] > 0
+        assert recorded["runs"]["ARMI101"]["total"]["seconds"] > 0
+        assert "db_query" in stderr.getvalue() and "ARMI101" in stderr.getvalue()
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data",
+           return_value=("/archive/MAR1.nxs", "1920000", "Title"))
+    def test_main_profile(self, _):
+        """
+        Test that main profiles the publishes of each run with --profile
+        """
+        publisher = FakePublisher()
+        with patch("autoreduce_scripts.manual_operations.instrumentation.Profile.summary",
+                   autospec=True,
+                   return_value="") as mock_summary, redirect_stderr(io.StringIO()):
+            ms.main("MARI", [1, 2], software=SOFTWARE, publisher=publisher, profile=True)
+
+        profile = mock_summary.call_args.args[0]
+        assert profile.stages["publish"].count == 2
+        assert [profile.runs[run]["publish"]["count"] for run in ("MARI1", "MARI2")] == [1, 1]
+
+    def test_concurrent_profiles(self):
+        """
+        Test that requests profiled at the same time in different threads each record only their own calls
+        """
+        barrier = threading.Barrier(2)
+        profiles = {}
+
+        def profiled_request(stage: str, calls: int):
+            with profiling() as profile:
+                barrier.wait()
+                for _ in range(calls):
+                    with measure(stage):
+                        pass
+                barrier.wait()
+            profiles[stage] = profile
+
+        with redirect_stderr(io.StringIO()):
+            threads = [
+                threading.Thread(target=profiled_request, args=args) for args in (("publish", 1), ("icat_query", 2))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert profiles["publish"] is not profiles["icat_query"]
+        assert {stage: histogram.count for stage, histogram in profiles["publish"].stages.items()} == {"publish": 1}
+        assert {stage: histogram.count
+                for stage, histogram in profiles["icat_query"].stages.items()} == {
+                    "icat_query": 2
+                }
+        assert measure("publish") is instrumentation.NULL_CONTEXT
+
+    @patch("autoreduce_scripts.manual_operations.manual_batch_submit.submit_run")
+    @patch("autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data",
+           return_value=("/archive/MAR1.nxs", "1920000", "Title"))
+    def test_batch_workers_profile(self, *_):
+        """
+        Test that the lookups made by the workers of a batch are recorded in the profile of the batch
+        """
+        with patch("autoreduce_scripts.manual_operations.instrumentation.Profile.summary",
+                   autospec=True,
+                   return_value="") as mock_summary, redirect_stderr(io.StringIO()):
+            manual_batch_submit.main("MARI", [1, 2, 3], publisher=FakePublisher(), workers=3, profile=True)
+
+        assert set(mock_summary.call_args.args[0].runs) == {"MARI1", "MARI2", "MARI3"}
+
+    def test_json_write_error(self):
+        """
+        Test that a profile that can't be written is logged, without hiding the error raised while profiling
+        """
+        with TemporaryDirectory() as tmp_dir, redirect_stderr(io.StringIO()), \
+                patch("autoreduce_scripts.manual_operations.instrumentation.logger") as mock_logger:
+            json_path = str(Path(tmp_dir, "missing", "profile.json"))
+            with self.assertRaisesRegex(ValueError, "No RB number"):
+                with profiling(json_path=json_path):
+                    raise ValueError("No RB number")
+        mock_logger.exception.assert_called_once_with("Could not write the profile to %s", json_path)
@@ -1,8 +1,13 @@
+import time
+from unittest import TestCase as UnitTestCase
 from unittest.mock import Mock, call, patch
 
 from django.test import TestCase
 
 from autoreduce_scripts.manual_operations.manual_batch_submit import main as submit_batch_main
+from autoreduce_scripts.manual_operations.manual_batch_submit import resolve_runs, split_batch
+from autoreduce_scripts.manual_operations.manual_submission import icat_datafile_query
+from autoreduce_scripts.manual_operations.resilience import KAFKA
 from autoreduce_scripts.manual_operations.tests.test_manual_remove import create_experiment_and_instrument
 
 
@@ -31,9 +36,12 @@ class TestManualBatchSubmission(TestCase):
                           mock_user_id, mock_description)
         mock_login_queue.assert_called_once()
 
-        mock_get_run_data.assert_has_calls(
-            [call(self.instrument.name, runs[0], "nxs"),
-             call(self.instrument.name, runs[1], "nxs")])
+        # the runs are looked up concurrently, so in any order
+        expected_calls = [
+            call(self.instrument.name, runs[0], "nxs", icat_client=None),
+            call(self.instrument.name, runs[1], "nxs", icat_client=None)
+        ]
+        mock_get_run_data.assert_has_calls(expected_calls, any_order=True)
 
         mock_submit_run.assert_called_once_with(mock_login_queue.return_value,
                                                 "test_rb",
@@ -64,8 +72,151 @@ class TestManualBatchSubmission(TestCase):
                               description="")
         mock_login_queue.assert_called_once()
 
-        mock_get_run_data.assert_has_calls(
-            [call(self.instrument.name, runs[0], "nxs"),
-             call(self.instrument.name, runs[1], "nxs")])
+        # the runs are looked up concurrently, so in any order
+        expected_calls = [
+            call(self.instrument.name, runs[0], "nxs", icat_client=None),
+            call(self.instrument.name, runs[1], "nxs", icat_client=None)
+        ]
+        mock_get_run_data.assert_has_calls(expected_calls, any_order=True)
 
         mock_submit_run.assert_not_called()
+
+    @patch('autoreduce_scripts.manual_operations.manual_batch_submit.submit_run')
+    @patch('autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data')
+    def test_mismatch_stops_lookups(self, mock_get_run_data: Mock, mock_submit_run: Mock):
+        """
+        Test that the runs left to look up are abandoned once a mismatching RB number is found,
+        and the error names the runs of each RB number
+        """
+
+        def get_run_data(_, run_number, *__, **___):
+            return ("location", "1930000" if run_number == 2 else "1920000", "title")
+
+        mock_get_run_data.side_effect = get_run_data
+        with self.assertRaisesRegex(RuntimeError, r"1920000 \(run 1\), 1930000 \(run 2\)$"):
+            submit_batch_main(self.instrument.name, list(range(1, 501)), publisher=Mock(), workers=1)
+        assert mock_get_run_data.call_count == 2
+
+        mock_get_run_data.reset_mock()
+        with self.assertRaisesRegex(RuntimeError, r"1930000 \(run 2\)"):
+            submit_batch_main(self.instrument.name, list(range(1, 501)), publisher=Mock(), workers=4)
+        assert mock_get_run_data.call_count < 500
+        mock_submit_run.assert_not_called()
+
+
+class TestSplitBatch(UnitTestCase):
+    """
+    Test splitting oversized batches into several batch submissions
+    """
+
+    def test_split_batch(self):
+        """
+        Test splitting by size, RB number and contiguous blocks, on their own and combined
+        """
+        runs = [1, 2, 3, 7, 8, 9]
+        rb_numbers = ["1920000", "1920000", "1930000", "1920000", "1920000", "1920000"]
+        assert split_batch(runs, rb_numbers) == [[0, 1, 2, 3, 4, 5]]
+        assert split_batch(runs, rb_numbers, max_batch_size=4) == [[0, 1, 2, 3], [4, 5]]
+        assert split_batch(runs, rb_numbers, split_by=["rb_number"]) == [[0, 1, 3, 4, 5], [2]]
+        assert split_batch(runs, rb_numbers, split_by=["contiguous"]) == [[0, 1, 2], [3, 4, 5]]
+        assert split_batch(runs, rb_numbers, max_batch_size=2, split_by=["rb_number", "contiguous"]) == [[0, 1], [3, 4],
+                                                                                                         [5], [2]]
+
+        with self.assertRaises(ValueError):
+            split_batch(runs, rb_numbers, split_by=["title"])
+        with self.assertRaises(ValueError):
+            split_batch(runs, rb_numbers, max_batch_size=-1)
+
+    @patch('autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data')
+    def test_parts_are_published_separately(self, mock_get_run_data: Mock):
+        """
+        Test that the parts are published one at a time, with descriptions naming the batch they were split from
+        """
+
+        def get_run_data(_, run_number, *__, **___):
+            return (f"/archive/MARI{run_number}.nxs", "1930000" if run_number == 3 else "1920000", "title")
+
+        mock_get_run_data.side_effect = get_run_data
+        publisher = Mock()
+        summary = submit_batch_main("mari", [1, 2, 3, 4],
+                                    software={
+                                        "name": "Mantid",
+                                        "version": "6.2.0"
+                                    },
+                                    description="rerun",
+                                    publisher=publisher,
+                                    split_by="rb_number",
+                                    max_batch_size=2)
+
+        assert publisher.publish.call_count == 3
+        messages = [message for args in publisher.publish.call_args_list for message in args.kwargs["messages"]]
+        assert [message.run_number for message in messages] == [[1, 2], [4], [3]]
+        assert [message.rb_number for message in messages] == [1920000, 1920000, 1930000]
+        assert messages[2].data == ["/archive/MARI3.nxs"]
+        assert messages[0].description == f"rerun (part 1 of 3 of batch {summary['batch_id']})"
+        assert summary["run_number"] == [1, 2, 3, 4]
+        assert [part["run_number"] for part in summary["parts"]] == [[1, 2], [4], [3]]
+
+    @patch('autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data',
+           side_effect=lambda _, run_number, *__, **___: (f"/archive/MARI{run_number}.nxs", "1920000", "title"))
+    def test_runs_generator(self, _):
+        """
+        Test that runs given as a generator are read once, and all of them are looked up, split and submitted
+        """
+        summary = submit_batch_main("mari", (run for run in [1, 2, 3]),
+                                    software={
+                                        "name": "Mantid",
+                                        "version": "6.2.0"
+                                    },
+                                    publisher=Mock(),
+                                    max_batch_size=2)
+
+        assert summary["run_number"] == [1, 2, 3]
+        assert [part["run_number"] for part in summary["parts"]] == [[1, 2], [3]]
+
+    @patch("autoreduce_scripts.manual_operations.resilience.time")
+    @patch('autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data',
+           side_effect=lambda _, run_number, *__, **___: (f"/archive/MARI{run_number}.nxs", "1920000", "title"))
+    def test_failed_part_is_not_republished(self, _, __):
+        """
+        Test that a part that fails to publish is retried on its own, without publishing the earlier parts again,
+        and that the error names the parts that were and weren't published
+        """
+        publisher = Mock()
+        attempts = KAFKA.policy.attempts
+        publisher.publish.side_effect = [None, BufferError("queue full"), None] + [BufferError("queue full")] * attempts
+        self.addCleanup(KAFKA.breaker.reset)
+        with self.assertRaises(RuntimeError) as context:
+            submit_batch_main("mari", [1, 2, 3],
+                              software={
+                                  "name": "Mantid",
+                                  "version": "6.2.0"
+                              },
+                              publisher=publisher,
+                              max_batch_size=1)
+
+        published = [args.kwargs["messages"][0].run_number for args in publisher.publish.call_args_list]
+        assert published == [[1], [2], [2]] + [[3]] * attempts
+        assert "Published the parts [[1], [2]], not the parts [[3]]" in str(context.exception)
+
+    def test_workers_share_icat_client(self):
+        """
+        Test that the workers of a batch looking runs up in ICAT take turns to use the shared client
+        """
+        active, overlaps = [], []
+
+        def execute_query(_):
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.pop()
+            return []
+
+        def get_run_data(_, run_number, *__, icat_client):
+            icat_datafile_query(icat_client, f"MAR{run_number}.nxs")
+            return (f"/archive/MARI{run_number}.nxs", "1920000", "title")
+
+        icat_client = Mock(execute_query=Mock(side_effect=execute_query))
+        with patch("autoreduce_scripts.manual_operations.manual_batch_submit.get_run_data", side_effect=get_run_data):
+            resolve_runs("MARI", [1, 2, 3, 4], icat_client=icat_client, workers=4)
+        assert overlaps == [1] * 4
@@ -431,7 +431,7 @@ class TestManualRemove(TestCase):
         Test: The correct query is run and associated records are removed
         When: Calling delete_data_location
         """
-        with patch("autoreduce_scripts.manual_operations.manual_remove.DataLocation") as data_location:
+        with patch("autoreduce_db.reduction_viewer.models.DataLocation") as data_location:
             self.manual_remove.delete_data_location(123)
             data_location.objects.filter.assert_called_once_with(reduction_run_id=123)
 
@@ -440,7 +440,7 @@ class TestManualRemove(TestCase):
         Test: The correct query is run and associated records are removed
         When: Calling delete_reduction_location
         """
-        with patch("autoreduce_scripts.manual_operations.manual_remove.ReductionLocation") as red_location:
+        with patch("autoreduce_db.reduction_viewer.models.ReductionLocation") as red_location:
             self.manual_remove.delete_reduction_location(123)
             red_location.objects.filter.assert_called_once_with(reduction_run_id=123)
 
@@ -449,7 +449,7 @@ class TestManualRemove(TestCase):
         Test: The correct query is run and associated records are removed
         When: Calling delete_reduction_run_location
         """
-        with patch("autoreduce_scripts.manual_operations.manual_remove.ReductionRun") as red_run:
+        with patch("autoreduce_db.reduction_viewer.models.ReductionRun") as red_run:
             self.manual_remove.delete_reduction_run(123)
             red_run.objects.filter.assert_called_once_with(id=123)
 
@@ -7,6 +7,8 @@
 """
 Test cases for the manual job submission script
 """
+import threading
+import time
 from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 from unittest.mock import MagicMock, Mock, patch
@@ -70,14 +72,16 @@ class TestManualSubmission(TestCase):
         mock_query_result = MagicMock(name="mock_query_result")
         mock_query_result.fetchall.side_effect = side_effects
 
-    def make_query_return_object(self, return_from):
+    def make_query_return_object(self, return_from, file_name="instrument-0001.file_ext"):
         """ Creates a MagicMock object in a format which mimics the format of
         an object returned from a query to ICAT or the auto-reduction database
         :param return_from: A string representing what type of return object
         to be mocked
+        :param file_name: The name of the datafile returned from ICAT
         :return: The formatted MagicMock object """
         ret_obj = [MagicMock(name="Return object")]
         if return_from == "icat":
+            ret_obj[0].name = file_name
             ret_obj[0].location = self.valid_return[0]
             ret_obj[0].dataset.investigation.name = self.valid_return[1]
         elif return_from == "db_location":
@@ -136,7 +140,7 @@ class TestManualSubmission(TestCase):
         self.assertEqual(expected, actual)
 
     @patch('autoreduce_scripts.manual_operations.manual_submission.login_icat')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.get_icat_instrument_prefix')
+    @patch('autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix')
     def test_get_from_icat_when_file_exists_without_zeroes(self, _, login_icat: Mock):
         """
         Test: Data for a given run can be retrieved from ICAT in the expected format
@@ -148,7 +152,7 @@ class TestManualSubmission(TestCase):
         self.assertEqual((loc, rb_num), self.valid_return)
 
     @patch('autoreduce_scripts.manual_operations.manual_submission.login_icat')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.get_icat_instrument_prefix', return_value='MAR')
+    @patch('autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix', return_value='MAR')
     def test_icat_uses_prefix_mapper(self, _, login_icat: Mock):
         """
         Test: The instrument shorthand name is used
@@ -156,6 +160,7 @@ class TestManualSubmission(TestCase):
         """
         icat_client = login_icat.return_value
         data_file = Mock()
+        data_file.name = 'MAR00123.nxs'
         data_file.location = 'location'
         data_file.dataset.investigation.name = 'inv_name'
         # Add return here to ensure we do NOT try fall through cases
@@ -165,31 +170,30 @@ class TestManualSubmission(TestCase):
         self.assertEqual('location', actual_loc)
         self.assertEqual('inv_name', actual_inv_name)
         login_icat.assert_called_once()
-        icat_client.execute_query.assert_called_once_with("SELECT df FROM Datafile df WHERE"
-                                                          " df.name = 'MAR00123.nxs' INCLUDE"
-                                                          " df.dataset AS ds, ds.investigation")
+        icat_client.execute_query.assert_called_once_with(
+            "SELECT df FROM Datafile df WHERE df.name IN ('MAR00123.nxs', 'MAR00000123.nxs', 'MARI00123.nxs', "
+            "'MARI00000123.nxs') INCLUDE df.dataset AS ds, ds.investigation")
 
     @patch('autoreduce_scripts.manual_operations.manual_submission.login_icat')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.get_icat_instrument_prefix')
+    @patch('autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix')
     def test_get_run_data_from_icat_when_first_file_not_found(self, _, login_icat: Mock):
         """
-        Test: that get_run_data_from_icat can handle a number of failed ICAT
-        data file search attempts before it returns valid data file and check that
-        expected format is then still returned.
-        When: get_run_data_from_icat is called and the file is initially not
-        found in ICAT.
+        Test: that get_run_data_from_icat looks up all the file names in one query
+        and returns the datafile found with a later name, in the expected format.
+        When: get_run_data_from_icat is called and the file is only in ICAT
+        under its last name.
         """
-        # icat returns: not found a number of times before file found
-        login_icat.return_value.execute_query.side_effect = [None, None, None, self.make_query_return_object("icat")]
+        login_icat.return_value.execute_query.return_value = self.make_query_return_object(
+            "icat", "instrument-0000001.file_ext")
         # call the method to test
         location_and_rb = ms.get_run_data_from_icat("instrument", -1, "file_ext")
-        # how many times have icat been called
-        self.assertEqual(login_icat.return_value.execute_query.call_count, 4)
+        # icat is only called once, for all the names
+        login_icat.return_value.execute_query.assert_called_once()
         # check returned format is OK
         self.assertEqual(location_and_rb, self.valid_return)
 
     @patch('autoreduce_scripts.manual_operations.manual_submission.login_icat')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.get_icat_instrument_prefix')
+    @patch('autoreduce_utils.clients.tools.isisicat_prefix_mapping.get_icat_instrument_prefix')
     def test_get_run_data_from_icat_raises_runtimeerror(self, _, login_icat: Mock):
         """
         Test: that get_run_data_from_icat can handle a number of failed ICAT
@@ -254,7 +258,7 @@ class TestManualSubmission(TestCase):
         sub_run_args["publisher"].publish.assert_called_with(topic='data_ready', messages=message)
 
     @patch('icat.Client')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.ICATClient.connect')
+    @patch('autoreduce_utils.clients.icat_client.ICATClient.connect')
     def test_icat_login_valid(self, mock_connect, _):
         """
         Test: A valid ICAT client is returned
@@ -266,7 +270,7 @@ class TestManualSubmission(TestCase):
         mock_connect.assert_called_once()
 
     @patch('icat.Client')
-    @patch('autoreduce_scripts.manual_operations.manual_submission.ICATClient.connect')
+    @patch('autoreduce_utils.clients.icat_client.ICATClient.connect')
     def test_icat_login_invalid(self, mock_connect, _):
         """
         Test: None is returned
@@ -278,7 +282,7 @@ class TestManualSubmission(TestCase):
             ms.login_icat()
         mock_connect.assert_called_once()
 
-    @patch('autoreduce_scripts.manual_operations.manual_submission.Publisher.__init__')
+    @patch('autoreduce_utils.clients.producer.Publisher.__init__')
     def test_queue_login_valid(self, _):
         """
         Test: A valid Queue client is returned
@@ -336,7 +340,7 @@ class TestManualSubmission(TestCase):
         # Assert
         assert len(return_value) == 1
         mock_queue.assert_called_once()
-        mock_get_loc.assert_called_once_with('TEST', 1111, "nxs")
+        mock_get_loc.assert_called_once_with('TEST', 1111, "nxs", icat_client=None, recheck=False)
         mock_submit.assert_called_once_with(mock_queue_client,
                                             "2222",
                                             'TEST',
@@ -448,6 +452,27 @@ class TestManualSubmission(TestCase):
         with self.assertRaises(RuntimeError):
             ms.icat_datafile_query(None, "test")
 
+    def test_icat_client_shared_between_threads(self):
+        """
+        Test that threads sharing an ICAT client query it one at a time
+        """
+        active, overlaps = [], []
+
+        def execute_query(_):
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.pop()
+            return []
+
+        icat_client = Mock(execute_query=Mock(side_effect=execute_query))
+        threads = [threading.Thread(target=ms.icat_datafile_query, args=(icat_client, "test")) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert overlaps == [1] * 4
+
     def test_overwrite_icat_calibration_placeholder(self):
         """
         Test that runs with CAL_<some string> get their RB overwritten with
@@ -0,0 +1,74 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.miss_cache import MissCache
+
+
+class MissCacheTest(TestCase):
+    """
+    Test that runs that weren't found are remembered for the TTL
+    """
+
+    def setUp(self) -> None:
+        self.cache_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.path = Path(self.cache_dir.name, "missing_runs.sqlite3")
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    @patch("autoreduce_scripts.manual_operations.miss_cache.time")
+    def test_ttl(self, mock_time: Mock):
+        """
+        Test that a miss is remembered until the TTL has passed, or it is forgotten
+        """
+        cache = MissCache(60, self.path)
+        mock_time.time.return_value = 1000
+        assert cache.missed_at("MARI", 1234, "nxs") is None
+        cache.record("MARI", 1234, "nxs")
+        assert cache.missed_at("MARI", 1234, "nxs") == 1000
+        assert cache.missed_at("MARI", 1234, "raw") is None
+
+        mock_time.time.return_value = 1060
+        assert cache.missed_at("MARI", 1234, "nxs") is None
+
+        mock_time.time.return_value = 1000
+        cache.forget("MARI", 1234, "nxs")
+        assert cache.missed_at("MARI", 1234, "nxs") is None
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_database",
+           return_value=(None, None, None))
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_archive", return_value=None)
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data_from_icat",
+           side_effect=ms.DatafileNotFoundError("Cannot find datafile 'MARI01234.nxs' in ICAT."))
+    def test_get_run_data_skips_known_misses(self, mock_from_icat: Mock, _, mock_from_database: Mock):
+        """
+        Test that ICAT isn't asked again about a run that it didn't find, unless rechecked,
+        but the run is still found as soon as it is in the DB
+        """
+        with patch("autoreduce_scripts.manual_operations.miss_cache.DEFAULT_CACHE_PATH", self.path):
+            with self.assertRaisesRegex(ms.DatafileNotFoundError, "in ICAT"):
+                ms.get_run_data("MARI", 1234, "nxs")
+            with self.assertRaisesRegex(ms.DatafileNotFoundError, "Recheck to look for it again"):
+                ms.get_run_data("MARI", 1234, "nxs")
+            assert mock_from_database.call_count == 2
+            assert mock_from_icat.call_count == 1
+
+            mock_from_database.return_value = ("/archive/MARI01234.nxs", "1920000", "Ingested")
+            assert ms.get_run_data("MARI", 1234, "nxs")[2] == "Ingested"
+            mock_from_database.return_value = (None, None, None)
+
+            mock_from_icat.side_effect = None
+            mock_from_icat.return_value = ("/archive/MARI01234.nxs", "1920000")
+            with patch("autoreduce_scripts.manual_operations.manual_submission.read_from_datafile",
+                       return_value="Title"):
+                assert ms.get_run_data("MARI", 1234, "nxs", recheck=True)[1:] == ("1920000", "Title")
+                assert ms.get_run_data("MARI", 1234, "nxs")[1:] == ("1920000", "Title")
@@ -0,0 +1,84 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.rb_categories import (CATEGORIES, RBCategory, categorize_rb_number,
+                                                                categorize_rb_numbers, count_categories, lookup_table)
+from autoreduce_scripts.manual_operations.scheduling import categorize
+
+RB_NUMBERS = [
+    "2100000", "2110000", "2120000", "2130000", "2135000", "2150000", "2160000", "2190000", "2140000", "2170000",
+    "2180000", "21N0000", "99999999999", "0", "1234", "", "21İ0000"
+]
+
+
+class CategorizeRBNumbersTest(TestCase):
+    """
+    Test that RB numbers are categorized in bulk like they are one at a time
+    """
+
+    def test_matches_categorize_rb_number(self):
+        """
+        Test that every RB number gets the same category as with categorize_rb_number
+        """
+        codes = categorize_rb_numbers(RB_NUMBERS)
+        assert [CATEGORIES[code] for code in codes] == [ms.categorize_rb_number(rb) for rb in RB_NUMBERS]
+
+    def test_single_rb_number(self):
+        """
+        Test that the scheduler and manual submission categorize single RB numbers the same way,
+        including RB numbers read as integers and missing ones
+        """
+        for rb_number in RB_NUMBERS:
+            assert categorize(("location", rb_number, "title")) == ms.categorize_rb_number(rb_number)
+        assert categorize_rb_number(1935000) == RBCategory.CALIBRATION
+        assert categorize_rb_number(None) == RBCategory.UNCATEGORIZED
+
+    def test_integers(self):
+        """
+        Test that RB numbers read as integers are categorized by their digits
+        """
+        codes = categorize_rb_numbers(np.array([1920000, 1935000, 123]))
+        expected = [RBCategory.RAPID_ACCESS, RBCategory.CALIBRATION, RBCategory.UNCATEGORIZED]
+        assert [CATEGORIES[code] for code in codes] == expected
+
+    def test_short_or_empty(self):
+        """
+        Test that arrays too narrow to hold an RB number, or empty, are handled
+        """
+        assert list(categorize_rb_numbers(["123", "4"])) == [CATEGORIES.index(RBCategory.UNCATEGORIZED)] * 2
+        assert len(categorize_rb_numbers([])) == 0
+
+    def test_count_categories(self):
+        """
+        Test that every category is counted, including those without RB numbers
+        """
+        counts = count_categories(categorize_rb_numbers(["1910000", "1920000", "1900000", "1234"]))
+        assert counts[RBCategory.RAPID_ACCESS] == 2
+        assert counts[RBCategory.DIRECT_ACCESS] == 1
+        assert counts[RBCategory.UNCATEGORIZED] == 1
+        assert counts[RBCategory.XPESS_ACCESS] == 0
+        assert set(counts) == set(RBCategory)
+
+    def test_million_runs(self):
+        """
+        Test that a million RB numbers are categorized with array operations, without
+        categorizing any of them one at a time in Python
+        """
+        rb_numbers = np.random.default_rng(0).integers(1000000, 2999999, size=1000000).astype(str)
+        lookup_table()
+        with patch("autoreduce_scripts.manual_operations.rb_categories.categorize_digits") as mock_categorize:
+            codes = categorize_rb_numbers(rb_numbers)
+        mock_categorize.assert_not_called()
+        assert isinstance(codes, np.ndarray) and codes.shape == (1000000, )
+        assert sum(count_categories(codes).values()) == 1000000
+        sample = rb_numbers[::100000]
+        assert [CATEGORIES[code] for code in codes[::100000]] == [ms.categorize_rb_number(rb) for rb in sample]
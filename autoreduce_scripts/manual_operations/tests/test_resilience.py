@@ -0,0 +1,135 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.fakes import FakePublisher
+from autoreduce_scripts.manual_operations.resilience import (BACKENDS, Backend, CircuitBreaker, CircuitOpenError,
+                                                             RetryPolicy)
+
+SOFTWARE = {"name": "Mantid", "version": "6.2.0"}
+RUN_DATA = ("/archive/MAR1.nxs", "1920000", "Title")
+
+
+def flaky(failures: int, error: Exception = ConnectionError("down")) -> Mock:
+    """Returns a function that fails the first `failures` times it is called"""
+    return Mock(side_effect=[error] * failures + ["result"])
+
+
+@patch("autoreduce_scripts.manual_operations.resilience.time")
+class ResilienceTest(TestCase):
+    """
+    Test the retries and circuit breakers around the backends
+    """
+
+    def setUp(self) -> None:
+        self.backend = Backend("test", lambda: (ConnectionError, ), RetryPolicy(attempts=3, base_delay=1, max_delay=3),
+                               CircuitBreaker("test", failure_threshold=2, reset_timeout=60))
+
+    def test_delays(self, _):
+        """
+        Test that the delays grow exponentially up to the maximum, with jitter
+        """
+        policy = RetryPolicy(base_delay=1, max_delay=3)
+        with patch("autoreduce_scripts.manual_operations.resilience.random.uniform", side_effect=max):
+            assert [policy.delay(attempt) for attempt in range(4)] == [1, 2, 3, 3]
+
+    def test_retries_transient_errors(self, mock_time: Mock):
+        """
+        Test that transient errors are retried until the attempts run out, and other errors aren't retried
+        """
+        assert self.backend.call(flaky(2)) == "result"
+        assert mock_time.sleep.call_count == 2
+
+        func = flaky(3)
+        with self.assertRaises(ConnectionError):
+            self.backend.call(func)
+        assert func.call_count == 3
+
+        func = flaky(1, ValueError("invalid query"))
+        with self.assertRaises(ValueError):
+            self.backend.call(func)
+        func.assert_called_once()
+        assert self.backend.breaker.failures == 0
+
+    def test_breaker(self, mock_time: Mock):
+        """
+        Test that the breaker fails fast once open, then lets one trial call through after the timeout
+        """
+        mock_time.monotonic.return_value = 1000
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.backend.call(flaky(3))
+        assert self.backend.breaker.is_open
+
+        func = flaky(0)
+        with self.assertRaises(CircuitOpenError):
+            self.backend.call(func)
+        func.assert_not_called()
+
+        mock_time.monotonic.return_value = 1060
+        with self.assertRaises(ConnectionError):
+            self.backend.call(flaky(3))
+        with self.assertRaises(CircuitOpenError):
+            self.backend.call(func)
+
+        mock_time.monotonic.return_value = 1120
+        assert self.backend.call(func) == "result"
+        assert not self.backend.breaker.is_open
+
+    def test_interrupt_leaves_breaker_alone(self, mock_time: Mock):
+        """
+        Test that an interrupt isn't counted as the backend answering, and doesn't block later trial calls
+        """
+        mock_time.monotonic.return_value = 1000
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.backend.call(flaky(3))
+
+        mock_time.monotonic.return_value = 1060
+        with self.assertRaises(KeyboardInterrupt):
+            self.backend.call(flaky(1, KeyboardInterrupt()))
+        assert self.backend.breaker.is_open
+        assert self.backend.call(flaky(0)) == "result"
+        assert not self.backend.breaker.is_open
+
+
+class PartialSubmissionTest(TestCase):
+    """
+    Test that submissions carry on past failed runs and report them
+    """
+
+    def tearDown(self) -> None:
+        for backend in BACKENDS:
+            backend.breaker.reset()
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data",
+           side_effect=[RUN_DATA, CircuitOpenError("Not calling ICAT"), RUN_DATA])
+    def test_main_reports_failures(self, _):
+        """
+        Test that the runs after a failed one are still submitted, and the failures are raised at the end
+        """
+        publisher = FakePublisher()
+        with self.assertRaises(ms.PartialSubmissionError) as context:
+            ms.main("MARI", [1, 2, 3], software=SOFTWARE, publisher=publisher)
+
+        assert [message["run_number"] for message in context.exception.submitted] == [1, 3]
+        assert list(context.exception.failed) == [("MARI", 2)]
+        assert "MARI2: CircuitOpenError: Not calling ICAT" in str(context.exception)
+        assert [published.message.run_number for published in publisher.published] == [1, 3]
+
+    @patch("autoreduce_scripts.manual_operations.resilience.time")
+    def test_publish_is_retried(self, mock_time: Mock):
+        """
+        Test that a failed publish is retried before the run is reported as failed
+        """
+        publisher = Mock()
+        publisher.publish.side_effect = [BufferError("queue full"), None]
+        ms.submit_run(publisher, "1920000", "MARI", "/archive/MAR1.nxs", 1, "Title", software=SOFTWARE)
+        assert publisher.publish.call_count == 2
+        mock_time.sleep.assert_called_once()
@@ -0,0 +1,160 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_scripts.manual_operations import manual_submission as ms
+from autoreduce_scripts.manual_operations.dedupe import PublicationLog
+from autoreduce_scripts.manual_operations.rb_categories import RBCategory
+from autoreduce_scripts.manual_operations.scheduling import PendingSubmission, SubmissionScheduler, TokenBucket
+
+RUN_DATA = {
+    ("MARI", 1234): ("/archive/MARI1234.nxs", "1900000", "User run"),
+    ("MARI", 1235): ("/archive/MARI1235.nxs", "1935000", "Vanadium"),
+    ("WISH", 100): ("/archive/WISH100.nxs", "1935001", "Vanadium"),
+}
+
+
+def fake_clock(mock_time: Mock):
+    """Makes the patched time module's clock only advance when sleeping"""
+    clock = {"now": 100.0}
+
+    def sleep(seconds):
+        clock["now"] += seconds
+
+    mock_time.monotonic.side_effect = lambda: clock["now"]
+    mock_time.sleep.side_effect = sleep
+
+
+def pending(instrument: str, run_number: int, category: RBCategory) -> PendingSubmission:
+    """Makes a pending submission without run data"""
+    return PendingSubmission(instrument, run_number, ("", "", ""), category)
+
+
+class TokenBucketTest(TestCase):
+    """
+    Test the rate limiting of the service and the scheduler
+    """
+
+    @patch("autoreduce_scripts.manual_operations.scheduling.time")
+    def test_acquire(self, mock_time: Mock):
+        """
+        Test that a burst is let through straight away, and further tokens are waited for
+        """
+        fake_clock(mock_time)
+
+        bucket = TokenBucket(rate=2, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        mock_time.sleep.assert_not_called()
+        assert bucket.wait_time() == 0.5
+        assert not bucket.try_acquire()
+
+        bucket.acquire()
+        mock_time.sleep.assert_called_once_with(0.5)
+
+
+class SubmissionSchedulerTest(TestCase):
+    """
+    Test the order in which pending submissions are published
+    """
+
+    def test_weighted_interleave(self):
+        """
+        Test that categories are interleaved in proportion to their weights, highest first
+        """
+        scheduler = SubmissionScheduler(weights={"calibration": 8, "direct_access": 2})
+        for run_number in range(10):
+            scheduler.add(pending("MARI", run_number, RBCategory.DIRECT_ACCESS))
+            scheduler.add(pending("MARI", 100 + run_number, RBCategory.CALIBRATION))
+        assert len(scheduler) == 20
+
+        order = [submission.category for submission in scheduler]
+        assert order[0] == RBCategory.CALIBRATION
+        assert order[:10].count(RBCategory.CALIBRATION) == 8
+        assert len(scheduler) == 0
+
+    def test_instruments_take_turns(self):
+        """
+        Test that the instruments of a category take turns, keeping the order of their runs
+        """
+        scheduler = SubmissionScheduler()
+        for run_number in (1, 2, 3):
+            scheduler.add(pending("MARI", run_number, RBCategory.RAPID_ACCESS))
+        scheduler.add(pending("WISH", 10, RBCategory.RAPID_ACCESS))
+
+        order = [(submission.instrument, submission.run_number) for submission in scheduler]
+        assert order == [("MARI", 1), ("WISH", 10), ("MARI", 2), ("MARI", 3)]
+
+    @patch("autoreduce_scripts.manual_operations.scheduling.time")
+    def test_rate_limits(self, mock_time: Mock):
+        """
+        Test that while a category is rate limited the others go ahead, and otherwise its runs are waited for
+        """
+        fake_clock(mock_time)
+        scheduler = SubmissionScheduler(rate_limits={"rapid_access": 1})
+        for run_number in (1, 2, 3):
+            scheduler.add(pending("MARI", run_number, RBCategory.RAPID_ACCESS))
+        scheduler.add(pending("MARI", 4, RBCategory.DIRECT_ACCESS))
+
+        assert [submission.run_number for submission in scheduler] == [1, 4, 2, 3]
+        assert mock_time.sleep.call_count == 2
+
+    def test_invalid_configuration(self):
+        """
+        Test that unknown categories, and weights and rate limits that aren't positive are refused
+        """
+        with self.assertRaises(ValueError):
+            SubmissionScheduler(weights={"urgent": 10})
+        with self.assertRaises(ValueError):
+            SubmissionScheduler(weights={"calibration": 0})
+        for rate in (0, -1):
+            with self.assertRaises(ValueError):
+                SubmissionScheduler(rate_limits={"calibration": rate})
+
+
+@patch("autoreduce_scripts.manual_operations.manual_submission.get_run_data",
+       side_effect=lambda instrument, run_number, *_, **__: RUN_DATA[(instrument, run_number)])
+@patch("autoreduce_scripts.manual_operations.manual_submission.submit_resolved_run",
+       side_effect=lambda publisher, instrument, run_number, *_, **__: {"run_number": run_number})
+class SubmitCampaignTest(TestCase):
+    """
+    Test that campaigns are looked up first, then published in order of priority
+    """
+
+    def test_calibration_first(self, mock_submit: Mock, _):
+        """
+        Test that the calibration runs of all instruments are published before the user runs
+        """
+        messages = ms.submit_campaign({"mari": [1234, 1235], "WISH": 100}, publisher=Mock(), description="rerun")
+        assert [message["run_number"] for message in messages] == [1235, 100, 1234]
+        assert mock_submit.call_args.kwargs == {"description": "rerun"}
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.login_queue")
+    def test_main_schedules(self, _, mock_submit: Mock, __):
+        """
+        Test that manual_submission.main schedules the runs when asked to
+        """
+        messages = ms.main("MARI", [1234, 1235], schedule=True)
+        assert [message["run_number"] for message in messages] == [1235, 1234]
+        assert mock_submit.call_args.kwargs["user_id"] == -1
+
+    def test_failed_submission_is_released(self, mock_submit: Mock, _):
+        """
+        Test that the runs that weren't published are released from the publication log
+        """
+        mock_submit.side_effect = RuntimeError("Kafka is down")
+        with TemporaryDirectory() as log_dir:
+            path = Path(log_dir, "publications.sqlite3")
+            with patch("autoreduce_scripts.manual_operations.manual_submission.PublicationLog",
+                       side_effect=lambda window: PublicationLog(window, path)):
+                with self.assertRaises(RuntimeError):
+                    ms.submit_campaign({"MARI": [1234, 1235]}, publisher=Mock(), dedupe_window=60)
+            assert PublicationLog(60, path).claim("MARI", 1234, None)
+            assert PublicationLog(60, path).claim("MARI", 1235, None)
@@ -0,0 +1,142 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import io
+import socketserver
+import threading
+from contextlib import redirect_stderr
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, call, patch
+
+from autoreduce_scripts.manual_operations.service import (ServiceBusyError, SubmissionService, create_server,
+                                                          make_handler, request)
+
+
+@patch("autoreduce_scripts.manual_operations.service.setup_django")
+@patch("autoreduce_scripts.manual_operations.manual_submission.login_icat")
+@patch("autoreduce_scripts.manual_operations.manual_submission.login_queue")
+class SubmissionServiceTest(TestCase):
+    """
+    Test that the service processes requests with its warm connections
+    """
+
+    def setUp(self) -> None:
+        self.socket_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.socket_path = str(Path(self.socket_dir.name, "service.sock"))
+        self.service = SubmissionService(rate=100, burst=10, queue_size=2)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, make_handler(self.service))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.socket_dir.cleanup()
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.main", return_value=[{"run_number": 1234}])
+    def test_submit(self, mock_main: Mock, mock_login_queue: Mock, mock_login_icat: Mock, _):
+        """
+        Test that a submission is made with the service's publisher and ICAT client, which are only created once
+        """
+        self.service.start()
+        for _ in range(2):
+            assert request("submit", self.socket_path, instrument="MARI", runs=[1234]) == [{"run_number": 1234}]
+        self.service.stop()
+
+        mock_main.assert_called_with(publisher=mock_login_queue.return_value,
+                                     icat_client=mock_login_icat.return_value,
+                                     instrument="MARI",
+                                     runs=[1234])
+        mock_login_queue.assert_called_once()
+        mock_login_icat.assert_called_once()
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.main", return_value=[{"run_number": 1234}])
+    def test_profile_is_returned(self, mock_main: Mock, *_):
+        """
+        Test that a profiled request returns the summary of its profile to the client, which prints it
+        """
+        self.service.start()
+        with patch("autoreduce_scripts.manual_operations.instrumentation.database_wrapped"), \
+                redirect_stderr(io.StringIO()) as stderr:
+            assert request("submit", self.socket_path, instrument="MARI", runs=[1234], profile=True) == [{
+                "run_number":
+                1234
+            }]
+        self.service.stop()
+        mock_main.assert_called_once_with(publisher=self.service.publisher,
+                                          icat_client=self.service.icat_client,
+                                          instrument="MARI",
+                                          runs=[1234])
+        # printed once, by the client
+        assert stderr.getvalue().startswith("stage") and stderr.getvalue().count("stage") == 1
+
+    @patch("autoreduce_scripts.manual_operations.manual_remove.main", return_value=[1234])
+    def test_remove_without_prompting(self, mock_main: Mock, *_):
+        """
+        Test that removals are made without prompting for confirmation
+        """
+        self.service.start()
+        assert request("remove", self.socket_path, instrument="MARI", first_run=1234) == [1234]
+        assert request("remove", self.socket_path, instrument="MARI", first_run=1234, no_input=False) == [1234]
+        self.service.stop()
+        assert mock_main.call_args_list == [call(instrument="MARI", first_run=1234, no_input=True)] * 2
+
+    @patch("autoreduce_scripts.manual_operations.manual_submission.main", side_effect=RuntimeError("No RB number"))
+    def test_errors_are_returned(self, _, mock_login_queue: Mock, mock_login_icat: Mock, __):
+        """
+        Test that failed and unknown requests are reported to the client, and the service carries on
+        """
+        mock_login_icat.side_effect = RuntimeError("Unable to connect to ICAT.")
+        self.service.start()
+        with self.assertRaisesRegex(RuntimeError, "Unknown action 'rerun'"):
+            request("rerun", self.socket_path)
+        with self.assertRaisesRegex(RuntimeError, "No RB number"):
+            request("submit", self.socket_path, instrument="MARI", runs=1234)
+        self.service.stop()
+        assert self.service.publisher == mock_login_queue.return_value
+        assert self.service.icat_client is None
+
+    def test_queue_full(self, *_):
+        """
+        Test that requests are refused while the queue is full
+        """
+        self.service.enqueue("submit")
+        self.service.enqueue("submit")
+        with self.assertRaises(ServiceBusyError):
+            self.service.enqueue("submit")
+
+    def test_worker_survives_rate_limit_errors(self, *_):
+        """
+        Test that a failure while waiting for the rate limit fails the request, and the next request is processed
+        """
+        self.service.start()
+        with patch.object(self.service.bucket, "acquire", side_effect=[OSError("Interrupted"), None]), \
+                patch.object(self.service, "actions", {"submit": Mock(return_value=[1235])}):
+            with self.assertRaisesRegex(RuntimeError, "Interrupted"):
+                request("submit", self.socket_path, timeout=5)
+            assert request("submit", self.socket_path, timeout=5) == [1235]
+        self.service.stop()
+
+    def test_invalid_rate(self, *_):
+        """
+        Test that a rate or burst that would never let a request through is refused
+        """
+        with self.assertRaisesRegex(ValueError, "rate must be positive"):
+            SubmissionService(rate=0)
+        with self.assertRaisesRegex(ValueError, "capacity must be at least 1"):
+            SubmissionService(burst=0)
+
+    def test_socket_permissions(self, *_):
+        """
+        Test that the socket is only accessible to the user running the service from the moment it is created
+        """
+        path = Path(self.socket_dir.name, "private.sock")
+        with patch("autoreduce_scripts.manual_operations.service.os.chmod") as mock_chmod:
+            server = create_server(path, self.service)
+        server.server_close()
+        assert path.stat().st_mode & 0o777 == 0o600
+        mock_chmod.assert_not_called()
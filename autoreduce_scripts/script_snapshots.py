@@ -0,0 +1,303 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+Keeps the full history of the reduction scripts, not just the daily backup.
+
+The autoreduction directory of every NDX instrument is polled, and every distinct version
+of a reduction file is stored once, by the SHA256 hash of its content. An index records
+when each (instrument, file) changed to which hash, so the script that was active at
+any given time - e.g. when a reduction run was created - can be looked up directly,
+without checking out the git history of the backups.
+
+Versions are timestamped with the file's modification time, so an edit is attributed
+to when it was made rather than when it was noticed. A file that disappears is recorded
+as deleted when it is noticed, and no script is returned for it from then on.
+
+To keep polling:
+
+python3 script_snapshots.py poll --interval 60
+
+To print the reduce.py that MARI was using at a given time:
+
+python3 script_snapshots.py show MARI reduce.py 2022-06-01T12:00:00
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+# this calls the configuration of the logger which is done in the settings module
+from autoreduce_utils.settings import logging
+
+from autoreduce_scripts.backup_reduction_scripts import (ISIS_MOUNT_PATH, MAX_FILE_SIZE, REDUCE_FILE_PATTERNS,
+                                                         scan_reduction_files)
+from autoreduce_scripts.local_store import LOCAL_STORE_DIR, connect
+
+SNAPSHOT_DIR = LOCAL_STORE_DIR / "script_snapshots"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    instrument TEXT NOT NULL,
+    file TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (instrument, file, timestamp)
+);
+CREATE TABLE IF NOT EXISTS seen_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+"""
+
+# the hash recorded for a file when it is deleted
+DELETED = ""
+
+log = logging.getLogger(__file__)
+
+# a datetime, or a POSIX timestamp
+When = Union[datetime.datetime, float]
+
+
+def to_timestamp(when: When) -> float:
+    """
+    Converts a datetime to a POSIX timestamp. Naive datetimes are taken as local time.
+    """
+    return when.timestamp() if isinstance(when, datetime.datetime) else float(when)
+
+
+class ScriptSnapshotStore:
+    """
+    A content addressed store of reduction script versions, with an index of when they were active.
+    """
+
+    def __init__(self, root: Path = SNAPSHOT_DIR):
+        """
+        :param root: The directory holding the objects and the index
+        """
+        self.objects = root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.index = connect(root / "index.sqlite3", SCHEMA)
+
+    def _object_path(self, content_hash: str) -> Path:
+        return self.objects / content_hash[:2] / content_hash[2:]
+
+    def _write_object(self, content: bytes) -> str:
+        """
+        Stores the content, unless a file with the same content is already stored.
+
+        :return: The hash of the content
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._object_path(content_hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(zlib.compress(content))
+            os.replace(tmp_path, path)
+        return content_hash
+
+    def read_object(self, content_hash: str) -> bytes:
+        """
+        Returns the content stored under the hash
+        """
+        return zlib.decompress(self._object_path(content_hash).read_bytes())
+
+    def record(self, instrument: str, file_name: str, content: bytes, timestamp: float) -> str:
+        """
+        Records a version of a file. Nothing is added to the index if the content is the
+        same as the version that was active at that time.
+
+        :param instrument: The name of the instrument
+        :param file_name: The name of the file in the autoreduction directory, e.g. reduce.py
+        :param content: The content of the file
+        :param timestamp: When the version became active, as a POSIX timestamp
+        :return: The hash of the content
+        """
+        content_hash = self._write_object(content)
+        active = self.version_at(instrument, file_name, timestamp)
+        if active is None or active[1] != content_hash:
+            with self.index:
+                self.index.execute(
+                    "INSERT OR REPLACE INTO versions (instrument, file, timestamp, hash) VALUES (?, ?, ?, ?)",
+                    (instrument, file_name, timestamp, content_hash))
+        return content_hash
+
+    def record_deletion(self, instrument: str, file_name: str, timestamp: float):
+        """
+        Records that the file was deleted, so that no version of it is active from then on
+
+        :param instrument: The name of the instrument
+        :param file_name: The name of the file in the autoreduction directory, e.g. reduce.py
+        :param timestamp: When the file was deleted, as a POSIX timestamp
+        """
+        with self.index:
+            self.index.execute(
+                "INSERT OR REPLACE INTO versions (instrument, file, timestamp, hash) VALUES (?, ?, ?, ?)",
+                (instrument, file_name, timestamp, DELETED))
+
+    def latest_version(self, instrument: str, file_name: str, when: When) -> Optional[Tuple[float, str]]:
+        """
+        Finds the last version of the file recorded at or before the given time, including deletions.
+
+        :return: The timestamp and hash of the version, or None if none is known from before that time
+        """
+        return self.index.execute(
+            "SELECT timestamp, hash FROM versions WHERE instrument = ? AND file = ? AND timestamp <= ? "
+            "ORDER BY timestamp DESC LIMIT 1", (instrument, file_name, to_timestamp(when))).fetchone()
+
+    def version_at(self, instrument: str, file_name: str, when: When) -> Optional[Tuple[float, str]]:
+        """
+        Finds the version of the file that was active at the given time.
+
+        :param instrument: The name of the instrument
+        :param file_name: The name of the file in the autoreduction directory, e.g. reduce.py
+        :param when: The time to look up, a datetime or POSIX timestamp
+        :return: The timestamp and hash of the version, or None if no version is known from before that time
+                 or the file was deleted by then
+        """
+        version = self.latest_version(instrument, file_name, when)
+        return None if version is None or version[1] == DELETED else version
+
+    def script_at(self, instrument: str, file_name: str, when: When) -> Optional[str]:
+        """
+        Returns the content of the file that was active at the given time.
+
+        For example, the script used by a reduction run is
+        ``store.script_at(run.instrument.name, "reduce.py", run.created)``
+
+        :param instrument: The name of the instrument
+        :param file_name: The name of the file in the autoreduction directory, e.g. reduce.py
+        :param when: The time to look up, a datetime or POSIX timestamp
+        :return: The content of the file, or None if no version is known from before that time
+                 or the file was deleted by then
+        """
+        version = self.version_at(instrument, file_name, when)
+        if version is None:
+            return None
+        return self.read_object(version[1]).decode("utf-8", errors="replace")
+
+    def poll_file(self, instrument: str, path: Path) -> bool:
+        """
+        Records the current version of the file, if it has been modified since it was last seen,
+        or its deletion, if it was seen before and no longer exists.
+        Files whose size and modification time are unchanged are not read.
+
+        :param instrument: The name of the instrument
+        :param path: The path to the file
+        :return: Whether the file was modified or deleted since it was last seen
+        """
+        seen = self.index.execute("SELECT size, mtime FROM seen_files WHERE path = ?", (str(path), )).fetchone()
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            if seen is None:
+                return False
+            self.record_deletion(instrument, path.name, time.time())
+            with self.index:
+                self.index.execute("DELETE FROM seen_files WHERE path = ?", (str(path), ))
+            return True
+        if seen == (stat.st_size, stat.st_mtime_ns):
+            return False
+
+        # a file restored with its old modification time becomes active again when it is noticed
+        timestamp = stat.st_mtime
+        latest = self.latest_version(instrument, path.name, time.time())
+        if latest is not None and latest[1] == DELETED and latest[0] > timestamp:
+            timestamp = time.time()
+        self.record(instrument, path.name, path.read_bytes(), timestamp)
+        with self.index:
+            self.index.execute("INSERT OR REPLACE INTO seen_files (path, size, mtime) VALUES (?, ?, ?)",
+                               (str(path), stat.st_size, stat.st_mtime_ns))
+        return True
+
+
+def instrument_name(mount_path: Path, path: Path) -> str:
+    """
+    Returns the name of the instrument from the NDX directory the file is in
+    """
+    return path.relative_to(mount_path).parts[0][len("NDX"):]
+
+
+def reduction_files(mount_path: Path) -> Tuple[Dict[Path, str], List[Path]]:
+    """
+    Finds the reduction files in the NDX directories of the mount
+
+    :return: The instrument name of each reduction file by path, and the directories that could not be scanned
+    """
+    files, unscanned = scan_reduction_files(mount_path, REDUCE_FILE_PATTERNS, MAX_FILE_SIZE, workers=8, timeout=120)
+    return {path: instrument_name(mount_path, path) for path in files}, unscanned
+
+
+def poll(store: ScriptSnapshotStore, mount_path: Path = ISIS_MOUNT_PATH) -> int:
+    """
+    Records any new versions of the reduction files of all instruments, and the files
+    seen before that weren't found. Those are checked again, as a file that is no longer
+    matched by the scan, e.g. because it grew too large, isn't necessarily deleted.
+    The files in a directory whose scan timed out or failed are left until the next poll,
+    rather than checked one by one on a mount that isn't responding.
+
+    :return: How many files were modified or deleted since the last poll
+    """
+    found, unscanned = reduction_files(mount_path)
+    for (seen, ) in store.index.execute("SELECT path FROM seen_files").fetchall():
+        path = Path(seen)
+        if path in found or mount_path not in path.parents:
+            continue
+        if any(directory in path.parents for directory in unscanned):
+            continue
+        found[path] = instrument_name(mount_path, path)
+
+    modified = 0
+    for path, instrument in found.items():
+        try:
+            modified += store.poll_file(instrument, path)
+        except OSError as err:
+            log.error("Could not snapshot %s. Error: %s", path, err)
+    return modified
+
+
+def main(args):
+    """
+    Polls the reduction files, or shows the version of a file active at a given time
+    """
+    store = ScriptSnapshotStore(Path(args.store))
+    if args.command == "show":
+        script = store.script_at(args.instrument.upper(), args.file, datetime.datetime.fromisoformat(args.when))
+        if script is None:
+            log.error("No version of %s for %s is known from before %s", args.file, args.instrument, args.when)
+        else:
+            print(script)
+        return
+
+    while True:
+        modified = poll(store)
+        log.info("Snapshot %s modified reduction files", modified)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Reduction script snapshots")
+    parser.add_argument("--store", default=str(SNAPSHOT_DIR), help="Directory holding the snapshots")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    poll_parser = subparsers.add_parser("poll", help="Record new versions of the reduction files")
+    poll_parser.add_argument("--interval",
+                             type=float,
+                             default=0,
+                             help="Seconds between polls. If 0, poll once and exit")
+    show_parser = subparsers.add_parser("show", help="Print the version of a file active at a given time")
+    show_parser.add_argument("instrument")
+    show_parser.add_argument("file")
+    show_parser.add_argument("when", help="ISO format date and time, e.g. 2022-06-01T12:00:00")
+
+    main(parser.parse_args())
@@ -0,0 +1,202 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import threading
+from argparse import Namespace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from git import PushInfo, Remote, Repo
+
+from autoreduce_scripts import backup_reduction_scripts
+from autoreduce_scripts.backup_reduction_scripts import (AUTOREDUCTION_PATH, MAX_FILE_SIZE, CopyJob, TimedJob,
+                                                         commit_and_push, load_manifest, main, run_jobs)
+
+ARGS = Namespace(dry_run=False, patterns=None, max_size=MAX_FILE_SIZE, workers=4, timeout=30)
+
+
+class BackupReductionScriptsTest(TestCase):
+    """
+    Test backing up the reduction scripts of a temporary mount to a bare remote
+    """
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        tmp = Path(self.tmp_dir.name)
+        self.mount = tmp / "isis"
+        self.storage = tmp / "storage"
+        self.manifest = tmp / "backup_manifest.json"
+        self.remote = Repo.init(tmp / "remote.git", bare=True)
+        repo = Repo.init(self.storage)
+        repo.git.symbolic_ref("HEAD", "refs/heads/master")
+        repo.create_remote("origin", self.remote.working_dir)
+
+        self.scripts = self.mount / "NDXMARI" / AUTOREDUCTION_PATH
+        self.scripts.mkdir(parents=True)
+        (self.scripts / "reduce.py").write_text("print('reduce')\n", encoding="utf-8")
+        (self.scripts / "reduce_vars.py").write_text("standard_vars = {}\n", encoding="utf-8")
+        (self.scripts / "compiled.py").write_bytes(b"\0\1\2")
+        (self.mount / "NDXWISH").mkdir()
+
+        for name, value in (("ISIS_MOUNT_PATH", self.mount), ("STORAGE_DIR", self.storage), ("MANIFEST_PATH",
+                                                                                             self.manifest)):
+            patcher = patch.object(backup_reduction_scripts, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def remote_commits(self) -> list:
+        """Returns the commits pushed to the remote, newest first"""
+        return list(self.remote.iter_commits("master")) if self.remote.heads else []
+
+    def backed_up(self, name: str) -> str:
+        """Returns the content of the backed up file in the last pushed commit"""
+        blob = self.remote.head.commit.tree / "NDXMARI" / str(AUTOREDUCTION_PATH) / name
+        return blob.data_stream.read().decode("utf-8")
+
+    def test_first_run(self):
+        """
+        Test that the first backup commits the text files and skips the binary file
+        """
+        main(ARGS)
+
+        assert len(self.remote_commits()) == 1
+        assert self.backed_up("reduce.py") == "print('reduce')\n"
+        files = {blob.name for blob in self.remote.head.commit.tree.traverse() if blob.type == "blob"}
+        assert files == {"reduce.py", "reduce_vars.py"}
+        assert load_manifest(self.manifest)[str(self.scripts / "compiled.py")]["sha256"] is None
+
+    def test_unchanged_second_run(self):
+        """
+        Test that a second backup with nothing changed commits nothing and reads no file again
+        """
+        main(ARGS)
+        with patch("autoreduce_scripts.backup_reduction_scripts.is_text") as mock_is_text, \
+                patch("autoreduce_scripts.backup_reduction_scripts.commit_and_push") as mock_commit:
+            main(ARGS)
+
+        mock_is_text.assert_not_called()
+        mock_commit.assert_not_called()
+        assert len(self.remote_commits()) == 1
+
+    def test_changed_file(self):
+        """
+        Test that only a changed file is copied again and committed
+        """
+        main(ARGS)
+        (self.scripts / "reduce.py").write_text("print('reduce again')\n", encoding="utf-8")
+        with patch("autoreduce_scripts.backup_reduction_scripts.shutil.copy",
+                   wraps=backup_reduction_scripts.shutil.copy) as mock_copy:
+            main(ARGS)
+
+        assert [call.args[0] for call in mock_copy.call_args_list] == [self.scripts / "reduce.py"]
+        assert len(self.remote_commits()) == 2
+        assert self.backed_up("reduce.py") == "print('reduce again')\n"
+        assert self.remote.head.commit.stats.files.keys() == {f"NDXMARI/{AUTOREDUCTION_PATH}/reduce.py"}
+
+    def test_rejected_push(self):
+        """
+        Test that a push rejected by the remote fails the backup, and the manifest keeps the old entries
+        so that the changed file is backed up again next time
+        """
+        main(ARGS)
+        manifest = load_manifest(self.manifest)
+        # another clone pushes first, so the next push isn't a fast-forward
+        other = Repo.clone_from(self.remote.working_dir, Path(self.tmp_dir.name, "other"))
+        other.index.commit("Diverging commit")
+        other.remote("origin").push("master")
+        (self.scripts / "reduce.py").write_text("print('reduce again')\n", encoding="utf-8")
+
+        with self.assertRaisesRegex(RuntimeError, "Could not push"):
+            main(ARGS)
+        assert load_manifest(self.manifest) == manifest
+        assert self.remote.head.commit.message == "Diverging commit"
+
+    def test_rejected_flags(self):
+        """
+        Test that a push result flagged only as rejected, without the error flag, is still a failure
+        """
+        (self.storage / "reduce.py").write_text("print('reduce')\n", encoding="utf-8")
+        for flag in (PushInfo.REJECTED, PushInfo.REMOTE_REJECTED):
+            result = PushInfo(flag, None, "refs/heads/master", None, summary="[rejected] (non-fast-forward)")
+            with patch.object(Remote, "push", return_value=[result]):
+                with self.assertRaisesRegex(RuntimeError, "non-fast-forward"):
+                    commit_and_push(self.storage, [self.storage / "reduce.py"])
+
+
+class RunJobsTest(TestCase):
+    """
+    Test running jobs in a bounded pool
+    """
+
+    def setUp(self) -> None:
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def waiting_jobs(self, *hangs: bool) -> list:
+        """Returns jobs that wait until released if they hang, or finish straight away"""
+        release = self.release
+
+        class WaitingJob(TimedJob):
+            """Waits until released, or finishes straight away"""
+
+            def __init__(self, hang: bool):
+                super().__init__()
+                self.hang = hang
+
+            def work(self):
+                if self.hang:
+                    release.wait(5)
+
+        return [WaitingJob(hang) for hang in hangs]
+
+    def test_timeout(self):
+        """
+        Test that a hung job is abandoned and the other jobs still run in the remaining threads
+        """
+        jobs = self.waiting_jobs(True, False, False, False)
+        finished, timed_out = run_jobs(jobs, workers=2, timeout=0.2)
+        assert timed_out == jobs[:1]
+        assert timed_out[0].abandoned
+        assert sorted(finished, key=jobs.index) == jobs[1:]
+
+    def test_all_threads_hung(self):
+        """
+        Test that the jobs that can't start, because every thread is held by a hung job, are given up on
+        """
+        jobs = self.waiting_jobs(True, False, False)
+        finished, timed_out = run_jobs(jobs, workers=1, timeout=0.2)
+        assert not finished
+        assert set(timed_out) == set(jobs)
+        assert all(job.started_at is None for job in jobs[1:])
+
+    def test_abandoned_copy(self):
+        """
+        Test that a copy that was abandoned doesn't replace the backed up file, or leave its partial copy behind
+        """
+        with TemporaryDirectory() as tmp_dir:
+            source, destination = Path(tmp_dir, "reduce.py"), Path(tmp_dir, "storage")
+            source.write_text("print('new')\n", encoding="utf-8")
+            destination.mkdir()
+            (destination / "reduce.py").write_text("print('old')\n", encoding="utf-8")
+            job = CopyJob(source, destination, None)
+            job.abandon()
+            job.run()
+
+            assert (destination / "reduce.py").read_text(encoding="utf-8") == "print('old')\n"
+            assert [path.name for path in destination.iterdir()] == ["reduce.py"]
+            assert not job.changed and job.entry is None
+
+    def test_abstract(self):
+        """
+        Test that a job must say what work it does
+        """
+        with self.assertRaises(TypeError):
+            TimedJob()  # pylint:disable=abstract-class-instantiated
@@ -0,0 +1,102 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+import datetime
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_scripts.backup_reduction_scripts import AUTOREDUCTION_PATH
+from autoreduce_scripts.script_snapshots import ScriptSnapshotStore, poll
+
+
+class ScriptSnapshotStoreTest(TestCase):
+    """
+    Test recording and looking up the versions of the reduction scripts
+    """
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.store = ScriptSnapshotStore(Path(self.tmp_dir.name, "snapshots"))
+        self.mount = Path(self.tmp_dir.name, "isis")
+        self.scripts = self.mount / "NDXMARI" / AUTOREDUCTION_PATH
+        self.scripts.mkdir(parents=True)
+        self.reduce_py = self.scripts / "reduce.py"
+
+    def tearDown(self) -> None:
+        self.store.index.close()
+        self.tmp_dir.cleanup()
+
+    def write_script(self, content: str, mtime: float):
+        """Writes reduce.py with the given modification time"""
+        self.reduce_py.write_text(content, encoding="utf-8")
+        os.utime(self.reduce_py, (mtime, mtime))
+
+    def test_version_at(self):
+        """
+        Test that the version active at a time is the last one recorded before it,
+        and recording the active content again adds no version
+        """
+        first = self.store.record("MARI", "reduce.py", b"first", 100)
+        self.store.record("MARI", "reduce.py", b"second", 200)
+        assert self.store.record("MARI", "reduce.py", b"second", 300)
+
+        assert self.store.version_at("MARI", "reduce.py", 50) is None
+        assert self.store.version_at("MARI", "reduce.py", 150) == (100, first)
+        assert self.store.version_at("MARI", "reduce.py", 300)[0] == 200
+        assert self.store.script_at("MARI", "reduce.py", datetime.datetime.fromtimestamp(250)) == "second"
+        assert self.store.script_at("MARI", "reduce_vars.py", 250) is None
+
+    def test_poll_file_unchanged(self):
+        """
+        Test that a file is only read again when its size or modification time changes
+        """
+        self.write_script("first", 100)
+        assert self.store.poll_file("MARI", self.reduce_py)
+        assert not self.store.poll_file("MARI", self.reduce_py)
+
+        self.write_script("second", 200)
+        assert self.store.poll_file("MARI", self.reduce_py)
+        assert self.store.script_at("MARI", "reduce.py", 150) == "first"
+        assert self.store.script_at("MARI", "reduce.py", 200) == "second"
+
+    def test_deletion(self):
+        """
+        Test that a deleted file has no script from when the deletion was noticed,
+        and is active again when it is restored
+        """
+        self.write_script("first", 100)
+        poll(self.store, self.mount)
+        self.reduce_py.unlink()
+        before_deletion = time.time()
+        assert poll(self.store, self.mount) == 1
+        assert poll(self.store, self.mount) == 0
+
+        assert self.store.script_at("MARI", "reduce.py", before_deletion - 1) == "first"
+        assert self.store.script_at("MARI", "reduce.py", time.time()) is None
+        assert self.store.version_at("MARI", "reduce.py", time.time()) is None
+
+        # restored with its old modification time
+        self.write_script("first", 100)
+        assert poll(self.store, self.mount) == 1
+        assert self.store.script_at("MARI", "reduce.py", time.time()) == "first"
+
+    def test_unscanned_directory(self):
+        """
+        Test that the files seen before in a directory whose scan timed out are not checked or marked deleted
+        """
+        self.write_script("first", 100)
+        poll(self.store, self.mount)
+        self.reduce_py.unlink()
+        with patch("autoreduce_scripts.script_snapshots.scan_reduction_files", return_value=([], [self.scripts])):
+            assert poll(self.store, self.mount) == 0
+        assert self.store.script_at("MARI", "reduce.py", time.time()) == "first"
+
+        assert poll(self.store, self.mount) == 1
+        assert self.store.script_at("MARI", "reduce.py", time.time()) is None
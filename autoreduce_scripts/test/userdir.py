@@ -0,0 +1,28 @@
+# ############################################################################### #
+# Autoreduction Repository : https://github.com/autoreduction/autoreduce
+#
+# Copyright &copy; 2022 ISIS Rutherford Appleton Laboratory UKRI
+# SPDX - License - Identifier: GPL-3.0-or-later
+# ############################################################################### #
+"""
+A pytest plugin pointing AUTOREDUCTION_USERDIR at a temporary directory, so that the local stores
+the tests create, e.g. the miss cache, don't end up in the real ~/.autoreduce.
+
+It is loaded with -p in pytest.ini, because autoreduce_utils.settings reads the variable when it is
+imported, which happens when pytest-django sets Django up, before any conftest.py is loaded.
+"""
+import os
+import shutil
+import tempfile
+
+if "AUTOREDUCTION_USERDIR" not in os.environ:
+    USERDIR = tempfile.mkdtemp(prefix="autoreduce-tests-")
+    os.environ["AUTOREDUCTION_USERDIR"] = USERDIR
+else:
+    USERDIR = None
+
+
+def pytest_unconfigure():
+    """Removes the temporary directory after the tests"""
+    if USERDIR is not None:
+        shutil.rmtree(USERDIR, ignore_errors=True)